@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/27
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 离线签名吞吐量测试. 对比单进程依次签名和不同进程数的 ParallelSigner, 不需要连接节点
+#
+#   python benchmarks/signing.py -n 2000
+#   python benchmarks/signing.py -n 5000 -p 1 2 4 8
+import argparse
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ucwallet.content_contract.signer import ParallelSigner, sign_serial  # noqa: E402
+
+# 只用于测试的私钥
+PRIVATE_KEY = "0x" + "11" * 32
+
+
+def make_transactions(n):
+    """构造n笔 _build_transaction 格式的合约调用交易"""
+    data = "0xa9059cbb" + "00" * 12 + "22" * 20 + "%064x" % 10 ** 18
+    return [{
+        "to": "0x" + "33" * 20,
+        "value": 0,
+        "gas": 60000,
+        "gasPrice": 10 ** 9,
+        "nonce": nonce,
+        "chainId": 1,
+        "data": data,
+    } for nonce in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline signing throughput benchmark")
+    parser.add_argument("-n", type=int, default=2000, help="交易数")
+    parser.add_argument("-p", type=int, nargs="*", help="测试的进程数, 默认为 1, 2, 4 ... CPU核数")
+    args = parser.parse_args()
+
+    transactions = make_transactions(args.n)
+    cpus = os.cpu_count() or 1
+    processes = args.p if args.p else sorted({min(2 ** i, cpus) for i in range(cpus.bit_length() + 1)})
+
+    start = time.perf_counter()
+    expected = sign_serial(PRIVATE_KEY, transactions)
+    serial = time.perf_counter() - start
+    print("{:<10} {:>10} {:>10} {:>8}".format("signer", "time(s)", "tx/s", "speedup"))
+    print("{:<10} {:>10.2f} {:>10.0f} {:>8.2f}".format("serial", serial, args.n / serial, 1))
+
+    for p in processes:
+        with ParallelSigner(PRIVATE_KEY, processes=p) as signer:
+            # 进程池启动和私钥加载不计入签名耗时
+            signer.sign(transactions[:p])
+            start = time.perf_counter()
+            signed = signer.sign(transactions)
+            elapsed = time.perf_counter() - start
+        if signed != expected:
+            print("{} processes: signed transactions differ from serial signing".format(p))
+            return 1
+        print("{:<10} {:>10.2f} {:>10.0f} {:>8.2f}".format("{} proc".format(p), elapsed, args.n / elapsed,
+                                                            serial / elapsed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
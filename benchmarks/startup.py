@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/22
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : ucwallet 冷启动耗时测试. 每轮启动一个新的python进程, 分阶段计时直到命令提示符可用:
+#            导入CLI模块 -> 创建 UCwallet(解密keystore, 读取命令列表) -> 创建命令补全(导入prompt_toolkit).
+#            之后合约(web3)在后台加载, 单独统计到加载完成的时间(contract), 不计入冷启动
+#
+#   python benchmarks/startup.py -n 10
+#   python benchmarks/startup.py --keystore haibo.json --password 12345678  # 包含keystore解密
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 只用于测试的私钥, 不含keystore解密(scrypt)的耗时; --keystore 时解密计入init
+PRIVATE_KEY = "0x" + "11" * 32
+
+CHILD = r'''
+import json, sys, time
+start = time.perf_counter()
+timings = {}
+import ucwallet.ucwallet_cli as cli
+timings["import"] = time.perf_counter() - start
+t = time.perf_counter()
+keystore, password, private_key = sys.argv[1:4]
+if keystore:
+    wallet = cli.UCwallet(keystore_file=keystore, keystore_pwd=password)
+else:
+    wallet = cli.UCwallet(keystore_file=None, keystore_pwd=None, private_key=private_key)
+timings["init"] = time.perf_counter() - t
+t = time.perf_counter()
+wallet._completer()
+import prompt_toolkit.shortcuts
+timings["prompt"] = time.perf_counter() - t
+timings["total"] = time.perf_counter() - start
+t = time.perf_counter()
+wallet._start_loading()
+wallet.content_contract
+timings["contract"] = time.perf_counter() - t
+print(json.dumps(timings))
+'''
+
+
+def run_once(keystore, password):
+    output = subprocess.check_output([sys.executable, "-c", CHILD, keystore or "", password or "", PRIVATE_KEY],
+                                     cwd=ROOT, env=dict(os.environ, PYTHONPATH=os.pathsep.join(
+                                         [ROOT, os.environ.get("PYTHONPATH", "")])))
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ucwallet cold start benchmark")
+    parser.add_argument("-n", type=int, default=10, help="运行次数")
+    parser.add_argument("--keystore", help="keystore文件, 默认使用私钥登录(不含解密耗时)")
+    parser.add_argument("--password", help="keystore密码")
+    parser.add_argument("--budget", type=float, default=300, help="冷启动耗时上限(毫秒), 超过时返回1")
+    args = parser.parse_args()
+
+    runs = [run_once(args.keystore, args.password) for _ in range(args.n)]
+    print("{:<8} {:>10} {:>10} {:>10}".format("phase", "min(ms)", "median(ms)", "max(ms)"))
+    for phase in ("import", "init", "prompt", "total", "contract"):
+        values = [r[phase] * 1000 for r in runs]
+        print("{:<8} {:>10.1f} {:>10.1f} {:>10.1f}".format(phase, min(values), statistics.median(values), max(values)))
+    total = statistics.median([r["total"] * 1000 for r in runs])
+    contract = statistics.median([r["contract"] * 1000 for r in runs])
+    print("median cold start {:.1f} ms, budget {:.0f} ms; contract loaded in background after {:.1f} ms".format(
+        total, args.budget, contract))
+    return 0 if total <= args.budget else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
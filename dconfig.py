@@ -13,12 +13,23 @@ provider = "http://testnet.usc.ulord.one:58858"
 # provider = "http://114.67.37.244:58858"
 # provider = "https://rinkeby.infura.io/v3/IPYK4Y721E5JAHXZC48BX4VT56EC67XI1N"
 # provider = "https://rinkeby.infura.io/v3/7226f0ad456a4f1189fee961011684ac"
+# 可以配置多个侧链节点, 请求会在这些节点之间分配, 某个节点连接失败时自动切换
+providers = [provider]
+ENDPOINT_STRATEGY = "round_robin"  # round_robin: 轮询; least_latency: 选择延迟最低的节点
+POOL_SIZE = 20  # 每个节点的连接池大小
+REQUEST_TIMEOUT = 10  # 请求超时时间(秒)
+RETRIES = 3  # 连接失败时的重试次数
+BACKOFF = 0.3  # 重试退避系数(秒)
+UDFS_CACHE_SIZE = 2 * 1024 ** 3  # 本地UDFS缓存的大小上限(字节), 0 表示不使用缓存
 BLOCK_GAS_LIMIT = 6800000
 GAS_LIMIT = 6800000
 USER_DATA_DIR = AppDirs("UlordPySdk", "").user_data_dir
 CURR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sols")
 
-print(USER_DATA_DIR,CURR_DIR)
-if os.path.isdir(USER_DATA_DIR) is False:
-    import shutil
-    shutil.copytree(CURR_DIR, USER_DATA_DIR)
\ No newline at end of file
+
+def prepare_user_data_dir():
+    """第一次使用时把sols目录复制到用户数据目录, 返回用户数据目录"""
+    if os.path.isdir(USER_DATA_DIR) is False:
+        import shutil
+        shutil.copytree(CURR_DIR, USER_DATA_DIR)
+    return USER_DATA_DIR
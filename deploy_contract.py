@@ -7,16 +7,23 @@
 # @Des     :
 
 
+import hashlib
 import os
 import json
-import time
-from web3 import Web3, HTTPProvider
+from web3 import Web3
 from web3.eth import Account
-from solc import compile_files
 from web3.middleware import geth_poa_middleware
 from appdirs import AppDirs
 
 import dconfig
+from ucwallet.compile_cache import CompileCache
+from ucwallet.content_contract.nonce import get_nonce_manager, send_signed
+from ucwallet.content_contract.fees import GasEstimator
+from ucwallet.content_contract.loader import build_abi_index
+from ucwallet.content_contract.receipts import ReceiptTracker
+from ucwallet.deploy_journal import DeployJournal, DONE, FAILED, SENT
+from ucwallet.keystore import unlock_keystore
+from ucwallet.transport import PooledHTTPProvider, get_transport
 
 USER_DATA_DIR = dconfig.USER_DATA_DIR
 CURR_DIR = dconfig.CURR_DIR
@@ -32,6 +39,8 @@ class Deploy(object):
             keystore_pwd=None,
             limit=None,
             price=None,
+            resume=True,
+            gas_price_strategy=None,
     ):
         """
         :param config: 配置文件路径
@@ -42,24 +51,27 @@ class Deploy(object):
         :param provider: 提供者(指定连接到哪个网络中)
         :param limit: 区块gas上限
         :param price: 区块gas价格
+        :param resume: 是否从上次中断的部署日志恢复, False时清空日志重新部署. 部署完成后日志会被归档, 不会再恢复
+        :param gas_price_strategy: gas价格策略 strategy(web3, transaction_params), 默认使用固定的 price
         """
-        provider = dconfig.provider
-
         self.gas_limit = limit if limit else dconfig.GAS_LIMIT
         self.gas_price = price if price else Web3.toWei("25", "gwei")
-        self.w3 = Web3(HTTPProvider(dconfig.provider))
+        self.gas_price_strategy = gas_price_strategy
+        # 与 ContentContract 共用连接池
+        self.transport = get_transport(dconfig.providers)
+        self.w3 = Web3(PooledHTTPProvider(self.transport))
         # Rinkeby测试网络使用的是POA权威证明, 需要使用这个中间件才能正常工作
         # http://web3py.readthedocs.io/en/stable/middleware.html#geth-style-proof-of-authority
-        if provider.startswith("https://rinkeby"):
+        if any(e.startswith("https://rinkeby") for e in self.transport.endpoints):
             self.w3.middleware_stack.inject(geth_poa_middleware, layer=0)
+        self.receipts = ReceiptTracker(self.w3, self.transport, timeout=600)
+        self.gas_estimator = GasEstimator(cap=self.gas_limit)
 
         if privateKey:
             self.account = Account.privateKeyToAccount(privateKey)
         elif keystorefile and keystore_pwd:
-            with open(keystorefile) as wf:
-                wallet = json.load(wf)
-                privateKey = Account.decrypt(wallet, keystore_pwd)
-                self.account = Account.privateKeyToAccount(privateKey)
+            privateKey = unlock_keystore(keystorefile, keystore_pwd)
+            self.account = Account.privateKeyToAccount(privateKey)
         else:
             raise ValueError(
                 "The deployment contract requires a valid address."
@@ -70,6 +82,10 @@ class Deploy(object):
         self.addresses = {}  # 记录发布合约的合约地址
         self.addresses["self"] = self.account.address
         self.prepare_dir()  # 创建abi保存地址
+        self.compile_cache = CompileCache()
+        self.journal = DeployJournal(os.path.join(USER_DATA_DIR, "deploy_journal_{}.jsonl".format(self.account.address)))
+        if not resume:
+            self.journal.clear()
 
     def prepare_dir(self):
         # 本地
@@ -83,8 +99,7 @@ class Deploy(object):
             os.mkdir(bin_dir)
 
         # 全局
-        if not os.path.isdir(USER_DATA_DIR):
-            os.makedirs(USER_DATA_DIR)
+        dconfig.prepare_user_data_dir()
         self.abi_dir = os.path.join(USER_DATA_DIR, "abi")
         if not os.path.isdir(self.abi_dir):
             os.mkdir(self.abi_dir)
@@ -100,20 +115,72 @@ class Deploy(object):
             conf = json.load(f)
         return conf
 
-    def _nonce(self, value=0):
-        nonce = self.w3.eth.getTransactionCount(self.account.address) + value
-        return nonce
+    @property
+    def nonce_manager(self):
+        """部署账户的本地nonce分配器, 与ContentContract共用"""
+        return get_nonce_manager(self.w3.eth, self.account.address)
+
+    def _nonce(self):
+        return self.nonce_manager.next_nonce()
+
+    def _gas_price(self):
+        if self.gas_price_strategy is None:
+            return self.gas_price
+        return self.gas_price_strategy(self.w3, None)
 
     def _build_transaction(self, func, gas_limit=None, gas_price=None, nonce=None):
-        """将合约方法的调用构建为离线交易对象"""
-        return func.buildTransaction({"nonce": nonce if nonce else self._nonce(),
-                                      "gas": gas_limit if gas_limit else self.gas_limit,
-                                      "gasPrice": gas_price if gas_price else self.gas_price, })
+        """将合约方法的调用构建为离线交易对象, nonce最后分配, 构建失败时归还"""
+        transaction = {"gas": gas_limit if gas_limit else self.gas_limit,
+                       "gasPrice": gas_price if gas_price else self._gas_price(), }
+        if nonce is not None:
+            transaction["nonce"] = nonce
+            return func.buildTransaction(transaction)
+        transaction["nonce"] = self._nonce()
+        try:
+            return func.buildTransaction(transaction)
+        except Exception:
+            self.nonce_manager.release(transaction["nonce"])
+            raise
+
+    def _sign_and_send_rawtransaction(self, transaction, step=None, key=None):
+        """签名并发送交易, 发送前先把交易hash和nonce写入部署日志. nonce冲突的处理见 nonce.send_signed"""
+        def journal(tx_hash, tx):
+            if step:
+                self.journal.record(step, key=key, status=SENT, tx_hash=tx_hash, nonce=tx["nonce"])
 
-    def _sign_and_send_rawtransaction(self, transaction):
-        signed = self.account.signTransaction(transaction)
-        tx_hash = Web3.toHex(self.w3.eth.sendRawTransaction(signed.rawTransaction))
-        return tx_hash
+        return send_signed(self.w3.eth, self.nonce_manager, self.account.signTransaction, transaction,
+                           before_send=journal)
+
+    def _reconcile(self, step, key):
+        """ 根据链上状态核对部署日志中的一步
+        :param step: 步骤名
+        :param key: 步骤的输入(字节码、参数等)的摘要, 与日志中不一致时需要重新执行
+        :return: (DONE, 日志记录), 交易已发送等待回执时为 (SENT, 交易hash), 需要(重新)执行时返回None
+        """
+        record = self.journal.get(step)
+        if record is None or record.get("key") != key:
+            return None
+        if record["status"] == DONE:
+            # 合约地址上没有代码说明连接的是另一条链, 或者链已经重置
+            if record.get("address") and not self.w3.eth.getCode(record["address"]):
+                return None
+            return DONE, record
+        if record["status"] == FAILED:
+            return None
+        tx_hash = record["tx_hash"]
+        receipt = self.w3.eth.getTransactionReceipt(tx_hash)
+        if receipt is not None:
+            if receipt.get("status") == 0:
+                return None
+            return SENT, tx_hash
+        if self.w3.eth.getTransaction(tx_hash) is not None:
+            return SENT, tx_hash
+        # 交易没有被节点接收(发送前中断或已被丢弃), 重新发送
+        return None
+
+    @staticmethod
+    def _step_key(*items):
+        return hashlib.sha256(json.dumps(items, sort_keys=True).encode("utf-8")).hexdigest()
 
     def deploy(self, **kwargs):
         """ 编译和部署合约 """
@@ -129,53 +196,112 @@ class Deploy(object):
         sortkeys = deploy_conf["sortkeys"]
         if not isinstance(sortkeys, list):
             raise ValueError('"sortkeys" value error. ')
-        sortfiles = [os.path.join(self.spath, key + ".sol") for key in sortkeys]
-        compileds = compile_files(sortfiles)
-        print("Smart contracts are being deployed...\n")
+        waves = self.plan(deploy_conf)
+        # 只编译源文件有变化的合约
+        compileds = self.compile_cache.compile({key: os.path.join(self.spath, key + ".sol") for key in sortkeys})
         for cname in sortkeys:
-            cv = None
-            for ck in compileds.keys():
-                if ck.endswith(cname):
-                    cv = compileds[ck]
-                    break
-            if not cv:
-                raise ValueError("No {} compilation results can be found".format(ck))
-            abi_file = os.path.join(self.abi_dir, cname + ".abi")
-            bin_file = os.path.join(self.bin_dir, cname + ".bin")
-            abi_content = cv.get("abi")
-            bin_content = cv.get("bin")
-            self.save_file(abi_file, abi_content)
-            self.save_file(bin_file, bin_content)
-            factory = self.w3.eth.contract(abi=abi_content, bytecode=bin_content)
-            arg = deploy_conf.get(cname)
-            if Web3.isAddress(arg):
-                deplpyed_contract_address = Web3.toChecksumAddress(arg)
-                self.addresses[cname] = deplpyed_contract_address
-                print("<{} | {}>  has been deployed, continue.".format(cname, deplpyed_contract_address))
+            self.save_file(os.path.join(self.abi_dir, cname + ".abi"), compileds[cname]["abi"])
+            self.save_file(os.path.join(self.bin_dir, cname + ".bin"), compileds[cname]["bin"])
+        # 更新ucwallet启动时使用的ABI索引
+        build_abi_index(os.path.join(CURR_DIR, "abi"))
+        print("Smart contracts are being deployed...\n")
+        for i, wave in enumerate(waves):
+            print("wave {}: {}".format(i + 1, ", ".join(wave)))
+            pending = []  # [(合约名, 交易hash), ...]
+            # 同一批的合约互不依赖, 依次分配nonce并全部发送后再一起等待回执
+            for cname in wave:
+                abi_content = compileds[cname]["abi"]
+                bin_content = compileds[cname]["bin"]
+                factory = self.w3.eth.contract(abi=abi_content, bytecode=bin_content)
+                arg = deploy_conf.get(cname)
+                if Web3.isAddress(arg):
+                    deplpyed_contract_address = Web3.toChecksumAddress(arg)
+                    self.addresses[cname] = deplpyed_contract_address
+                    print("<{} | {}>  has been deployed, continue.".format(cname, deplpyed_contract_address))
+                    continue
+                contract_address_args, constructor_args = arg
+                args = []
+                for name in contract_address_args:
+                    ca = self.addresses.get(name, None)
+                    if not ca:
+                        raise ValueError("Cannot find {} contract address".format(name))
+                    args.append(ca)
+                constructor_args = [Web3.toChecksumAddress(c) if Web3.isAddress(c) else c for c in constructor_args]
+                args.extend(constructor_args)
+                print("{} args: {}".format(cname, args))
+                step = "deploy:" + cname
+                key = self._step_key(bin_content, args)
+                state = self._reconcile(step, key)
+                if state and state[0] == DONE:
+                    self.addresses[cname] = state[1]["address"]
+                    print("<{} | {}>  has been deployed in last run, continue.".format(cname, state[1]["address"]))
+                    continue
+                if state:
+                    print("[{} | {}] was sent in last run.".format(cname, state[1]))
+                    pending.append((cname, state[1]))
+                    continue
+                func = factory.constructor(*args)
+                tx = self._build_transaction(func, gas_limit=self._gas_for(func, kwargs.get("gas_limit")),
+                                             gas_price=kwargs.get("gas_price"))
+                print("nonce: {}".format(tx["nonce"]))
+                tx_hash = self._sign_and_send_rawtransaction(transaction=tx, step=step, key=key)
+                print("[{} | {}] sent.".format(cname, tx_hash))
+                pending.append((cname, tx_hash))
+            if not pending:
                 continue
-            contract_address_args, constructor_args = arg
-            args = []
-            for name in contract_address_args:
-                ca = self.addresses.get(name, None)
-                if not ca:
-                    raise ValueError("Cannot find {} contract address".format(name))
-                args.append(ca)
-            constructor_args = [Web3.toChecksumAddress(c) if Web3.isAddress(c) else c for c in constructor_args]
-            args.extend(constructor_args)
-            print("{} args: {}".format(cname, args))
-            print("nonce: {}".format(self._nonce()))
-            func = factory.constructor(*args)
-            tx = self._build_transaction(func, **kwargs)
-            tx_hash = self._sign_and_send_rawtransaction(transaction=tx)
-            print("Waiting for [{} | {}] contract receipt...".format(cname, tx_hash))
-            receipt = self.w3.eth.waitForTransactionReceipt(tx_hash, timeout=600)
-            contractAddress = receipt["contractAddress"]
-            self.addresses[cname] = contractAddress
-            print("{} >>> txHash: {} | contractAddress: {}\n".format(cname, tx_hash, contractAddress))
-            time.sleep(0.5)  # 预防获取nonce(交易数)时,请求太快而不准确
+            print("Waiting for wave {} contract receipts...".format(i + 1))
+            receipts = self.receipts.wait_all([tx_hash for _, tx_hash in pending])
+            for (cname, tx_hash), receipt in zip(pending, receipts):
+                if receipt.get("status") == 0 or not receipt["contractAddress"]:
+                    self.journal.record("deploy:" + cname, status=FAILED)
+                    raise ValueError("Deploy {} fail, txHash: {}".format(cname, tx_hash))
+                contractAddress = receipt["contractAddress"]
+                self.journal.record("deploy:" + cname, status=DONE, address=contractAddress)
+                self.addresses[cname] = contractAddress
+                print("{} >>> txHash: {} | contractAddress: {}".format(cname, tx_hash, contractAddress))
+            print("")
+            # 每批部署完成后保存已有的合约地址
+            self.save_file(os.path.join(USER_DATA_DIR, "contractAddresses.json"), self.addresses)
         self.save_file(os.path.join(USER_DATA_DIR, "contractAddresses.json"), self.addresses)
         print("All contracts are deployed.")
-        self.activate()
+        self.activate(**kwargs)
+        # 只有中断的部署需要恢复, 完成后归档日志, 下次部署重新开始
+        self.journal.archive()
+
+    def plan(self, deploy_conf):
+        """ 根据配置中的依赖关系把合约分批, 同一批内的合约互不依赖, 可以同时部署
+        :param deploy_conf: 配置文件中的deploy部分
+        :return: [[合约名, ...], ...], 按部署顺序排列, 每批内保持sortkeys中的顺序
+        """
+        sortkeys = deploy_conf["sortkeys"]
+        depends = {}
+        for cname in sortkeys:
+            arg = deploy_conf.get(cname)
+            if arg is None:
+                raise ValueError("Cannot find {} deploy args".format(cname))
+            if Web3.isAddress(arg):
+                depends[cname] = set()
+            else:
+                # 不在sortkeys中的名字是 account_address 中的账户
+                depends[cname] = set(name for name in arg[0] if name in sortkeys)
+        waves = []
+        planned = set()
+        while len(planned) < len(sortkeys):
+            wave = [cname for cname in sortkeys if cname not in planned and depends[cname] <= planned]
+            if not wave:
+                raise ValueError("Circular dependency in {}".format(
+                    ", ".join(c for c in sortkeys if c not in planned)))
+            waves.append(wave)
+            planned.update(wave)
+        return waves
+
+    def _gas_for(self, func, gas_limit=None):
+        """ 估算交易需要的gas
+        同一批交易要一起打包, 每笔都使用区块gas上限的话一个块只能打包一笔
+        """
+        if gas_limit:
+            return gas_limit
+        return self.gas_estimator.estimate(func, self.account.address)
 
     def save_file(self, file, data):
         with open(file, "w") as f:
@@ -186,9 +312,12 @@ class Deploy(object):
                 json.dump(data, f)
 
     def activate(self, **kwargs):
-        """ 激活(添加白名单) """
+        """ 激活(添加白名单)
+        所有合约都已部署, 各个白名单调用之间没有依赖, 全部发送后一起等待回执
+        """
         print("\nContracts are being activate(add white list)...\n")
         activate_conf = self.conf["activate"]
+        pending = []  # [(步骤名, 交易hash), ...]
         for cname, func_list in activate_conf.items():
             contract_address = self.addresses[cname]
             with open(os.path.join(self.abi_dir, cname + ".abi")) as f:
@@ -198,7 +327,7 @@ class Deploy(object):
             for func_name, param_s in func_list.items():
                 # for one function
                 print("call {} , will do {} call ".format(func_name, len(param_s)))
-                for param_o in param_s:
+                for index, param_o in enumerate(param_s):
                     func = contract.functions.__getattribute__(func_name)
                     # add param
                     param_list = []
@@ -207,14 +336,31 @@ class Deploy(object):
                         if p is None:
                             p = param
                         param_list.append(p)
+                    step = "activate:{}.{}:{}".format(cname, func_name, index)
+                    key = self._step_key(contract_address, func_name, param_list)
+                    state = self._reconcile(step, key)
+                    if state and state[0] == DONE:
+                        print("call {}.{}({}) has been done in last run, continue.".format(cname, func_name, param_o))
+                        continue
+                    if state:
+                        pending.append((step, state[1]))
+                        continue
                     func = func(*param_list)
-                    tx = self._build_transaction(func, **kwargs)
-                    tx_hash = self._sign_and_send_rawtransaction(transaction=tx)
+                    tx = self._build_transaction(func, gas_limit=self._gas_for(func, kwargs.get("gas_limit")),
+                                                 gas_price=kwargs.get("gas_price"))
+                    tx_hash = self._sign_and_send_rawtransaction(transaction=tx, step=step, key=key)
                     print("input : {}".format(param_o))
                     print("input change to : {}".format(param_list))
-                    print("Waiting for  <{} | {}>  contract receipt...".format(cname, tx_hash))
-                    receipt = self.w3.eth.waitForTransactionReceipt(tx_hash)
-                    print("call {} successful. \nreceipt : {}\n".format(func_name, receipt))
+                    print("<{} | {}> sent.".format(cname, tx_hash))
+                    pending.append((step, tx_hash))
+        print("Waiting for white list receipts...")
+        receipts = self.receipts.wait_all([tx_hash for _, tx_hash in pending])
+        for (step, tx_hash), receipt in zip(pending, receipts):
+            if receipt.get("status") == 0:
+                self.journal.record(step, status=FAILED)
+                raise ValueError("Call {} fail, txHash: {}".format(step, tx_hash))
+            self.journal.record(step, status=DONE)
+            print("call {} successful. \nreceipt : {}\n".format(step, receipt))
 
         print("All white list are activated.")
 
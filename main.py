@@ -21,11 +21,7 @@ def function_test():
     # c = ucwallet.contract("AuthorModule", "Center_")
     # print(c)
     # print(c)
-    # while True:
-    #     s = ucwallet.get_last_receipt()
-    #     print(s)
-    #     if s is not None:
-    #         break
+    # print(ucwallet.wait_receipt())
     # ucwallet.exit()
     #
     # c = ucwallet.contract('AuthorModule', 'claimsByAddress', a)
@@ -60,29 +56,17 @@ def function_test():
 
     # 转账gas
     print(ucwallet.transfer_gas(b, 1))
-    while True:
-        s = ucwallet.get_last_receipt()
-        print(s)
-        if s is not None:
-            break
+    print(ucwallet.wait_receipt())
 
     # 授权
     print(ucwallet.contract("UshareToken", "approve", b, 1100))
-    while True:
-        s = ucwallet.get_last_receipt()
-        print(s)
-        if s is not None:
-            break
+    print(ucwallet.wait_receipt())
     # 授权余额查询
     print(ucwallet.contract("UshareToken", "allowance", a, b))
 
     # 多地址结算(需要先给此合约地址转账)
     print(ucwallet.transfer_tokens(b + "," + c, "10,10"))
-    while True:
-        s = ucwallet.get_last_receipt()
-        print(s)
-        if s is not None:
-            break
+    print(ucwallet.wait_receipt())
 
     print(ucwallet.exit())
 
@@ -7,7 +7,8 @@ import os
 from setuptools import setup, find_packages
 
 requires = [
-    'aniso8601>=3.0.2', 'ApiDoc>=1.4.0', 'appdirs>=1.4.3', 'asn1crypto>=0.24.0', 'attrdict>=2.0.0', 'backcall>=0.1.0',
+    'aiohttp>=3.4.4', 'aniso8601>=3.0.2', 'ApiDoc>=1.4.0', 'appdirs>=1.4.3', 'asn1crypto>=0.24.0', 'attrdict>=2.0.0',
+    'backcall>=0.1.0',
     'certifi>=2018.4.16', 'cffi>=1.11.5', 'chardet>=3.0.4', 'click>=6.7', 'colorama>=0.3.9', 'cryptography>=2.3.1',
     'cytoolz>=0.9.0.1', 'decorator>=4.3.0', 'eth-abi>=1.1.1', 'eth-account>=0.2.3', 'eth-hash>=0.1.4',
     'eth-keyfile>=0.5.1', 'eth-keys>=0.2.0b3', 'eth-rlp>=0.1.2', 'eth-typing>=1.1.0', 'eth-utils>=1.0.3',
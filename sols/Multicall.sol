@@ -0,0 +1,77 @@
+pragma solidity ^0.4.24;
+
+
+/**
+ * @title Multicall
+ * @dev Execute many read-only calls in one eth_call, so that all results
+ *      come from the same block.
+ */
+contract Multicall {
+
+    /**
+     * @dev Call several view functions and pack their return data.
+     * @param _targets address[] : contracts to call
+     * @param _data    bytes     : call data of every call, concatenated
+     * @param _sizes   uint256[] : byte length of each call data in _data
+     * @return blockNumber uint256   : the block the calls were executed in
+     * @return returnData  bytes     : return data of every call, concatenated
+     * @return returnSizes uint256[] : byte length of each return data in returnData
+     * @return success     bool[]    : whether each call succeeded
+     */
+    function aggregate(address[] _targets, bytes _data, uint256[] _sizes)
+        public
+        view
+        returns(uint256 blockNumber, bytes returnData, uint256[] returnSizes, bool[] success)
+    {
+        require(_targets.length == _sizes.length);
+        blockNumber = block.number;
+        returnSizes = new uint256[](_targets.length);
+        success = new bool[](_targets.length);
+        bytes[] memory results = new bytes[](_targets.length);
+        uint256 offset = 0;
+        uint256 total = 0;
+        for(uint256 i = 0; i < _targets.length; i++){
+            require(offset + _sizes[i] <= _data.length);
+            (success[i], results[i]) = _staticCall(_targets[i], _data, offset, _sizes[i]);
+            offset += _sizes[i];
+            returnSizes[i] = results[i].length;
+            total += results[i].length;
+        }
+        returnData = new bytes(total);
+        offset = 0;
+        for(i = 0; i < results.length; i++){
+            _copy(results[i], returnData, offset);
+            offset += results[i].length;
+        }
+    }
+
+    function getBlockNumber() view public returns(uint256){
+        return block.number;
+    }
+
+    function _staticCall(address _target, bytes memory _data, uint256 _offset, uint256 _size)
+        internal
+        view
+        returns(bool ok, bytes memory result)
+    {
+        assembly {
+            ok := staticcall(gas, _target, add(add(_data, 32), _offset), _size, 0, 0)
+            let size := returndatasize
+            result := mload(0x40)
+            mstore(result, size)
+            returndatacopy(add(result, 32), 0, size)
+            mstore(0x40, add(add(result, 32), and(add(size, 31), not(31))))
+        }
+    }
+
+    function _copy(bytes memory _src, bytes memory _dest, uint256 _offset) internal pure {
+        assembly {
+            let src := add(_src, 32)
+            let dest := add(add(_dest, 32), _offset)
+            let len := mload(_src)
+            for { let j := 0 } lt(j, len) { j := add(j, 32) } {
+                mstore(add(dest, j), mload(add(src, j)))
+            }
+        }
+    }
+}
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/20
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 合约编译缓存. 以源文件(含import的文件)内容和solc版本的hash为键,
+#            把编译得到的abi/bin保存在用户数据目录, 源文件没有变化时不再调用solc
+import hashlib
+import json
+import logging
+import os
+import re
+
+import dconfig
+
+log = logging.getLogger("compile_cache")
+
+IMPORT_RE = re.compile(r'^\s*import\s+(?:[^;]*?\s+from\s+)?["\']([^"\']+)["\']', re.MULTILINE)
+
+# 部署只需要abi和bin, 不让solc输出ast等其他内容
+OUTPUT_VALUES = ("abi", "bin")
+
+
+class CompileCache(object):
+    """ 合约编译缓存
+    缓存文件为 <cache_dir>/<合约名>-<hash>.json, 内容为 {"abi": ..., "bin": ...}.
+    hash 覆盖了合约源文件、它直接或间接import的所有文件以及solc版本, 任何一项变化都会重新编译.
+    """
+
+    def __init__(self, cache_dir=None, solc_version=None):
+        """
+        :param cache_dir: 缓存目录, 默认为用户数据目录下的 compile_cache
+        :param solc_version: solc版本字符串, 默认在第一次使用时通过 solc --version 获取
+        """
+        self.cache_dir = cache_dir if cache_dir else os.path.join(dconfig.prepare_user_data_dir(), "compile_cache")
+        self._solc_version = solc_version
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @property
+    def solc_version(self):
+        if self._solc_version is None:
+            from solc import get_solc_version_string
+            self._solc_version = get_solc_version_string().strip()
+        return self._solc_version
+
+    def _sources(self, source_file):
+        """源文件及其直接或间接import的所有文件, 按路径排序"""
+        seen = set()
+        stack = [os.path.normpath(source_file)]
+        while stack:
+            path = stack.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            with open(path, encoding="utf-8") as f:
+                content = f.read()
+            for name in IMPORT_RE.findall(content):
+                stack.append(os.path.normpath(os.path.join(os.path.dirname(path), name)))
+        return sorted(seen)
+
+    def source_hash(self, source_file):
+        """计算源文件的缓存键"""
+        base = os.path.dirname(os.path.normpath(source_file))
+        sha = hashlib.sha256(self.solc_version.encode("utf-8"))
+        for path in self._sources(source_file):
+            sha.update(os.path.relpath(path, base).encode("utf-8"))
+            with open(path, "rb") as f:
+                sha.update(hashlib.sha256(f.read()).digest())
+        return sha.hexdigest()
+
+    def _path(self, name, digest):
+        return os.path.join(self.cache_dir, "{}-{}.json".format(name, digest))
+
+    def get(self, name, digest):
+        """读取缓存, 没有缓存时返回None"""
+        path = self._path(name, digest)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            log.warning("compile cache {} is broken, ignore it".format(path))
+            return None
+
+    def put(self, name, digest, compiled):
+        """写入缓存, 同时删除该合约的旧缓存"""
+        prefix = name + "-"
+        for filename in os.listdir(self.cache_dir):
+            if filename.startswith(prefix) and filename[len(prefix):-5].isalnum():
+                os.remove(os.path.join(self.cache_dir, filename))
+        path = self._path(name, digest)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"abi": compiled["abi"], "bin": compiled["bin"]}, f)
+        os.replace(tmp, path)
+
+    def compile(self, sources):
+        """ 编译合约, 只有缓存中没有的合约才会调用solc, 并且所有需要编译的文件只调用一次solc
+        :param sources: {合约名: 源文件路径}
+        :return: {合约名: {"abi": ..., "bin": ...}}
+        """
+        results = {}
+        misses = {}
+        for name, source_file in sources.items():
+            digest = self.source_hash(source_file)
+            compiled = self.get(name, digest)
+            if compiled is None:
+                misses[name] = (source_file, digest)
+            else:
+                results[name] = compiled
+        if misses:
+            log.info("compile {}".format(", ".join(misses)))
+            from solc import compile_files
+            compileds = compile_files(sorted(set(f for f, _ in misses.values())), output_values=OUTPUT_VALUES)
+            for name, (source_file, digest) in misses.items():
+                compiled = None
+                for key, value in compileds.items():
+                    if key.split(":")[-1] == name:
+                        compiled = value
+                        break
+                if compiled is None:
+                    raise ValueError("No {} compilation results can be found".format(name))
+                self.put(name, digest, compiled)
+                results[name] = {"abi": compiled["abi"], "bin": compiled["bin"]}
+        return results
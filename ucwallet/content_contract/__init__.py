@@ -6,14 +6,16 @@
 # @Email   : httpservlet@yeah.net
 # @Des     :
 
+import inspect
 import json
 import os
+from collections import namedtuple
+from concurrent.futures import Future
 from pprint import pprint
 
 import web3
 from web3.middleware import geth_poa_middleware
 from web3 import Web3
-from web3 import HTTPProvider
 from web3.eth import Eth
 from web3.utils.events import get_event_data
 
@@ -21,24 +23,49 @@ import dconfig
 from eth_account import Account
 from functools import wraps
 
+from ucwallet.content_contract.events import EventRegistry
+from ucwallet.content_contract.fees import GasEstimator
+from ucwallet.content_contract.loader import ABIFiles, LazyContracts, load_abi_index
+from ucwallet.content_contract.nonce import get_nonce_manager, is_nonce_error, send_signed
+from ucwallet.content_contract.receipts import ReceiptTracker
+from ucwallet.content_contract.signer import ParallelSigner, SignedRaw
+from ucwallet.content_contract.rpc import batch_request, decode_call_result, to_block_param
+from ucwallet.content_contract.submitter import TransactionSubmitter
+from ucwallet.keystore import unlock_keystore
+from ucwallet.transport import PooledHTTPProvider, get_transport
+
 # ULORD_PROVIDER = dconfig.provider
 # USH_TOKEN_ADDRESS = dconfig.USH_TOKEN_ADDRESS
 # CENTER_PUBLISH_ADDRESS = dconfig.CENTER_PUBLISH_ADDRESS
 # BLOCK_GAS_LIMIT = dconfig.BLOCK_GAS_LIMIT
 GAS_PRICE = Web3.toWei('2', 'gwei')
+BATCH_SIZE = 100
+
+# 批量读取的单项结果, 成功时error为None
+BatchResult = namedtuple("BatchResult", ["value", "error"])
+
+
+def _require_account(self):
+    if not hasattr(self, "account") or not self.account:
+        raise ValueError(
+            "No account is set, use the set_account_* to set the account, "
+            "or use the create() to new an account."
+        )
 
 
 def check_account(func):
-    """检查在调用转账等操作前, 是否设置了account"""
+    """检查在调用转账等操作前, 是否设置了account. 协程函数在 await 时检查, 异常由 await 抛出"""
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            _require_account(args[0])
+            return await func(*args, **kwargs)
+
+        return async_wrapper
 
     @wraps(func)
     def wrapper(*args, **kwargs):
-        self = args[0]
-        if not hasattr(self, "account") or not self.account:
-            raise ValueError(
-                "No account is set, use the set_account_* to set the account, "
-                "or use the create() to new an account."
-            )
+        _require_account(args[0])
         return func(*args, **kwargs)
 
     return wrapper
@@ -49,20 +76,38 @@ class ContentContract(object):
 
     def __init__(self, keystore_file, keystore_pwd,
                  private_key=None,
-                 provider=dconfig.provider,
-                 gas_price=GAS_PRICE, ):
+                 provider=None,
+                 gas_price=GAS_PRICE,
+                 batch_size=BATCH_SIZE,
+                 gas_price_strategy=None, ):
         """ 合约方法调用类
         参数有可能会变化, 所以调用时最好指定参数名
         :param keystore_file: user account keystore file, which include user account private key
         :param keystore_pwd: user account keystore password
-        :param provider: Ulord side provider, such as http://xxxx:yyy, which is a RPC endpoint
+        :param provider: Ulord side provider, such as http://xxxx:yyy, which is a RPC endpoint.
+                         A list of endpoints is also accepted, default is dconfig.providers
+        :param batch_size: batch_call 中每个JSON-RPC批量请求包含的最大调用数
+        :param gas_price_strategy: gas价格策略 strategy(web3, transaction_params), 见 fees 模块,
+                                   默认使用固定的 gas_price
         """
-        self.web3 = Web3(HTTPProvider(provider))
+        # 同一组节点的所有实例共用一个连接池
+        self.transport = get_transport(provider)
+        self.web3 = Web3(PooledHTTPProvider(self.transport))
         self.gas_limit = dconfig.BLOCK_GAS_LIMIT
         self.gas_price = gas_price
+        self.gas_price_strategy = gas_price_strategy
+        # 交易的gas上限按估算值设置, gas_limit 只作为上限
+        self.gas_estimator = GasEstimator(cap=self.gas_limit)
+        self.batch_size = batch_size
 
         self.last_tx = None
         self.last_contract = None
+        self.transactions = {}  # 本对象发出的交易: tx_hash -> 合约名
+        self.submitter = None
+        self.indexer = None
+        self.signer = None
+        self.account_pool = None
+        self.view_cache = None
 
         if private_key:
             self.set_account_from_privatekey(private_key)
@@ -71,9 +116,11 @@ class ContentContract(object):
 
         # Rinkeby测试网络使用的是POA权威证明, 需要使用这个插件才能正常工作
         # http://web3py.readthedocs.io/en/stable/middleware.html#geth-style-proof-of-authority
-        if provider.startswith("https://rinkeby"):
+        if any(e.startswith("https://rinkeby") for e in self.transport.endpoints):
             self.web3.middleware_stack.inject(geth_poa_middleware, layer=0)
         self.eth = Eth(self.web3)
+        # 所有交易回执都通过同一个跟踪器批量查询
+        self.receipts = ReceiptTracker(self.web3, self.transport)
 
         # 装载所有合约
         self.reloading_contract()
@@ -102,30 +149,49 @@ class ContentContract(object):
         return address
 
     def _load_abi(self):
+        # 只读取ABI索引, ABI文件在第一次使用对应合约时读取
         abi_path = os.path.join(dconfig.CURR_DIR, 'abi')
-        file_list = os.listdir(abi_path)
-        self.abi_files = {}
-        for i in file_list:
-            if not i.endswith(".abi"):
-                continue
-            with open(os.path.join(abi_path, i)) as cp:
-                cp_abi = cp.read()
-                self.abi_files[i[:-4]] = json.loads(cp_abi)
-
-    def _nonce(self, value=0):
-        nonce = self.eth.getTransactionCount(self.account.address) + value
-        return nonce
-
-    def _build_transaction(self, func, gas_limit=None, gas_price=None, nonce=None):
-        """将合约方法的调用构建为离线交易对象"""
-        return func.buildTransaction({"nonce": nonce if nonce else self._nonce(),
-                                      "gas": gas_limit if gas_limit else self.gas_limit,
-                                      "gasPrice": gas_price if gas_price else self.gas_price, })
+        self.abi_index = load_abi_index(abi_path)
+        self.abi_files = ABIFiles(abi_path, self.abi_index)
+
+    @property
+    def nonce_manager(self):
+        """当前账户的本地nonce分配器"""
+        return get_nonce_manager(self.eth, self.account.address)
+
+    def _nonce(self):
+        """从本地分配器中取一个nonce, 不再每次都请求节点"""
+        return self.nonce_manager.next_nonce()
+
+    def _gas_price(self, transaction_params=None):
+        """按gas价格策略选择价格"""
+        if self.gas_price_strategy is None:
+            return self.gas_price
+        return self.gas_price_strategy(self.web3, transaction_params)
+
+    def _build_transaction(self, func, gas_limit=None, gas_price=None, nonce=None, value=None):
+        """ 将合约方法的调用构建为离线交易对象, 没有指定gas上限时使用(缓存的)估算值
+        nonce最后分配, 构建失败时归还, 不会在nonce序列中留下空洞
+        """
+        transaction = {"gas": gas_limit if gas_limit else self.gas_estimator.estimate(func, self.account.address),
+                       "gasPrice": gas_price if gas_price else self._gas_price(), }
+        if value:
+            transaction["value"] = value
+        if nonce is not None:
+            transaction["nonce"] = nonce
+            return func.buildTransaction(transaction)
+        transaction["nonce"] = self._nonce()
+        try:
+            return func.buildTransaction(transaction)
+        except Exception:
+            self.nonce_manager.release(transaction["nonce"])
+            raise
 
-    def _sign_and_send_rawtransaction(self, transaction):
-        signed = self.account.signTransaction(transaction)
-        tx_hash = Web3.toHex(self.eth.sendRawTransaction(signed.rawTransaction))
-        return tx_hash
+    def _sign_and_send_rawtransaction(self, transaction, account=None):
+        """签名并发送交易, account 默认为当前账户. nonce冲突的处理见 nonce.send_signed"""
+        account = account if account is not None else self.account
+        nonce_manager = get_nonce_manager(self.eth, account.address)
+        return send_signed(self.eth, nonce_manager, account.signTransaction, transaction)
 
     def create(self, wallet_password):
         """创建一个账户, 保存keyfile到对应目录的json文件中, 且返回私钥和地址"""
@@ -152,7 +218,8 @@ class ContentContract(object):
     def set_account_from_wallet(self, wallet_file, wallet_password):
         """从密钥文件加载accout对象"""
         wallet = self._load_wallet(wallet_file)
-        private_key = Account.decrypt(wallet, wallet_password)
+        # 同一进程中解密过的keystore在有效期内不再重复scrypt运算
+        private_key = unlock_keystore(wallet, wallet_password)
         setattr(self, "account", Account.privateKeyToAccount(private_key))
         self.main_address = self.web3.eth.account.privateKeyToAccount(private_key).address
         return dict(
@@ -166,13 +233,30 @@ class ContentContract(object):
         """
         return self.web3.eth.getTransactionReceipt(tx_hash)
 
+    def wait_for_receipt(self, tx_hash, timeout=None):
+        """ 阻塞等待交易被打包, 返回交易回执
+        :param timeout: 超时时间(秒), 超时抛出 concurrent.futures.TimeoutError
+        """
+        return self.receipts.wait(tx_hash, timeout=timeout)
+
     def read_last_receipt(self):
-        receipt = self.web3.eth.getTransactionReceipt(self.last_tx)
-        return self.contract[self.last_contract].events.myEvent().processReceipt(receipt)
+        """解码最后一笔交易回执中的事件"""
+        return self.read_receipt(self.last_contract, self.last_tx)
 
     def read_receipt(self, contract, tx_hash):
+        """ 解码交易回执中的事件
+        一笔交易可能触发多个合约的事件, 所有已加载合约的事件都会被解码
+        :param contract: 只返回该合约的事件, 为None时返回全部
+        :param tx_hash: 交易hash
+        :return: [EventRecord, ...], 交易未打包时返回None
+        """
         receipt = self.web3.eth.getTransactionReceipt(tx_hash)
-        return self.contract[contract].events.myEvent().processReceipt(receipt)
+        if receipt is None:
+            return None
+        records = self.events.decode_receipt(receipt)
+        if contract is not None:
+            records = [r for r in records if r.contract == contract]
+        return records
 
     def get_gas_balance(self, address):
         """ 获取侧链余额
@@ -191,17 +275,28 @@ class ContentContract(object):
         :param value: 转账金额(wei)
         :return: 交易hash
         """
-        print("nonce:", self._nonce())
         to_address = self.valid_address(to_address)
+        value = Web3.toWei(value, "ether")
+        if self.account_pool is not None:
+            return self.account_pool.transfer(to_address, value)
+        return self._transfer(to_address, value)
+
+    def _transfer(self, to_address, value, account=None):
+        """ 发送转账交易
+        :param value: 转账金额(wei)
+        :param account: 发送账户, 默认为当前账户
+        """
+        account = account if account is not None else self.account
         payload = {
             "to": to_address,
-            "value": Web3.toWei(value, "ether"),
-            "gas": self.gas_limit,
-            "gasPrice": self.gas_price,
-            "nonce": self._nonce(),
+            "value": value,
+            "gas": self.gas_estimator.estimate_transfer(self.web3, account.address, to_address, value),
+            "gasPrice": self._gas_price(),
+            "nonce": get_nonce_manager(self.eth, account.address).next_nonce(),
         }
-        res = self._sign_and_send_rawtransaction(payload)
-        self.last_tx = res
+        print("nonce:", payload["nonce"])
+        res = self._sign_and_send_rawtransaction(payload, account=account)
+        self._track(res)
         return res
 
     def transfer_tokens(self, addresses, qualitys):
@@ -209,16 +304,60 @@ class ContentContract(object):
         :param addresses: List, 结算的地址列表
         :param qualitys: List, 结算地址列表对应的金额
         """
-        for i, address in enumerate(addresses):
-            addresses[i] = self.valid_address(address)
-        for i, quality in enumerate(qualitys):
-            qualitys[i] = int(quality)
-        publish_tx = self.contract["MulTransfer"].functions.mulPayDiff(addresses, qualitys).buildTransaction({
-            "nonce": self._nonce(), "gas": self.gas_limit, "gasPrice": self.gas_price})
+        addresses = [self.valid_address(address) for address in addresses]
+        qualitys = [int(quality) for quality in qualitys]
+        publish_tx = self._build_transaction(self.contract["MulTransfer"].functions.mulPayDiff(addresses, qualitys))
         res = self._sign_and_send_rawtransaction(publish_tx)
-        self.last_tx = res
+        self._track(res, "MulTransfer")
         return res
 
+    @check_account
+    def sign_transactions(self, transactions, processes=None):
+        """ 用进程池并行签名一组交易
+        :param transactions: _build_transaction 构建的交易列表
+        :param processes: 工作进程数, 默认为CPU核数. 进程池在第一次调用时启动, 之后一直复用
+        :return: [SignedRaw(raw_transaction, hash, nonce), ...], 顺序与transactions一致
+        """
+        if self.signer is None or (processes and self.signer.processes != processes):
+            if self.signer is not None:
+                self.signer.close()
+            self.signer = ParallelSigner(self.account.privateKey, processes=processes)
+        return self.signer.sign(transactions)
+
+    def send_raw_transactions(self, raw_transactions, batch_size=None):
+        """ 用JSON-RPC批量请求广播已签名的交易
+        :param raw_transactions: 已签名交易的十六进制字符串, 或 sign_transactions 返回的 SignedRaw
+        :param batch_size: 每个批量请求包含的最大交易数, 默认使用 self.batch_size
+        :return: [BatchResult(交易hash, error), ...], 顺序与输入一致
+        """
+        raws = [r.raw_transaction if isinstance(r, SignedRaw) else r for r in raw_transactions]
+        batch_size = batch_size if batch_size else self.batch_size
+        results = []
+        for start in range(0, len(raws), batch_size):
+            chunk = raws[start:start + batch_size]
+            responses = batch_request(self.transport, [("eth_sendRawTransaction", [raw]) for raw in chunk])
+            for result, error in responses:
+                if error is None:
+                    self._track(result)
+                results.append(BatchResult(result, error))
+        if any(r.error is not None and is_nonce_error(r.error) for r in results):
+            # 部分交易的nonce与链上不一致, 之后的交易重新同步nonce
+            self.nonce_manager.resync()
+        return results
+
+    def bulk_transfer_tokens(self, recipients, report_path, **kwargs):
+        """ 大批量结算, 按gas上限分批调用 MulTransfer, 见 payouts.BulkPayout
+        :param recipients: 可迭代的 (地址, 金额wei), 或CSV文件路径(每行为 地址,金额)
+        :param report_path: 结算报告文件路径, 使用同一个报告再次调用时从中断处继续
+        :param kwargs: 传给 BulkPayout 的其他参数, 如 max_batch_gas, max_in_flight, fund
+        :return: 结算报告的汇总
+        """
+        from ucwallet.content_contract.payouts import BulkPayout
+        payout = BulkPayout(self, report_path, **kwargs)
+        if isinstance(recipients, str):
+            return payout.pay_csv(recipients)
+        return payout.pay(recipients)
+
     # zza write
 
     def reloading_contract(self):
@@ -235,27 +374,53 @@ class ContentContract(object):
         # 读取合约地址
         with open(os.path.join(dconfig.CURR_DIR, "contractAddresses.json")) as wf:
             self.contract_addrs = json.load(wf)
-        self.contract = {}
-        # 装载合约
-        for contract, addr in self.contract_addrs.items():
-            try:
-                self.contract[contract] = self.web3.eth.contract(address=self.valid_address(addr),
-                                                                 abi=self.abi_files[contract])
-            except:
-                continue
-            view_funcs = []
-            abi = {}
-            for func in self.abi_files[contract]:
-                if func['type'] == 'function':
-                    if func.get('constant') and func.get("stateMutability") == 'view':
-                        view_funcs.append(func["name"])
-                    abi[func['name']] = func
-            self.contract[contract].view_funcs = view_funcs
-            self.contract[contract].abi = abi
-
-    @check_account
-    def func_call(self, contract_name, function, param):
-        # 找到合约中对应的函数
+        # 合约对象在第一次访问时创建
+        self.contract = LazyContracts(self._create_contract, self.contract_addrs, self.abi_index)
+        self._events = None
+
+    def _create_contract(self, name, address):
+        """创建一个web3合约对象"""
+        contract = self.web3.eth.contract(address=self.valid_address(address), abi=self.abi_files[name])
+        abi = {}
+        for func in self.abi_files[name]:
+            if func['type'] == 'function':
+                abi[func['name']] = func
+        contract.view_funcs = self.abi_index["contracts"][name]["view"]
+        contract.abi = abi
+        return contract
+
+    @property
+    def events(self):
+        """所有已加载合约的事件解码器, 第一次使用时创建"""
+        if self._events is None:
+            events = EventRegistry()
+            for name in self.contract:
+                if Web3.isAddress(self.contract_addrs[name]):
+                    events.register(name, self.contract_addrs[name], self.abi_files[name])
+            self._events = events
+        return self._events
+
+    def open_indexer(self, db_path=None, **kwargs):
+        """ 打开本地事件索引(SQLite), 之后可以通过 self.indexer 在本地查询资源和订单
+        :param db_path: 数据库文件路径, 默认为用户数据目录下的 events.db
+        :param kwargs: 传给 EventIndexer 的其他参数, 如 chunk_size, reorg_depth, start_block
+        :return: EventIndexer, 调用它的 sync() 同步一次或 start() 持续跟踪
+        """
+        from ucwallet.content_contract.indexer import EventIndexer
+        if self.indexer is None:
+            self.indexer = EventIndexer(self, db_path=db_path, **kwargs)
+        return self.indexer
+
+    def _track(self, tx_hash, contract_name=None):
+        """记录发出的交易"""
+        self.transactions[tx_hash] = contract_name
+        self.last_tx = tx_hash
+        self.last_contract = contract_name
+
+    def _prepare_call(self, contract_name, function, param):
+        """ 找到合约中对应的函数并传入参数
+        :return: (合约函数对象, 是否为静态函数), 出错时返回错误信息
+        """
         contract = self.contract[contract_name]
         try:
             func = contract.functions.__getattribute__(function)
@@ -264,24 +429,190 @@ class ContentContract(object):
         # 准备参数
         inputs = contract.abi[function]['inputs']
         param = self.format_param(param, inputs)
+        if isinstance(param, str):
+            return param
         # 增加参数
         func = func() if len(param) == 0 else func(*param)
+        return func, function in contract.view_funcs
+
+    def enable_view_cache(self, **kwargs):
+        """ 开启只读函数缓存, 之后 func_call 调用只读函数时优先从缓存返回
+        :param kwargs: 传给 ViewCache 的参数, 如 maxsize, ttl, refresh_interval
+        """
+        from ucwallet.content_contract.viewcache import ViewCache
+        if self.view_cache is None:
+            self.view_cache = ViewCache(self, **kwargs)
+        return self.view_cache
+
+    def disable_view_cache(self):
+        """关闭只读函数缓存"""
+        self.view_cache = None
+
+    @check_account
+    def enable_account_pool(self, password=None, keystore_dir=None, accounts=None, **kwargs):
+        """ 开启账户池模式
+        开启后 func_call 和 transfer_gas 由池中负载最小的账户发送, 当前账户作为资金账户给余额不足的账户补充gas
+        :param password: keystore密码, 所有keystore相同时为字符串, 否则为 {地址: 密码}
+        :param keystore_dir: keystore目录, 默认为 resources/keystore
+        :param accounts: 直接指定池中的账户对象, 指定时不读取keystore
+        :param kwargs: 传给 AccountPool 的参数, 如 min_balance, refill_amount
+        """
+        from ucwallet.content_contract.accounts import AccountPool
+
+        if accounts is None:
+            keystore_dir = keystore_dir if keystore_dir else os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), 'resources', 'keystore')
+            self.account_pool = AccountPool.from_keystores(self, keystore_dir, password, **kwargs)
+        else:
+            self.account_pool = AccountPool(self, accounts, **kwargs)
+        return self.account_pool
+
+    def disable_account_pool(self):
+        """关闭账户池模式, 之后的交易都由当前账户发送"""
+        self.account_pool = None
+
+    def enable_pipeline(self, max_in_flight=16, timeout=None):
+        """ 开启流水线提交模式
+        开启后 func_call 不再等待上一笔交易确认, 而是把调用放入提交队列, 返回以回执为结果的 Future
+        :param max_in_flight: 同时在途的最大交易数
+        :param timeout: 等待单笔交易回执的超时时间(秒)
+        """
+        if self.submitter is None:
+            self.submitter = TransactionSubmitter(self, max_in_flight=max_in_flight, timeout=timeout)
+        return self.submitter
+
+    def disable_pipeline(self, wait=True):
+        """关闭流水线提交模式, wait为True时等待队列中的交易全部确认"""
+        if self.submitter is not None:
+            self.submitter.close(wait=wait)
+            self.submitter = None
+
+    @check_account
+    def submit_call(self, contract_name, function, param, **kwargs):
+        """ 将需要上链的合约调用放入提交队列
+        :return: concurrent.futures.Future, 结果为交易回执
+        """
+        prepared = self._prepare_call(contract_name, function, param)
+        if isinstance(prepared, str):
+            raise ValueError(prepared)
+        func, is_view = prepared
+        if is_view:
+            raise ValueError("{}.{} is a view function, use func_call instead".format(contract_name, function))
+        return self.enable_pipeline().submit(func, contract_name, **kwargs)
+
+    @check_account
+    def func_call(self, contract_name, function, param):
+        prepared = self._prepare_call(contract_name, function, param)
+        if isinstance(prepared, str):
+            return prepared
+        func, is_view = prepared
         # 静态函数
-        if function in self.contract[contract_name].view_funcs:
+        if is_view:
+            if self.view_cache is not None:
+                return self.view_cache.call(contract_name, func)
             return func.call()
+        # 流水线模式: 直接入队, 不等待上一笔交易
+        if self.submitter is not None:
+            return self.submitter.submit(func, contract_name)
+        # 账户池模式: 由负载最小的账户发送
+        if self.account_pool is not None:
+            return self.account_pool.send(func, contract_name)
         print(func.call())
         # 需要上链的函数
         if self.last_tx is None or self.get_for_receipt(self.last_tx) is not None:
-            self.last_contract = contract_name
             tx = self._build_transaction(func)
             res = self._sign_and_send_rawtransaction(transaction=tx)
-            self.last_tx = res
+            self._track(res, contract_name)
             print("Call successful , transaction hash:")
             return res
         else:
             print("The last transaction was not confirmed , please call get_for_receipt to view the last transaction")
             return self.last_tx
 
+    def _encode_call(self, contract_name, function, args):
+        """ 编码一个合约调用
+        :return: (函数ABI, 合约地址, 调用数据)
+        """
+        contract = self.contract[contract_name]
+        func = contract.functions.__getattribute__(function)(*args)
+        return contract.abi[function], contract.address, func._encode_transaction_data()
+
+    def batch_call(self, calls, batch_size=None, block_identifier="latest"):
+        """ 批量调用静态函数, 多个 eth_call 合并为JSON-RPC批量请求发送
+        :param calls: [(合约名, 函数名, 参数列表), ...]
+        :param batch_size: 每个批量请求包含的最大调用数, 默认使用 self.batch_size
+        :param block_identifier: 在哪个块上执行, 默认 latest
+        :return: 与calls顺序一致的 BatchResult(value, error) 列表
+        """
+        batch_size = batch_size if batch_size else self.batch_size
+        block = to_block_param(block_identifier)
+        results = [None] * len(calls)
+        prepared = []  # (下标, 函数ABI, rpc参数)
+        for i, (contract_name, function, args) in enumerate(calls):
+            try:
+                fn_abi, address, data = self._encode_call(contract_name, function, args)
+            except Exception as e:
+                results[i] = BatchResult(None, e)
+                continue
+            prepared.append((i, fn_abi, [{"to": address, "data": data}, block]))
+
+        for start in range(0, len(prepared), batch_size):
+            chunk = prepared[start:start + batch_size]
+            responses = batch_request(self.transport, [("eth_call", params) for _, _, params in chunk])
+            for (i, fn_abi, _), (result, error) in zip(chunk, responses):
+                if error is not None:
+                    results[i] = BatchResult(None, error)
+                    continue
+                try:
+                    results[i] = BatchResult(decode_call_result(fn_abi, result), None)
+                except Exception as e:
+                    results[i] = BatchResult(None, e)
+        return results
+
+    def multicall(self, calls, block_identifier=None, batch_size=None):
+        """ 通过 Multicall 合约在一次 eth_call 中执行多个静态函数, 所有结果来自同一个块
+        :param calls: [(合约名, 函数名, 参数列表), ...]
+        :param block_identifier: 在哪个块上执行, 默认为当前最新块号. 分多次请求时都固定在这个块上
+        :param batch_size: 每次 eth_call 包含的最大调用数, 默认全部放在一次调用中
+        :return: (块号, 与calls顺序一致的 BatchResult(value, error) 列表)
+        """
+        if "Multicall" not in self.contract:
+            raise ValueError("Multicall contract is not deployed, use the deploy_contract command to deploy it first.")
+        if block_identifier is None:
+            block_identifier = self.web3.eth.blockNumber
+        aggregate = self.contract["Multicall"].functions.aggregate
+        results = [None] * len(calls)
+        prepared = []  # (下标, 函数ABI, 合约地址, 调用数据)
+        for i, (contract_name, function, args) in enumerate(calls):
+            try:
+                fn_abi, address, data = self._encode_call(contract_name, function, args)
+            except Exception as e:
+                results[i] = BatchResult(None, e)
+                continue
+            prepared.append((i, fn_abi, address, Web3.toBytes(hexstr=data)))
+
+        batch_size = batch_size if batch_size else max(len(prepared), 1)
+        block_number = block_identifier
+        for start in range(0, len(prepared), batch_size):
+            chunk = prepared[start:start + batch_size]
+            targets = [address for _, _, address, _ in chunk]
+            sizes = [len(data) for _, _, _, data in chunk]
+            packed = b"".join(data for _, _, _, data in chunk)
+            block_number, return_data, return_sizes, success = aggregate(targets, packed, sizes).call(
+                block_identifier=block_identifier)
+            offset = 0
+            for (i, fn_abi, _, _), size, ok in zip(chunk, return_sizes, success):
+                output = return_data[offset:offset + size]
+                offset += size
+                if not ok:
+                    results[i] = BatchResult(None, ValueError("call reverted"))
+                    continue
+                try:
+                    results[i] = BatchResult(decode_call_result(fn_abi, output), None)
+                except Exception as e:
+                    results[i] = BatchResult(None, e)
+        return block_number, results
+
     def format_param(self, param, inputs):
         if isinstance(param, list):
             res = param
@@ -318,12 +649,13 @@ class ContentContract(object):
                 print("{} no {} , pass".format(name, func_name))
                 continue
             print(name, func_name, address)
-            print(self.func_call(name, func_name, [address]))
-            while True:
-                a = self.get_last_call_info()
-                if a:
-                    print(a)
-                    break
+            if self.submitter is None and self.account_pool is None and self.last_tx is not None:
+                # 上一笔交易未确认时 func_call 不会发送新交易
+                self.wait_for_receipt(self.last_tx)
+            res = self.func_call(name, func_name, [address])
+            print(res)
+            # 流水线模式返回Future, 其他模式返回这笔交易的hash
+            print(res.result() if isinstance(res, Future) else self.wait_for_receipt(res))
         return True
 
 
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/28
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 账户池. 一个账户的nonce只能顺序递增, 把交易分散到多个账户上并行发送,
+#            每个账户有自己的nonce分配器, 余额不足时由资金账户自动补充gas
+import logging
+import os
+import threading
+
+from eth_account import Account
+
+from ucwallet.content_contract.nonce import get_nonce_manager
+from ucwallet.keystore import load_keystore, unlock_keystore
+
+log = logging.getLogger("accounts")
+
+
+class PoolMember(object):
+    """池中的一个账户"""
+
+    def __init__(self, account, nonce_manager, balance):
+        self.account = account
+        self.address = account.address
+        self.nonce_manager = nonce_manager
+        self.balance = balance  # 本地估计的余额(wei), 每次发送时扣除gas费用和转账金额
+        self.in_flight = 0  # 已发送未确认的交易数
+        self.sent = 0
+        self.refill_tx = None  # 正在进行的补充gas交易
+
+
+class AccountPool(object):
+    """ 账户池
+    每笔交易路由到在途交易最少的账户. 账户的余额在本地按gas上限和gas价格估算扣除,
+    低于 min_balance 时资金账户(ContentContract 的当前账户)转入 refill_amount, 补充期间优先使用其他账户.
+    """
+
+    def __init__(self, content_contract, accounts, min_balance=None, refill_amount=None, timeout=None):
+        """
+        :param content_contract: ContentContract 对象, 当前账户为资金账户
+        :param accounts: 池中的账户对象列表, 资金账户不会被加入池中
+        :param min_balance: 触发补充gas的余额下限(wei), 默认不自动补充
+        :param refill_amount: 每次补充的金额(wei), 默认为 min_balance 的两倍
+        :param timeout: 等待交易回执的超时时间(秒)
+        """
+        self.content_contract = content_contract
+        self.min_balance = min_balance
+        self.refill_amount = refill_amount if refill_amount else (min_balance * 2 if min_balance else None)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pending = {}  # tx_hash -> 发送账户地址
+        eth = content_contract.eth
+        treasury = content_contract.account.address
+        self.members = {}
+        for account in accounts:
+            if account.address == treasury or account.address in self.members:
+                continue
+            self.members[account.address] = PoolMember(account, get_nonce_manager(eth, account.address),
+                                                       eth.getBalance(account.address))
+        if not self.members:
+            raise ValueError("The account pool needs at least one account other than the treasury account.")
+
+    @classmethod
+    def from_keystores(cls, content_contract, keystore_dir, password, **kwargs):
+        """ 从目录中的keystore文件加载账户, 无法解密的文件会被跳过
+        :param password: 所有keystore相同时为字符串, 否则为 {地址: 密码}
+        """
+        accounts = []
+        for filename in sorted(os.listdir(keystore_dir)):
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(keystore_dir, filename)
+            try:
+                wallet = load_keystore(path)
+                if isinstance(password, dict):
+                    wallet_password = password.get(content_contract.valid_address(wallet["address"]))
+                    if wallet_password is None:
+                        continue
+                else:
+                    wallet_password = password
+                private_key = unlock_keystore(wallet, wallet_password)
+            except Exception as e:
+                log.warning("skip keystore {}: {}".format(filename, e))
+                continue
+            accounts.append(Account.privateKeyToAccount(private_key))
+        return cls(content_contract, accounts, **kwargs)
+
+    def _acquire(self):
+        """选出在途交易最少的账户, 正在补充gas的账户排在最后"""
+        with self._lock:
+            member = min(self.members.values(), key=lambda m: (m.refill_tx is not None, m.in_flight, m.sent))
+            member.in_flight += 1
+            member.sent += 1
+            return member
+
+    def _release(self, member):
+        with self._lock:
+            member.in_flight -= 1
+            self._idle.notify_all()
+
+    def _charge(self, member, transaction):
+        """按gas上限扣除本地估计的余额, 低于下限时补充gas"""
+        cost = transaction["gas"] * transaction["gasPrice"] + transaction.get("value", 0)
+        with self._lock:
+            member.balance -= cost
+            if self.min_balance is None or member.balance >= self.min_balance or member.refill_tx is not None:
+                return
+            member.refill_tx = "pending"
+        self._refill(member)
+
+    def _refill(self, member):
+        cc = self.content_contract
+        try:
+            tx_hash = cc._transfer(member.address, self.refill_amount)
+        except Exception as e:
+            log.error("refill {} fail: {}".format(member.address, e))
+            with self._lock:
+                member.refill_tx = None
+            return
+        log.info("refill {} with {} wei, txHash: {}".format(member.address, self.refill_amount, tx_hash))
+        with self._lock:
+            member.refill_tx = tx_hash
+        cc.receipts.watch(tx_hash, callback=lambda h, receipt: self._refilled(member), timeout=self.timeout)
+
+    def _refilled(self, member):
+        # 以链上余额为准, 纠正本地估计的误差
+        try:
+            balance = self.content_contract.eth.getBalance(member.address)
+        except Exception as e:
+            log.warning("get balance of {} fail: {}".format(member.address, e))
+            balance = None
+        with self._lock:
+            if balance is not None:
+                member.balance = balance
+            member.refill_tx = None
+
+    def _dispatch(self, send, contract_name=None):
+        """ 用选出的账户发送交易
+        :param send: send(member) -> (交易hash, 交易)
+        """
+        member = self._acquire()
+        try:
+            tx_hash, transaction = send(member)
+        except Exception:
+            self._release(member)
+            raise
+        with self._lock:
+            self._pending[tx_hash] = member.address
+        self.content_contract._track(tx_hash, contract_name)
+        self.content_contract.receipts.watch(tx_hash, callback=self._resolve, timeout=self.timeout)
+        self._charge(member, transaction)
+        return tx_hash
+
+    def _resolve(self, tx_hash, receipt):
+        with self._lock:
+            member = self.members[self._pending.pop(tx_hash)]
+        self._release(member)
+
+    def send(self, func, contract_name=None, **kwargs):
+        """ 发送一个合约调用
+        :param func: 已经传入参数的合约函数对象
+        :param kwargs: 传给 _build_transaction 的参数, 如 gas_price
+        :return: 交易hash
+        """
+        cc = self.content_contract
+        gas_limit = kwargs.pop("gas_limit", None)
+
+        gas_price = kwargs.pop("gas_price", None)
+
+        def send(member):
+            # 先估算gas和价格再分配nonce, 估算失败(如调用回滚)不会占用账户的nonce
+            gas = gas_limit if gas_limit else cc.gas_estimator.estimate(func, member.address)
+            price = gas_price if gas_price else cc._gas_price()
+            nonce = member.nonce_manager.next_nonce()
+            try:
+                transaction = cc._build_transaction(func, nonce=nonce, gas_limit=gas, gas_price=price, **kwargs)
+            except Exception:
+                member.nonce_manager.release(nonce)
+                raise
+            return cc._sign_and_send_rawtransaction(transaction, account=member.account), transaction
+
+        return self._dispatch(send, contract_name)
+
+    def transfer(self, to_address, value):
+        """ 转账
+        :param value: 转账金额(wei)
+        :return: 交易hash
+        """
+        cc = self.content_contract
+
+        def send(member):
+            transaction = {
+                "to": to_address,
+                "value": value,
+                "gas": cc.gas_estimator.estimate_transfer(cc.web3, member.address, to_address, value),
+                "gasPrice": cc._gas_price(),
+                "nonce": member.nonce_manager.next_nonce(),
+            }
+            return cc._sign_and_send_rawtransaction(transaction, account=member.account), transaction
+
+        return self._dispatch(send)
+
+    def wait(self):
+        """等待池中所有交易确认"""
+        with self._lock:
+            while self._pending:
+                self._idle.wait()
+
+    def status(self):
+        """每个账户的在途交易数、已发送交易数和估计余额"""
+        with self._lock:
+            return {m.address: {"in_flight": m.in_flight, "sent": m.sent, "balance": m.balance,
+                                "refilling": m.refill_tx is not None}
+                    for m in self.members.values()}
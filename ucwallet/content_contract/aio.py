@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/10
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : asyncio版本的合约调用类
+
+import asyncio
+import itertools
+import logging
+import time
+
+import aiohttp
+from web3 import Web3
+
+from ucwallet.content_contract import ContentContract, GAS_PRICE, BATCH_SIZE, check_account
+from ucwallet.content_contract.fees import estimate_key
+from ucwallet.content_contract.nonce import is_known_error, is_nonce_error, is_nonce_too_low
+from ucwallet.content_contract.receipts import format_receipt
+from ucwallet.content_contract.rpc import RPCError, decode_call_result, to_block_param
+
+log = logging.getLogger("aio")
+
+POOL_SIZE = 100
+
+
+class AsyncHTTPProvider(object):
+    """ 基于aiohttp的JSON-RPC客户端
+    所有请求共用一个带连接池的 ClientSession, 连接保持keep-alive. 配置了多个节点时轮流使用.
+    """
+
+    def __init__(self, endpoints, pool_size=POOL_SIZE, timeout=10, keepalive_timeout=30):
+        """
+        :param endpoints: 节点RPC地址或地址列表
+        :param pool_size: 连接池大小, 即同时打开的最大连接数
+        :param timeout: 单个请求超时时间(秒)
+        :param keepalive_timeout: 空闲连接保持时间(秒)
+        """
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+        self.endpoints = list(endpoints)
+        self._cycle = itertools.cycle(self.endpoints)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+        self._ids = itertools.count()
+
+    @property
+    def session(self):
+        # ClientSession 必须在事件循环中创建, 所以在第一次请求时才创建
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _post(self, payload):
+        async with self.session.post(next(self._cycle), json=payload) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def make_request(self, method, params):
+        """发送一个请求, 返回result, 节点返回错误时抛出 RPCError"""
+        body = await self._post({"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params})
+        if body.get("error") is not None:
+            raise RPCError(body["error"])
+        return body.get("result")
+
+    async def make_batch(self, calls):
+        """ 发送一个批量请求
+        :param calls: [(method, params), ...]
+        :return: 与calls顺序一致的 (result, error) 列表
+        """
+        if not calls:
+            return []
+        payload = [{"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": params}
+                   for method, params in calls]
+        body = await self._post(payload)
+        if isinstance(body, dict):
+            raise RPCError(body.get("error", body))
+        by_id = {item.get("id"): item for item in body}
+        results = []
+        for request in payload:
+            item = by_id.get(request["id"])
+            if item is None:
+                results.append((None, RPCError("No response for {}".format(request["method"]))))
+            elif item.get("error") is not None:
+                results.append((None, RPCError(item["error"])))
+            else:
+                results.append((item.get("result"), None))
+        return results
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncReceiptTracker(object):
+    """ ReceiptTracker 的asyncio版本
+    一个后台任务在每个新块上用一个批量请求查询所有等待中的交易回执
+    """
+
+    def __init__(self, provider, poll_interval=1, timeout=600):
+        self.provider = provider
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.pending = {}  # tx_hash -> (future, deadline)
+        self._fresh = False
+        self._last_block = None
+        self._task = None
+
+    async def wait(self, tx_hash, timeout=None):
+        """等待交易回执, 超时抛出 asyncio.TimeoutError"""
+        timeout = self.timeout if timeout is None else timeout
+        if tx_hash in self.pending:
+            future = self.pending[tx_hash][0]
+        else:
+            future = asyncio.get_event_loop().create_future()
+            self.pending[tx_hash] = (future, time.time() + timeout)
+            self._fresh = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        return await future
+
+    async def _run(self):
+        while self.pending:
+            try:
+                await self._poll()
+            except Exception as e:
+                log.warning("poll receipts fail: {}".format(e))
+            self._expire()
+            await asyncio.sleep(self.poll_interval)
+
+    async def _poll(self):
+        block = int(await self.provider.make_request("eth_blockNumber", []), 16)
+        if block == self._last_block and not self._fresh:
+            return
+        self._last_block = block
+        self._fresh = False
+        hashes = list(self.pending.keys())
+        results = await self.provider.make_batch([("eth_getTransactionReceipt", [h]) for h in hashes])
+        for tx_hash, (result, error) in zip(hashes, results):
+            if error is not None:
+                log.warning("get receipt of {} fail: {}".format(tx_hash, error))
+            elif result is not None:
+                future, _ = self.pending.pop(tx_hash)
+                if not future.done():
+                    future.set_result(format_receipt(result))
+
+    def _expire(self):
+        now = time.time()
+        for tx_hash in [h for h, (_, deadline) in self.pending.items() if deadline < now]:
+            future, _ = self.pending.pop(tx_hash)
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError(
+                    "Transaction {} is not in the chain after timeout".format(tx_hash)))
+
+
+class AsyncContentContract(ContentContract):
+    """ ContentContract 的asyncio版本
+    func_call、get_gas_balance、transfer_gas、transfer_tokens、get_for_receipt、wait_for_receipt、
+    get_last_call_info、transfer_ownership 是协程, 通过带连接池的 AsyncHTTPProvider 访问节点.
+    交易在本地构建和签名, nonce在本地分配(与同步方法共用同一个分配器).
+    func_call 的只读调用同样使用 enable_view_cache 开启的缓存.
+    协程版本的内部方法以 _async 结尾, 不覆盖 ContentContract 的同名同步方法, 所以继承的其他方法
+    (batch_call、multicall、bulk_transfer_tokens、账户池、流水线、批量发布等)仍然通过同步连接正常工作.
+    """
+
+    def __init__(self, keystore_file, keystore_pwd,
+                 private_key=None,
+                 provider=None,
+                 gas_price=GAS_PRICE,
+                 batch_size=BATCH_SIZE,
+                 gas_price_strategy=None,
+                 pool_size=POOL_SIZE,
+                 timeout=10, ):
+        """
+        :param pool_size: 连接池大小
+        :param timeout: 单个请求超时时间(秒)
+        其他参数与 ContentContract 相同
+        """
+        super(AsyncContentContract, self).__init__(keystore_file, keystore_pwd,
+                                                   private_key=private_key,
+                                                   provider=provider,
+                                                   gas_price=gas_price,
+                                                   batch_size=batch_size,
+                                                   gas_price_strategy=gas_price_strategy, )
+        self.async_provider = AsyncHTTPProvider(self.transport.endpoints, pool_size=pool_size, timeout=timeout)
+        self.async_receipts = AsyncReceiptTracker(self.async_provider)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        """关闭连接池"""
+        await self.async_provider.close()
+
+    async def _pending_count(self):
+        count = await self.async_provider.make_request("eth_getTransactionCount",
+                                                       [self.account.address, "pending"])
+        return int(count, 16)
+
+    async def _nonce_async(self):
+        manager = self.nonce_manager
+        if not manager.seeded:
+            manager.seed(await self._pending_count())
+        return manager.next_nonce()
+
+    async def _gas_price_async(self, transaction_params=None):
+        if self.gas_price_strategy is None:
+            return self.gas_price
+        # 策略使用同步的web3接口, 在线程池中执行
+        return await asyncio.get_event_loop().run_in_executor(None, self.gas_price_strategy,
+                                                               self.web3, transaction_params)
+
+    async def _estimate_gas(self, key, params):
+        """估算gas上限, 同一个键只估算一次, 估算失败时使用gas上限"""
+        gas = self.gas_estimator.lookup(key)
+        if gas is not None:
+            return gas
+        try:
+            estimate = await self.async_provider.make_request("eth_estimateGas", [params])
+        except Exception as e:
+            log.warning("estimate gas fail: {}, use gas limit {}".format(e, self.gas_limit))
+            return self.gas_limit
+        return self.gas_estimator.update(key, int(estimate, 16))
+
+    async def _build_transaction_async(self, func, gas_limit=None, gas_price=None, nonce=None):
+        """将合约方法的调用构建为离线交易对象, 没有缓存的gas估算值时查询一次节点"""
+        if not gas_limit:
+            gas_limit = await self._estimate_gas(estimate_key(func, self.account.address), {
+                "from": self.account.address,
+                "to": func.address,
+                "data": func._encode_transaction_data(),
+            })
+        transaction = {"gas": gas_limit,
+                       "gasPrice": gas_price if gas_price else await self._gas_price_async(), }
+        if nonce is not None:
+            transaction["nonce"] = nonce
+            return func.buildTransaction(transaction)
+        # nonce最后分配, 构建失败时归还
+        transaction["nonce"] = await self._nonce_async()
+        try:
+            return func.buildTransaction(transaction)
+        except Exception:
+            self.nonce_manager.release(transaction["nonce"])
+            raise
+
+    async def _sign_and_send_rawtransaction_async(self, transaction):
+        """签名并发送交易, nonce冲突的处理与 nonce.send_signed 相同"""
+        manager = self.nonce_manager
+        for attempt in range(2):
+            signed = self.account.signTransaction(transaction)
+            tx_hash = Web3.toHex(signed.hash)
+            try:
+                await self.async_provider.make_request("eth_sendRawTransaction", [Web3.toHex(signed.rawTransaction)])
+                return tx_hash
+            except Exception as e:
+                error = e
+            if is_known_error(error):
+                # 同一笔交易已经在交易池中, 不能再发送一次
+                manager.resync(await self._pending_count())
+                return tx_hash
+            if is_nonce_error(error):
+                manager.resync(await self._pending_count())
+                if await self.async_provider.make_request("eth_getTransactionByHash", [tx_hash]) is not None:
+                    return tx_hash
+                if attempt or not is_nonce_too_low(error):
+                    raise error
+                transaction = dict(transaction, nonce=manager.next_nonce())
+                continue
+            try:
+                accepted = await self.async_provider.make_request("eth_getTransactionByHash", [tx_hash]) is not None
+            except Exception as e:
+                log.warning("check transaction {} fail: {}, keep nonce {}".format(tx_hash, e, transaction["nonce"]))
+                raise error
+            if accepted:
+                return tx_hash
+            manager.release(transaction["nonce"])
+            raise error
+
+    async def get_for_receipt(self, tx_hash):
+        """获取交易回执(只有已打包的交易才有数据,否则返回None)"""
+        receipt = await self.async_provider.make_request("eth_getTransactionReceipt", [tx_hash])
+        return format_receipt(receipt) if receipt is not None else None
+
+    async def wait_for_receipt(self, tx_hash, timeout=None):
+        """等待交易被打包, 返回交易回执, 超时抛出 asyncio.TimeoutError"""
+        return await self.async_receipts.wait(tx_hash, timeout=timeout)
+
+    async def get_gas_balance(self, address=None):
+        """获取侧链余额"""
+        if address is None:
+            address = self.main_address
+        address = self.valid_address(address)
+        balance = await self.async_provider.make_request("eth_getBalance", [address, "latest"])
+        return Web3.fromWei(int(balance, 16), 'ether')
+
+    @check_account
+    async def transfer_gas(self, to_address, value):
+        """ gas就是侧链的币
+        :param to_address: 接收地址
+        :param value: 转账金额(ether)
+        :return: 交易hash
+        """
+        to_address = self.valid_address(to_address)
+        value = Web3.toWei(value, "ether")
+        payload = {
+            "to": to_address,
+            "value": value,
+            "gas": await self._estimate_gas(("transfer", to_address), {
+                "from": self.account.address, "to": to_address, "value": Web3.toHex(value)}),
+            "gasPrice": await self._gas_price_async(),
+            "nonce": await self._nonce_async(),
+        }
+        res = await self._sign_and_send_rawtransaction_async(payload)
+        self._track(res)
+        return res
+
+    async def transfer_tokens(self, addresses, qualitys):
+        """ 多地址结算
+        :param addresses: List, 结算的地址列表
+        :param qualitys: List, 结算地址列表对应的金额
+        """
+        addresses = [self.valid_address(address) for address in addresses]
+        qualitys = [int(quality) for quality in qualitys]
+        tx = await self._build_transaction_async(self.contract["MulTransfer"].functions.mulPayDiff(addresses, qualitys))
+        res = await self._sign_and_send_rawtransaction_async(tx)
+        self._track(res, "MulTransfer")
+        return res
+
+    async def get_last_call_info(self):
+        if self.last_tx is None:
+            return None
+        return await self.get_for_receipt(self.last_tx)
+
+    async def transfer_ownership(self, address):
+        func_name = "transferOwnership"
+        for name, con in self.contract.items():
+            try:
+                con.functions.__getattribute__(func_name)
+            except AttributeError:
+                print("{} no {} , pass".format(name, func_name))
+                continue
+            print(name, func_name, address)
+            res = await self.func_call(name, func_name, [address])
+            print(res)
+            print(await self.wait_for_receipt(res))
+        return True
+
+    @check_account
+    async def func_call(self, contract_name, function, param, block_identifier="latest"):
+        """ 调用合约函数
+        静态函数返回调用结果; 需要上链的函数直接发送并返回交易hash, 不等待上一笔交易确认,
+        需要回执时使用 wait_for_receipt
+        """
+        prepared = self._prepare_call(contract_name, function, param)
+        if isinstance(prepared, str):
+            return prepared
+        func, is_view = prepared
+        if is_view:
+            cache = self.view_cache
+            if cache is not None:
+                key = cache.key(contract_name, func, block_identifier)
+                if block_identifier == "latest" and cache.needs_refresh():
+                    # 检查新块事件使用同步的web3接口, 在线程池中执行
+                    await asyncio.get_event_loop().run_in_executor(None, cache.refresh)
+                found, value = cache.lookup(key, refresh=False)
+                if found:
+                    return value
+            call = {"to": func.address, "data": func._encode_transaction_data()}
+            result = await self.async_provider.make_request("eth_call", [call, to_block_param(block_identifier)])
+            value = decode_call_result(self.contract[contract_name].abi[function], result)
+            if cache is not None:
+                cache.put(key, value)
+            return value
+        tx = await self._build_transaction_async(func)
+        res = await self._sign_and_send_rawtransaction_async(transaction=tx)
+        self._track(res, contract_name)
+        return res
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/19
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 预编译的合约事件解码器
+
+from collections import namedtuple
+
+from eth_abi import decode_abi
+from eth_utils import event_abi_to_log_topic
+from hexbytes import HexBytes
+from web3 import Web3
+from web3.utils.abi import map_abi_data, normalize_event_input_types
+from web3.utils.events import get_event_abi_types_for_decoding
+from web3.utils.normalizers import BASE_RETURN_NORMALIZERS
+
+# 解码后的事件
+EventRecord = namedtuple("EventRecord", [
+    "contract", "event", "args", "address", "block_number", "log_index",
+    "transaction_hash", "transaction_index", "block_hash",
+])
+
+
+class EventDecoder(object):
+    """单个事件的解码器, 参数类型和名称在创建时计算好, 解码时不再查找ABI"""
+
+    def __init__(self, contract_name, event_abi):
+        self.contract = contract_name
+        self.name = event_abi["name"]
+        self.abi = event_abi
+        self.topic = HexBytes(event_abi_to_log_topic(event_abi))
+        inputs = list(normalize_event_input_types(event_abi.get("inputs", [])))
+        indexed = [i for i in inputs if i.get("indexed")]
+        data = [i for i in inputs if not i.get("indexed")]
+        # 动态类型的indexed参数在topic中只保存了hash, 按bytes32解码
+        self.topic_types = list(get_event_abi_types_for_decoding(indexed))
+        self.topic_names = [i["name"] for i in indexed]
+        self.data_types = [i["type"] for i in data]
+        self.data_names = [i["name"] for i in data]
+
+    def decode(self, log_entry):
+        """解码一条日志, 返回 EventRecord"""
+        topics = log_entry["topics"][1:]
+        if len(topics) != len(self.topic_types):
+            raise ValueError("Expected {0} log topics. Got {1}".format(len(self.topic_types), len(topics)))
+        args = {}
+        if self.topic_types:
+            values = decode_abi(self.topic_types, b"".join(HexBytes(t) for t in topics))
+            values = map_abi_data(BASE_RETURN_NORMALIZERS, self.topic_types, values)
+            args.update(zip(self.topic_names, values))
+        if self.data_types:
+            values = decode_abi(self.data_types, HexBytes(log_entry["data"]))
+            values = map_abi_data(BASE_RETURN_NORMALIZERS, self.data_types, values)
+            args.update(zip(self.data_names, values))
+        return EventRecord(
+            contract=self.contract,
+            event=self.name,
+            args=args,
+            address=log_entry["address"],
+            block_number=log_entry["blockNumber"],
+            log_index=log_entry["logIndex"],
+            transaction_hash=log_entry["transactionHash"],
+            transaction_index=log_entry["transactionIndex"],
+            block_hash=log_entry["blockHash"],
+        )
+
+
+class EventRegistry(object):
+    """ 以topic0为键的事件解码器表
+    加载合约时注册所有合约ABI中的所有事件. 不同合约中签名相同的事件(如 LogError)按日志地址区分来源合约.
+    """
+
+    def __init__(self):
+        self._by_address = {}  # (合约地址, topic0) -> EventDecoder
+        self._by_topic = {}  # topic0 -> EventDecoder, 地址未知时使用
+        self.topics = {}  # (合约名, 事件名) -> topic0
+
+    def register(self, contract_name, address, abi):
+        """注册一个合约ABI中的所有事件"""
+        address = Web3.toChecksumAddress(address) if address else None
+        for item in abi:
+            if item.get("type") != "event" or item.get("anonymous"):
+                continue
+            decoder = EventDecoder(contract_name, item)
+            self._by_topic.setdefault(decoder.topic, decoder)
+            if address:
+                self._by_address[(address, decoder.topic)] = decoder
+            self.topics[(contract_name, decoder.name)] = Web3.toHex(decoder.topic)
+
+    def decoder_for(self, log_entry):
+        """找到日志对应的解码器, 未注册的事件返回None"""
+        if not log_entry["topics"]:
+            return None
+        topic = HexBytes(log_entry["topics"][0])
+        address = log_entry.get("address")
+        if address:
+            decoder = self._by_address.get((Web3.toChecksumAddress(address), topic))
+            if decoder is not None:
+                return decoder
+        return self._by_topic.get(topic)
+
+    def decode_log(self, log_entry):
+        """解码一条日志, 未注册的事件返回None"""
+        decoder = self.decoder_for(log_entry)
+        return decoder.decode(log_entry) if decoder is not None else None
+
+    def decode_logs(self, logs):
+        """解码一组日志, 跳过未注册的事件"""
+        records = []
+        for entry in logs:
+            decoder = self.decoder_for(entry)
+            if decoder is not None:
+                records.append(decoder.decode(entry))
+        return records
+
+    def decode_receipt(self, receipt):
+        """解码交易回执中所有合约的事件"""
+        return self.decode_logs(receipt["logs"])
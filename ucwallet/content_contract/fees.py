@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/25
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : gas估算和gas价格策略. 交易的gas上限使用 eth_estimateGas 的结果加上安全余量,
+#            不再每笔交易都占用整个区块的gas上限, 一个块可以打包多笔交易
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger("fees")
+
+GAS_MARGIN = 1.2  # 估算值乘以这个系数作为交易的gas上限
+TRANSFER_GAS = 21000  # 普通转账的gas
+MAX_SIZE = 4096  # 最多缓存的估算结果数
+
+
+def arg_key(value):
+    """ 参数转换为可hash的值
+    gas消耗取决于参数的值(如写入的是新的存储位置还是已有的位置、数组的长度), 而不只是参数的类型和长度
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(arg_key(v) for v in value)
+    if isinstance(value, bytearray):
+        return bytes(value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, arg_key(v)) for k, v in value.items()))
+    return value
+
+
+def estimate_key(func, sender=None):
+    """ 估算缓存的键
+    合约方法为 (合约地址, 方法名, 参数值, 发送地址); 合约构造为 ("constructor", 交易数据hash, 发送地址)
+    """
+    if hasattr(func, "fn_name"):
+        return func.address, func.fn_name, arg_key(list(func.arguments)), sender
+    data = func.data_in_transaction
+    data = data if isinstance(data, bytes) else str(data).encode("utf-8")
+    return "constructor", hashlib.sha1(data).hexdigest(), sender
+
+
+class GasEstimator(object):
+    """ 带缓存的gas估算
+    每个 (合约, 方法, 参数值, 发送地址) 只调用一次 eth_estimateGas, 之后复用估算结果, 最多保存 maxsize 个.
+    同一个键记录见过的最大估算值, 估算失败(如调用会被revert)时使用gas上限, 交易仍然会发出.
+    普通转账(21000)的gas是固定的, 不加余量.
+    """
+
+    def __init__(self, cap, margin=GAS_MARGIN, maxsize=MAX_SIZE):
+        """
+        :param cap: 交易gas上限的最大值, 一般为区块gas上限
+        :param margin: 安全余量系数
+        :param maxsize: 最多缓存的估算结果数
+        """
+        self.cap = cap
+        self.margin = margin
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """读取缓存的gas上限, 没有缓存时返回None"""
+        with self._lock:
+            gas = self._cache.get(key)
+            if gas is not None:
+                self._cache.move_to_end(key)
+            return gas
+
+    def update(self, key, estimate):
+        """记录一次估算结果, 返回加上余量后的gas上限"""
+        # 普通转账固定为21000, 不需要余量; 合约调用至少还有calldata的gas, 一定大于21000
+        gas = estimate if estimate <= TRANSFER_GAS else min(int(estimate * self.margin), self.cap)
+        with self._lock:
+            gas = max(gas, self._cache.pop(key, 0))
+            self._cache[key] = gas
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return gas
+
+    def estimate(self, func, sender):
+        """ 估算合约调用或合约构造交易的gas上限
+        :param func: 已传入参数的 ContractFunction 或 ContractConstructor
+        :param sender: 发送交易的地址
+        """
+        key = estimate_key(func, sender)
+        gas = self.lookup(key)
+        if gas is not None:
+            return gas
+        try:
+            estimate = func.estimateGas({"from": sender})
+        except Exception as e:
+            log.warning("estimate gas of {} fail: {}, use gas limit {}".format(key[1], e, self.cap))
+            return self.cap
+        return self.update(key, estimate)
+
+    def estimate_transfer(self, web3, sender, to_address, value):
+        """估算转账交易的gas上限, 接收地址是合约时会大于21000"""
+        key = ("transfer", to_address)
+        gas = self.lookup(key)
+        if gas is not None:
+            return gas
+        try:
+            estimate = web3.eth.estimateGas({"from": sender, "to": to_address, "value": value})
+        except Exception as e:
+            log.warning("estimate transfer gas fail: {}, use gas limit {}".format(e, self.cap))
+            return self.cap
+        return self.update(key, estimate)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+# gas价格策略与web3的 setGasPriceStrategy 使用相同的接口: strategy(web3, transaction_params) -> wei
+
+
+def fixed_gas_price(price):
+    """固定的gas价格"""
+
+    def strategy(web3, transaction_params=None):
+        return price
+
+    return strategy
+
+
+def node_gas_price(web3, transaction_params=None):
+    """使用节点 eth_gasPrice 返回的价格"""
+    return web3.eth.gasPrice
+
+
+class RecentBlocksGasPrice(object):
+    """ 根据最近若干个块中交易的gas价格选择价格
+    取最近 blocks 个块中所有交易gas价格的 percentile 百分位数, 限制在 [min_price, max_price] 之间.
+    结果按最新块号缓存, 同一个块内的多笔交易只查询一次.
+    """
+
+    def __init__(self, blocks=20, percentile=50, min_price=None, max_price=None, default=None):
+        """
+        :param blocks: 采样的块数
+        :param percentile: 百分位数, 越大交易被打包得越快
+        :param min_price: 最低价格(wei)
+        :param max_price: 最高价格(wei)
+        :param default: 最近的块中没有交易时使用的价格, 默认使用节点的 eth_gasPrice
+        """
+        if not 0 <= percentile <= 100:
+            raise ValueError("percentile must be between 0 and 100.")
+        self.blocks = blocks
+        self.percentile = percentile
+        self.min_price = min_price
+        self.max_price = max_price
+        self.default = default
+        self._prices = {}  # 块号 -> 该块中交易的gas价格列表
+        self._cached = (None, None)  # (最新块号, 价格)
+        self._lock = threading.Lock()
+
+    def _block_prices(self, web3, number):
+        if number not in self._prices:
+            block = web3.eth.getBlock(number, full_transactions=True)
+            self._prices[number] = [tx["gasPrice"] for tx in block["transactions"]] if block else []
+        return self._prices[number]
+
+    def __call__(self, web3, transaction_params=None):
+        with self._lock:
+            latest = web3.eth.blockNumber
+            if self._cached[0] == latest:
+                return self._cached[1]
+            first = max(latest - self.blocks + 1, 0)
+            prices = []
+            for number in range(first, latest + 1):
+                prices.extend(self._block_prices(web3, number))
+            for number in [n for n in self._prices if n < first]:
+                del self._prices[number]
+            if prices:
+                prices.sort()
+                price = prices[min(len(prices) * self.percentile // 100, len(prices) - 1)]
+            else:
+                price = self.default if self.default is not None else web3.eth.gasPrice
+            if self.min_price is not None:
+                price = max(price, self.min_price)
+            if self.max_price is not None:
+                price = min(price, self.max_price)
+            self._cached = (latest, price)
+            return price
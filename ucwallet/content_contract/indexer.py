@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/14
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 合约事件索引, 把ClaimDB/OrderDB/CenterControl的日志写入本地SQLite
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from hexbytes import HexBytes
+from web3 import Web3
+
+import dconfig
+from ucwallet.content_contract.logscanner import LogScanner
+
+log = logging.getLogger("indexer")
+
+# 需要索引的合约事件
+FOLLOWED_EVENTS = {
+    "ClaimDB": ["LogNewClaim", "LogUpdateClaimUdfs", "LogUpdateClaimAuthor", "LogUpdateClaimPricing",
+                "LogUpdateClaimWaive", "LogDeleteClaim"],
+    "OrderDB": ["LogNewOrder", "LogRemoveOrder"],
+    "CenterControl": ["LogSimpleClaim"],
+}
+# 按订单id而不是资源id归类的事件
+ORDER_EVENTS = ("LogNewOrder", "LogRemoveOrder")
+CHUNK_SIZE = 1000
+MAX_WORKERS = 4
+REORG_DEPTH = 12
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key     TEXT PRIMARY KEY,
+    value   TEXT
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    number  INTEGER PRIMARY KEY,
+    hash    TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    block_number    INTEGER NOT NULL,
+    log_index       INTEGER NOT NULL,
+    block_hash      TEXT,
+    tx_hash         TEXT,
+    contract        TEXT,
+    event           TEXT,
+    args            TEXT,
+    entity_id       TEXT,
+    PRIMARY KEY (block_number, log_index)
+);
+CREATE TABLE IF NOT EXISTS claims (
+    claim_id        TEXT PRIMARY KEY,
+    author          TEXT,
+    udfs            TEXT,
+    pricing         TEXT,
+    waive           INTEGER DEFAULT 0,
+    deleted         INTEGER DEFAULT 0,
+    block_number    INTEGER
+);
+CREATE TABLE IF NOT EXISTS orders (
+    order_id        TEXT PRIMARY KEY,
+    claim_id        TEXT,
+    customer        TEXT,
+    payer           TEXT,
+    removed         INTEGER DEFAULT 0,
+    block_number    INTEGER
+);
+CREATE TABLE IF NOT EXISTS simple_claims (
+    block_number    INTEGER NOT NULL,
+    log_index       INTEGER NOT NULL,
+    tx_hash         TEXT,
+    author          TEXT,
+    udfs            TEXT,
+    PRIMARY KEY (block_number, log_index)
+);
+CREATE INDEX IF NOT EXISTS idx_events_contract ON events (contract, event);
+CREATE INDEX IF NOT EXISTS idx_claims_author ON claims (author);
+CREATE INDEX IF NOT EXISTS idx_claims_udfs ON claims (udfs);
+CREATE INDEX IF NOT EXISTS idx_orders_claim ON orders (claim_id);
+CREATE INDEX IF NOT EXISTS idx_orders_customer ON orders (customer);
+CREATE INDEX IF NOT EXISTS idx_simple_claims_author ON simple_claims (author);
+CREATE INDEX IF NOT EXISTS idx_simple_claims_udfs ON simple_claims (udfs);
+"""
+
+
+def _to_json(value):
+    """事件参数转换为可以写入JSON的值"""
+    if isinstance(value, (bytes, bytearray)):
+        return Web3.toHex(value)
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return value
+
+
+def _entity_id(event, args):
+    """事件所属的资源id或订单id, 回滚时只重建这些记录; 简单声明没有id"""
+    if event in ORDER_EVENTS:
+        return args.get("orderId")
+    return args.get("_claimId")
+
+
+class EventIndexer(object):
+    """ 合约事件索引器
+    用 LogScanner 并行扫描块区间内的日志, 解码后写入SQLite, 每段处理完成后记录检查点.
+    最近 reorg_depth 个块的hash会被保存, 同步前和链上对比, 发现分叉时回滚到分叉点重新索引.
+    """
+
+    def __init__(self, content_contract, db_path=None, chunk_size=CHUNK_SIZE, max_workers=MAX_WORKERS,
+                 reorg_depth=REORG_DEPTH, start_block=0):
+        """
+        :param content_contract: 已加载合约的 ContentContract 对象
+        :param db_path: SQLite数据库文件路径, 默认为用户数据目录下的 events.db
+        :param chunk_size: 每次 eth_getLogs 查询的初始块数, 之后根据结果数量自动调整
+        :param max_workers: 回溯历史时并行查询的线程数
+        :param reorg_depth: 处理分叉的最大深度(块数)
+        :param start_block: 第一次同步时的起始块号
+        """
+        self.content_contract = content_contract
+        self.web3 = content_contract.web3
+        self.db_path = db_path if db_path else os.path.join(dconfig.prepare_user_data_dir(), "events.db")
+        self.scanner = LogScanner(content_contract, FOLLOWED_EVENTS, max_workers=max_workers,
+                                  chunk_size=chunk_size)
+        self.reorg_depth = reorg_depth
+        self.start_block = start_block
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """旧数据库的events表没有entity_id列, 添加后从已保存的事件参数补全"""
+        columns = [row["name"] for row in self.db.execute("PRAGMA table_info(events)")]
+        with self.db:
+            if "entity_id" not in columns:
+                self.db.execute("ALTER TABLE events ADD COLUMN entity_id TEXT")
+                rows = self.db.execute("SELECT block_number, log_index, event, args FROM events").fetchall()
+                for row in rows:
+                    self.db.execute("UPDATE events SET entity_id = ? WHERE block_number = ? AND log_index = ?",
+                                    (_entity_id(row["event"], json.loads(row["args"])),
+                                     row["block_number"], row["log_index"]))
+            self.db.execute("CREATE INDEX IF NOT EXISTS idx_events_entity ON events (entity_id)")
+
+    # 检查点
+
+    def _get_meta(self, key, default=None):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else default
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    @property
+    def last_block(self):
+        """已经处理完成的最后一个块"""
+        value = self._get_meta("last_block")
+        return int(value) if value is not None else self.start_block - 1
+
+    # 分叉处理
+
+    def _check_reorg(self):
+        """ 对比本地保存的块hash和链上的块hash, 返回分叉点(最后一个一致的块号), 没有分叉返回None """
+        rows = self.db.execute("SELECT number, hash FROM blocks ORDER BY number DESC").fetchall()
+        for i, row in enumerate(rows):
+            block = self.web3.eth.getBlock(row["number"])
+            if block is not None and Web3.toHex(block["hash"]) == row["hash"]:
+                return None if i == 0 else row["number"]
+        # 保存的块全部不一致, 分叉深度超过了 reorg_depth, 回滚到最早保存的块之前
+        return rows[-1]["number"] - 1 if rows else None
+
+    def _rollback(self, block_number):
+        """ 删除 block_number 之后的数据
+        只重建被回滚的事件涉及的资源和订单: 删除这些记录后按剩下的事件重放, 再只为这些资源查询udfs.
+        回滚的代价与分叉深度有关, 与索引的历史长度无关.
+        """
+        log.warning("chain reorganization detected, roll back to block {}".format(block_number))
+        with self.db:
+            rows = self.db.execute("SELECT entity_id FROM events WHERE block_number > ? AND entity_id IS NOT NULL",
+                                   (block_number,)).fetchall()
+            entities = set(row["entity_id"] for row in rows)
+            self.db.execute("DELETE FROM events WHERE block_number > ?", (block_number,))
+            self.db.execute("DELETE FROM blocks WHERE number > ?", (block_number,))
+            self.db.execute("DELETE FROM simple_claims WHERE block_number > ?", (block_number,))
+            for entity_id in entities:
+                self.db.execute("DELETE FROM claims WHERE claim_id = ?", (entity_id,))
+                self.db.execute("DELETE FROM orders WHERE order_id = ?", (entity_id,))
+                rows = self.db.execute("SELECT * FROM events WHERE entity_id = ? ORDER BY block_number, log_index",
+                                       (entity_id,)).fetchall()
+                for row in rows:
+                    self._apply(row["contract"], row["event"], json.loads(row["args"]),
+                                row["block_number"], row["log_index"], row["tx_hash"])
+            self._set_meta("last_block", block_number)
+        self._fill_claims()
+
+    # 同步
+
+    def _apply(self, contract, event, args, block_number, log_index, tx_hash):
+        """根据一个事件更新索引表"""
+        if event == "LogNewClaim":
+            self.db.execute("INSERT OR REPLACE INTO claims (claim_id, author, block_number) VALUES (?, ?, ?)",
+                            (args["_claimId"], args["_author"], block_number))
+        elif event == "LogUpdateClaimUdfs":
+            # 新的udfs不在事件中, 置空后由 _fill_claims 重新查询
+            self.db.execute("UPDATE claims SET udfs = NULL, pricing = ?, block_number = ? WHERE claim_id = ?",
+                            (str(args["_pricing"]), block_number, args["_claimId"]))
+        elif event == "LogUpdateClaimAuthor":
+            self.db.execute("UPDATE claims SET author = ?, block_number = ? WHERE claim_id = ?",
+                            (args["_newAuthor"], block_number, args["_claimId"]))
+        elif event == "LogUpdateClaimPricing":
+            self.db.execute("UPDATE claims SET pricing = ?, block_number = ? WHERE claim_id = ?",
+                            (str(args["_newPricinge"]), block_number, args["_claimId"]))
+        elif event == "LogUpdateClaimWaive":
+            self.db.execute("UPDATE claims SET waive = ?, block_number = ? WHERE claim_id = ?",
+                            (int(args["_waive"]), block_number, args["_claimId"]))
+        elif event == "LogDeleteClaim":
+            self.db.execute("UPDATE claims SET deleted = 1, block_number = ? WHERE claim_id = ?",
+                            (block_number, args["_claimId"]))
+        elif event == "LogNewOrder":
+            self.db.execute("INSERT OR REPLACE INTO orders (order_id, claim_id, customer, payer, block_number) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (args["orderId"], args["claimId"], args["customer"], args["payer"], block_number))
+        elif event == "LogRemoveOrder":
+            self.db.execute("UPDATE orders SET removed = 1, block_number = ? WHERE order_id = ?",
+                            (block_number, args["orderId"]))
+        elif event == "LogSimpleClaim":
+            self.db.execute("INSERT OR REPLACE INTO simple_claims (block_number, log_index, tx_hash, author, udfs) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (block_number, log_index, tx_hash, args["author"], args["udfs"]))
+
+    def _fill_claims(self):
+        """ LogNewClaim 和 LogUpdateClaimUdfs 中没有udfs, 用一个批量请求从ClaimDB查询补全 """
+        rows = self.db.execute("SELECT claim_id FROM claims WHERE udfs IS NULL AND deleted = 0").fetchall()
+        if not rows:
+            return
+        claim_ids = [row["claim_id"] for row in rows]
+        calls = [("ClaimDB", "getClaimInfoByID", [Web3.toBytes(hexstr=cid)]) for cid in claim_ids]
+        results = self.content_contract.batch_call(calls)
+        with self.db:
+            for claim_id, result in zip(claim_ids, results):
+                if result.error is not None:
+                    log.warning("get claim {} info fail: {}".format(claim_id, result.error))
+                    continue
+                author, udfs, _, _, pricing, waive, _ = result.value
+                self.db.execute("UPDATE claims SET udfs = ?, pricing = ?, waive = ? WHERE claim_id = ?",
+                                (udfs, str(pricing), int(waive), claim_id))
+
+    def _store(self, events, to_block):
+        """把一段区间内的事件写入数据库, 并更新检查点"""
+        with self.db:
+            for event in events:
+                args = {k: _to_json(v) for k, v in event.args.items()}
+                tx_hash = Web3.toHex(event.transaction_hash)
+                block_hash = Web3.toHex(event.block_hash)
+                self.db.execute("INSERT OR REPLACE INTO events (block_number, log_index, block_hash, tx_hash, "
+                                "contract, event, args, entity_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                (event.block_number, event.log_index, block_hash, tx_hash, event.contract,
+                                 event.event, json.dumps(args), _entity_id(event.event, args)))
+                self.db.execute("INSERT OR REPLACE INTO blocks (number, hash) VALUES (?, ?)",
+                                (event.block_number, block_hash))
+                self._apply(event.contract, event.event, args, event.block_number, event.log_index, tx_hash)
+            block = self.web3.eth.getBlock(to_block)
+            self.db.execute("INSERT OR REPLACE INTO blocks (number, hash) VALUES (?, ?)",
+                            (to_block, Web3.toHex(block["hash"])))
+            # 只保留可能发生分叉的最近区块
+            self.db.execute("DELETE FROM blocks WHERE number <= ?", (to_block - self.reorg_depth,))
+            self._set_meta("last_block", to_block)
+
+    def sync(self, to_block=None):
+        """ 把索引同步到指定块(默认最新块)
+        :return: 同步后的最后一个块号
+        """
+        with self._lock:
+            fork = self._check_reorg()
+            if fork is not None:
+                self._rollback(fork)
+            head = self.web3.eth.blockNumber if to_block is None else to_block
+            start = self.last_block + 1
+            while start <= head:
+                # 每次并行扫描的区间覆盖所有线程的一个分片, 处理完成后记录一次检查点
+                end = min(start + self.scanner.chunk_size * self.scanner.max_workers - 1, head)
+                events = self.scanner.scan(start, end)
+                self._store(events, end)
+                log.info("indexed blocks {}-{}, {} events".format(start, end, len(events)))
+                start = end + 1
+            self._fill_claims()
+            return self.last_block
+
+    def start(self, poll_interval=5):
+        """在后台线程中持续跟踪新块"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._follow, args=(poll_interval,), name="event-indexer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """停止后台跟踪"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _follow(self, poll_interval):
+        while not self._stop.is_set():
+            try:
+                self.sync()
+            except Exception as e:
+                log.error("index events fail: {}".format(e))
+            self._stop.wait(poll_interval)
+
+    # 本地查询
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self.db.execute(sql, params).fetchall()]
+
+    @staticmethod
+    def _claim_id(claim_id):
+        return Web3.toHex(HexBytes(claim_id))
+
+    def get_claim(self, claim_id):
+        """查询一个资源"""
+        rows = self._query("SELECT * FROM claims WHERE claim_id = ?", (self._claim_id(claim_id),))
+        return rows[0] if rows else None
+
+    def claims_by_author(self, author, include_deleted=False):
+        """查询作者发布的所有资源"""
+        sql = "SELECT * FROM claims WHERE author = ?"
+        if not include_deleted:
+            sql += " AND deleted = 0"
+        return self._query(sql + " ORDER BY block_number", (Web3.toChecksumAddress(author),))
+
+    def claims_by_udfs(self, udfs):
+        """查询udfs hash对应的资源, 包括只记录了日志的简单声明"""
+        claims = self._query("SELECT * FROM claims WHERE udfs = ? AND deleted = 0", (udfs,))
+        simple = self._query("SELECT * FROM simple_claims WHERE udfs = ?", (udfs,))
+        return claims + simple
+
+    def is_published(self, udfs):
+        """udfs hash是否已经发布过(未删除的资源或简单声明), 用于上传和发布前的去重"""
+        rows = self._query("SELECT 1 FROM claims WHERE udfs = ? AND deleted = 0 "
+                           "UNION ALL SELECT 1 FROM simple_claims WHERE udfs = ? LIMIT 1", (udfs, udfs))
+        return bool(rows)
+
+    def buyers_of_claim(self, claim_id):
+        """查询购买了某个资源的所有用户"""
+        rows = self._query("SELECT DISTINCT customer FROM orders WHERE claim_id = ? AND removed = 0",
+                           (self._claim_id(claim_id),))
+        return [row["customer"] for row in rows]
+
+    def orders_by_customer(self, customer):
+        """查询用户的所有订单"""
+        return self._query("SELECT * FROM orders WHERE customer = ? AND removed = 0 ORDER BY block_number",
+                           (Web3.toChecksumAddress(customer),))
+
+    def events(self, contract=None, event=None, from_block=None, to_block=None):
+        """按条件查询原始事件"""
+        sql = "SELECT * FROM events WHERE 1 = 1"
+        params = []
+        for column, op, value in (("contract", "=", contract), ("event", "=", event),
+                                  ("block_number", ">=", from_block), ("block_number", "<=", to_block)):
+            if value is not None:
+                sql += " AND {} {} ?".format(column, op)
+                params.append(value)
+        rows = self._query(sql + " ORDER BY block_number, log_index", params)
+        for row in rows:
+            row["args"] = json.loads(row["args"])
+        return rows
+
+    def close(self):
+        self.stop()
+        self.db.close()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/22
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 合约ABI和合约对象的延迟加载. 启动时只读取一个紧凑的ABI索引,
+#            ABI文件和web3合约对象在第一次使用时才创建
+import hashlib
+import json
+import logging
+import os
+from collections.abc import Mapping
+
+log = logging.getLogger("loader")
+
+ABI_INDEX_FILE = "abi_index.json"
+
+
+def _abi_stats(abi_dir):
+    """abi目录下每个ABI文件内容的sha1, 用于判断索引是否过期. 只读取不解析, 代价很小"""
+    stats = {}
+    for filename in os.listdir(abi_dir):
+        if filename.endswith(".abi"):
+            with open(os.path.join(abi_dir, filename), "rb") as f:
+                stats[filename[:-4]] = hashlib.sha1(f.read()).hexdigest()
+    return stats
+
+
+def summarize_abi(abi):
+    """ABI中的函数名、只读函数名和事件名"""
+    functions, view_funcs, events = [], [], []
+    for item in abi:
+        if item.get("type") == "function":
+            functions.append(item["name"])
+            if item.get("constant") and item.get("stateMutability") == "view":
+                view_funcs.append(item["name"])
+        elif item.get("type") == "event":
+            events.append(item["name"])
+    return {"functions": functions, "view": view_funcs, "events": events}
+
+
+def build_abi_index(abi_dir):
+    """ 解析所有ABI文件生成索引并写入 abi_index.json
+    :return: {"files": {合约名: sha1}, "contracts": {合约名: {"functions", "view", "events"}}}
+    """
+    stats = _abi_stats(abi_dir)
+    contracts = {}
+    for name in sorted(stats):
+        with open(os.path.join(abi_dir, name + ".abi")) as f:
+            contracts[name] = summarize_abi(json.load(f))
+    index = {"files": stats, "contracts": contracts}
+    try:
+        tmp = os.path.join(abi_dir, ABI_INDEX_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(index, f, separators=(",", ":"))
+        os.replace(tmp, os.path.join(abi_dir, ABI_INDEX_FILE))
+    except OSError as e:
+        # 安装目录可能没有写权限, 此时只在内存中使用索引
+        log.warning("save abi index fail: {}".format(e))
+    return index
+
+
+def load_abi_index(abi_dir):
+    """读取ABI索引, 索引不存在或ABI文件有变化时重新生成"""
+    try:
+        with open(os.path.join(abi_dir, ABI_INDEX_FILE)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return build_abi_index(abi_dir)
+    if index.get("files") != _abi_stats(abi_dir):
+        return build_abi_index(abi_dir)
+    return index
+
+
+class ABIFiles(Mapping):
+    """合约名 -> ABI, 第一次访问某个合约时才读取对应的ABI文件"""
+
+    def __init__(self, abi_dir, index):
+        self.abi_dir = abi_dir
+        self.index = index
+        self._abis = {}
+
+    def __getitem__(self, name):
+        if name not in self._abis:
+            if name not in self.index["contracts"]:
+                raise KeyError(name)
+            with open(os.path.join(self.abi_dir, name + ".abi")) as f:
+                self._abis[name] = json.load(f)
+        return self._abis[name]
+
+    def __iter__(self):
+        return iter(self.index["contracts"])
+
+    def __len__(self):
+        return len(self.index["contracts"])
+
+
+class LazyContracts(Mapping):
+    """ 合约名 -> web3合约对象, 第一次访问某个合约时才创建
+    只包含在 contractAddresses.json 中有地址并且有ABI文件的合约; 创建失败(如地址无效)的合约视为不存在.
+    """
+
+    def __init__(self, factory, addresses, index):
+        """
+        :param factory: 创建合约对象的函数 factory(合约名, 地址)
+        :param addresses: contractAddresses.json 的内容
+        :param index: ABI索引
+        """
+        self._factory = factory
+        self._addresses = addresses
+        self._names = [name for name in addresses if name in index["contracts"]]
+        self._contracts = {}
+        self._failed = set()
+
+    def __getitem__(self, name):
+        contract = self._contracts.get(name)
+        if contract is not None:
+            return contract
+        if name not in self._names or name in self._failed:
+            raise KeyError(name)
+        try:
+            contract = self._factory(name, self._addresses[name])
+        except Exception as e:
+            log.warning("load {} contract fail: {}".format(name, e))
+            self._failed.add(name)
+            raise KeyError(name)
+        self._contracts[name] = contract
+        return contract
+
+    def __contains__(self, name):
+        return name in self._names and name not in self._failed
+
+    def __iter__(self):
+        return (name for name in self._names if name not in self._failed)
+
+    def __len__(self):
+        return len(self._names) - len(self._failed)
+
+    @property
+    def loaded(self):
+        """已经创建的合约对象"""
+        return dict(self._contracts)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/17
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 并行的合约日志扫描
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+
+log = logging.getLogger("logscanner")
+
+# 节点因为单次查询结果太多或查询太慢而拒绝时的错误信息
+TOO_MANY_RESULTS = (
+    "query returned more than",
+    "too many",
+    "limit exceeded",
+    "response size",
+    "query timeout",
+)
+
+
+def is_too_many_results(err):
+    """判断 eth_getLogs 的异常是否因为区间太大"""
+    if isinstance(err, requests.exceptions.ReadTimeout):
+        return True
+    message = str(err).lower()
+    return any(e in message for e in TOO_MANY_RESULTS)
+
+
+class LogScanner(object):
+    """ 合约日志扫描器
+    把一个块区间拆分成多个分片, 在有限大小的线程池中并行调用 eth_getLogs.
+    区间大小自适应: 节点报告结果太多时把分片一分为二重新查询并缩小区间, 结果稀疏时扩大区间.
+    解码使用 ContentContract 加载合约时注册的事件解码器, 结果按(块号, 日志序号)排序后返回.
+    """
+
+    def __init__(self, content_contract, events=None, max_workers=4, chunk_size=1000,
+                 min_chunk_size=1, max_chunk_size=100000, target_logs=1000):
+        """
+        :param content_contract: 已加载合约的 ContentContract 对象
+        :param events: 需要扫描的事件 {合约名: [事件名, ...]}, 默认为所有已加载合约的所有事件
+        :param max_workers: 并行查询的线程数
+        :param chunk_size: 初始分片大小(块数)
+        :param min_chunk_size: 最小分片大小
+        :param max_chunk_size: 最大分片大小
+        :param target_logs: 每个分片期望的日志数量, 少于一半时扩大分片
+        """
+        self.content_contract = content_contract
+        self.web3 = content_contract.web3
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_logs = target_logs
+        self._load_events(events)
+
+    def _load_events(self, events):
+        """找出需要扫描的合约地址和事件签名"""
+        self.addresses = []
+        self.topics = []
+        registry = self.content_contract.events
+        names = events.keys() if events is not None else self.content_contract.contract.keys()
+        for name in names:
+            contract = self.content_contract.contract.get(name)
+            if contract is None:
+                log.warning("{} contract is not loaded, its events are not scanned".format(name))
+                continue
+            self.addresses.append(contract.address)
+            for (contract_name, event_name), topic in registry.topics.items():
+                if contract_name != name or (events is not None and event_name not in events[name]):
+                    continue
+                if topic not in self.topics:
+                    self.topics.append(topic)
+        self._wanted = None if events is None else {(name, e) for name, items in events.items() for e in items}
+
+    def fetch(self, from_block, to_block):
+        """ 查询并解码一个块区间内的事件(一次 eth_getLogs, 不拆分)
+        :return: [EventRecord, ...]
+        """
+        if not self.addresses:
+            return []
+        logs = self.web3.eth.getLogs({
+            "fromBlock": from_block,
+            "toBlock": to_block,
+            "address": self.addresses,
+            "topics": [self.topics],
+        })
+        events = self.content_contract.events.decode_logs(logs)
+        if self._wanted is not None:
+            events = [e for e in events if (e.contract, e.event) in self._wanted]
+        return events
+
+    def _adjust(self, blocks, count):
+        """根据一个分片的结果数量调整后续分片大小"""
+        if count < self.target_logs // 2 and blocks >= self.chunk_size:
+            self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+
+    def _shrink(self, blocks):
+        self.chunk_size = max(min(self.chunk_size, blocks) // 2, self.min_chunk_size)
+
+    def scan(self, from_block, to_block):
+        """ 并行扫描 [from_block, to_block] 区间内的事件
+        :return: 按(块号, 日志序号)排序的 [EventRecord, ...]
+        """
+        results = []
+        retry = []  # 被拆分后需要重新查询的区间
+        pending = set()
+        next_start = from_block
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while retry or pending or next_start <= to_block:
+                while len(pending) < self.max_workers and (retry or next_start <= to_block):
+                    if retry:
+                        start, end = retry.pop()
+                    else:
+                        start, end = next_start, min(next_start + self.chunk_size - 1, to_block)
+                        next_start = end + 1
+                    future = pool.submit(self.fetch, start, end)
+                    future.block_range = (start, end)
+                    pending.add(future)
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    start, end = future.block_range
+                    try:
+                        events = future.result()
+                    except Exception as e:
+                        if not is_too_many_results(e) or start == end:
+                            raise
+                        # 区间太大, 一分为二重新查询
+                        log.info("blocks {}-{} too many results, split".format(start, end))
+                        self._shrink(end - start + 1)
+                        middle = (start + end) // 2
+                        retry.extend([(middle + 1, end), (start, middle)])
+                        continue
+                    self._adjust(end - start + 1, len(events))
+                    results.extend(events)
+        results.sort(key=lambda e: (e.block_number, e.log_index))
+        return results
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/3
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 本地nonce分配器
+
+import logging
+import threading
+
+from web3 import Web3
+
+log = logging.getLogger("nonce")
+
+# 节点返回这些错误时, 说明本地nonce已经落后于链上, 需要重新同步
+NONCE_ERRORS = (
+    "nonce too low",
+    "known transaction",
+    "already known",
+    "replacement transaction underpriced",
+)
+# 同一笔交易(同样的hash)已经在交易池中, 不能重新签名再发送
+KNOWN_ERRORS = (
+    "known transaction",
+    "already known",
+)
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def is_nonce_error(err):
+    """判断发送交易时的异常是否由nonce冲突引起"""
+    message = str(err).lower()
+    return any(e in message for e in NONCE_ERRORS)
+
+
+def is_known_error(err):
+    """判断发送交易时的异常是否表示这笔交易已经在交易池中"""
+    message = str(err).lower()
+    return any(e in message for e in KNOWN_ERRORS)
+
+
+def is_nonce_too_low(err):
+    """判断发送交易时的异常是否表示nonce已经被链上的交易使用"""
+    return "nonce too low" in str(err).lower()
+
+
+class NonceManager(object):
+    """ 单个账户的nonce分配器
+    第一次使用时从节点的pending交易数初始化, 之后在本地递增分配, 多线程安全.
+    """
+
+    def __init__(self, eth, address):
+        """
+        :param eth: web3.eth 对象, 用于查询账户交易数
+        :param address: 账户地址
+        """
+        self.eth = eth
+        self.address = address
+        self._lock = threading.Lock()
+        self._next = None
+        self._released = set()  # 分配后没有发出、可以重新分配的nonce
+
+    def _fetch(self):
+        return self.eth.getTransactionCount(self.address, "pending")
+
+    def next_nonce(self):
+        """分配一个nonce, 优先使用被释放的nonce"""
+        with self._lock:
+            if self._released:
+                nonce = min(self._released)
+                self._released.remove(nonce)
+                return nonce
+            if self._next is None:
+                self._next = self._fetch()
+            nonce = self._next
+            self._next += 1
+            return nonce
+
+    def peek(self):
+        """查看下一个将被分配的nonce, 不占用"""
+        with self._lock:
+            if self._next is None:
+                self._next = self._fetch()
+            return self._next
+
+    def seed(self, value):
+        """ 用外部查询到的pending交易数初始化(异步客户端使用), 已初始化时忽略
+        :return: 是否使用了该值
+        """
+        with self._lock:
+            if self._next is not None:
+                return False
+            self._next = value
+            return True
+
+    @property
+    def seeded(self):
+        """是否已经初始化"""
+        return self._next is not None
+
+    def release(self, nonce):
+        """ 释放一个确定没有发出的nonce
+        只影响这一个nonce: 其他线程已经分配的nonce不变, 这个nonce由下一次分配重新使用, 不会留下空洞
+        """
+        with self._lock:
+            if self._next is None or nonce >= self._next:
+                return
+            self._released.add(nonce)
+            # 释放的是最后分配的nonce时直接回退计数
+            while self._next - 1 in self._released:
+                self._next -= 1
+                self._released.remove(self._next)
+
+    def resync(self, pending=None):
+        """ 丢弃本地计数, 以节点的pending交易数为准重新同步
+        :param pending: 外部查询到的pending交易数(异步客户端使用), 默认从节点查询
+        """
+        with self._lock:
+            self._next = self._fetch() if pending is None else pending
+            self._released.clear()
+            return self._next
+
+    def reset(self):
+        """ 清空本地计数, 下次分配时再从节点获取
+        只能在没有已分配但未发出的nonce时使用, 否则下次分配会与它们重复; 单个交易失败时使用 release
+        """
+        with self._lock:
+            self._next = None
+            self._released.clear()
+
+
+def send_signed(eth, nonce_manager, sign, transaction, before_send=None):
+    """ 签名并发送交易, 处理nonce冲突, 保证同一个调用不会被发送两次
+    - 节点已经有这笔交易(known transaction): 只重新同步nonce, 返回原交易的hash
+    - nonce too low: 确认原交易不在节点上之后, 用新的nonce重新签名发送一次
+    - 其他错误(包括超时): 原交易已被节点接收时返回它的hash; 确认没有被接收时释放这个nonce;
+      无法确认时保留nonce(可能已经发出), 抛出异常
+    :param eth: web3.eth 对象
+    :param nonce_manager: 发送账户的 NonceManager
+    :param sign: 签名函数 sign(transaction) -> 已签名交易(有 hash 和 rawTransaction)
+    :param transaction: 已分配nonce的交易
+    :param before_send: 发送前的回调 before_send(交易hash, transaction), 如写入日志
+    :return: 交易hash
+    """
+    for attempt in range(2):
+        signed = sign(transaction)
+        tx_hash = Web3.toHex(signed.hash)
+        if before_send is not None:
+            before_send(tx_hash, transaction)
+        try:
+            eth.sendRawTransaction(signed.rawTransaction)
+            return tx_hash
+        except Exception as e:
+            error = e
+        if is_known_error(error):
+            nonce_manager.resync()
+            return tx_hash
+        if is_nonce_error(error):
+            # nonce已被占用, 之后的分配以节点为准
+            nonce_manager.resync()
+            if eth.getTransaction(signed.hash) is not None:
+                return tx_hash
+            if attempt or not is_nonce_too_low(error):
+                raise error
+            transaction = dict(transaction, nonce=nonce_manager.next_nonce())
+            continue
+        try:
+            accepted = eth.getTransaction(signed.hash) is not None
+        except Exception as e:
+            log.warning("check transaction {} fail: {}, keep nonce {}".format(tx_hash, e, transaction["nonce"]))
+            raise error
+        if accepted:
+            return tx_hash
+        nonce_manager.release(transaction["nonce"])
+        raise error
+
+
+def get_nonce_manager(eth, address):
+    """ 获取账户对应的nonce分配器
+    同一个进程中同一个账户共用一个分配器, 所以ContentContract和Deploy同时发送交易时也不会冲突
+    """
+    with _managers_lock:
+        manager = _managers.get(address)
+        if manager is None:
+            manager = _managers[address] = NonceManager(eth, address)
+        return manager
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/26
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 通过 MulTransfer 合约批量结算. 收款人按gas上限分批, 连续分配nonce发送,
+#            每批的收款人和交易写入结算报告, 中断后可以从报告继续
+import csv
+import logging
+import threading
+
+from web3 import Web3
+
+from ucwallet.content_contract.nonce import send_signed
+from ucwallet.deploy_journal import DeployJournal, DONE, FAILED, SENT
+
+log = logging.getLogger("payouts")
+
+BASE_GAS = 30000  # 一笔 mulPayDiff/mulPaySame 交易的基础gas(不含收款人)
+RECIPIENT_GAS = 40000  # 每个收款人的gas上限估计, 包含向新地址转账的25000
+MAX_BATCH_SIZE = 200
+
+
+def read_csv(path):
+    """ 从CSV文件读取收款人, 每行为 地址,金额(wei)
+    空行、以#开头的行和第一行表头(金额列不含数字)会被跳过, 其他格式错误的行抛出 ValueError
+    """
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        first = True
+        for row in reader:
+            if not any(cell.strip() for cell in row) or row[0].strip().startswith("#"):
+                continue
+            amount = row[1].strip() if len(row) > 1 else ""
+            if first and amount and not any(c.isdigit() for c in amount):
+                first = False
+                continue
+            first = False
+            if not row[0].strip() or not amount.isdigit():
+                raise ValueError("{} line {}: invalid payout row {}".format(path, reader.line_num, row))
+            yield row[0].strip(), int(amount)
+
+
+class PayoutReport(DeployJournal):
+    """ 结算报告
+    与部署日志格式相同, 每一步是一批转账("batch:<序号>"), 记录这批的收款人 [[输入序号, 地址, 金额], ...]、
+    调用的方法、交易hash、nonce和状态
+    """
+
+    def batches(self):
+        """按序号排列的所有批次记录"""
+        return sorted((r for r in self.steps.values() if r["step"].startswith("batch:")),
+                      key=lambda r: int(r["step"][6:]))
+
+    def recipients(self):
+        """ 每个收款人的结算情况
+        :return: [(输入序号, 地址, 金额, 批次, 交易hash, 状态), ...]
+        """
+        rows = []
+        for record in self.batches():
+            for index, address, amount in record["recipients"]:
+                rows.append((index, address, amount, record["step"], record.get("tx_hash"), record["status"]))
+        return sorted(rows)
+
+    def export_csv(self, path):
+        """把每个收款人的结算情况导出为CSV"""
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["index", "address", "amount", "batch", "tx_hash", "status"])
+            for row in self.recipients():
+                writer.writerow(row)
+
+    def summary(self):
+        """各状态的批次数、收款人数和金额"""
+        summary = {}
+        for record in self.batches():
+            item = summary.setdefault(record["status"], {"batches": 0, "recipients": 0, "amount": 0})
+            item["batches"] += 1
+            item["recipients"] += len(record["recipients"])
+            item["amount"] += sum(amount for _, _, amount in record["recipients"])
+        return summary
+
+
+class BulkPayout(object):
+    """ 批量结算
+    从迭代器或CSV读取收款人, 按gas上限打包为 mulPayDiff (金额不同) 或 mulPaySame (金额相同) 调用,
+    连续分配nonce发送, 同时在途的交易不超过 max_in_flight. 每批交易在发送前写入结算报告,
+    确认后记录结果. 使用同一个报告再次运行时, 已经结算或已发送的收款人会被跳过, 失败和未上链的批次会重新结算.
+    调用账户需要在 MulTransfer 的白名单中, 合约中需要有足够的余额(或者使用 fund=True 随交易转入).
+    """
+
+    def __init__(self, content_contract, report_path,
+                 max_batch_gas=None,
+                 max_batch_size=MAX_BATCH_SIZE,
+                 max_in_flight=16,
+                 fund=False,
+                 timeout=None):
+        """
+        :param content_contract: ContentContract 对象
+        :param report_path: 结算报告文件路径
+        :param max_batch_gas: 每批交易的最大gas, 默认为区块gas上限的一半
+        :param max_batch_size: 每批的最大收款人数
+        :param max_in_flight: 同时在途的最大交易数
+        :param fund: 是否随每批交易转入这批的总金额, 默认使用合约中已有的余额
+        :param timeout: 等待每批交易回执的超时时间(秒)
+        """
+        self.content_contract = content_contract
+        self.contract = content_contract.contract["MulTransfer"]
+        self.report = PayoutReport(report_path)
+        self.max_batch_gas = max_batch_gas if max_batch_gas else content_contract.gas_limit // 2
+        self.max_batch_size = max(min(max_batch_size, (self.max_batch_gas - BASE_GAS) // RECIPIENT_GAS), 1)
+        self.fund = fund
+        self.timeout = timeout
+        self._window = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._pending = {}  # tx_hash -> 步骤名
+        self._idle = threading.Condition(self._lock)
+
+    def _reconcile(self):
+        """ 核对报告中已发送但未确认的批次
+        :return: 已经被报告覆盖(结算完成或等待确认)的输入序号 -> (地址, 金额)
+        """
+        covered = {}
+        eth = self.content_contract.web3.eth
+        for record in self.report.batches():
+            # 失败但没有回执证明的批次(如旧版本在发送超时后记录的失败)也要核对, 交易可能已经被节点接收
+            unproven = record["status"] == FAILED and record.get("tx_hash") and record.get("block_number") is None
+            if record["status"] == SENT or unproven:
+                receipt = eth.getTransactionReceipt(record["tx_hash"])
+                if receipt is not None:
+                    self._finish(record["step"], receipt)
+                elif eth.getTransaction(record["tx_hash"]) is not None:
+                    if record["status"] != SENT:
+                        self.report.record(record["step"], status=SENT)
+                    self._window.acquire()
+                    self._watch(record["step"], record["tx_hash"])
+                elif record.get("error") != "dropped":
+                    # 交易没有被节点接收(发送前中断或已被丢弃), 这批重新结算
+                    self.report.record(record["step"], status=FAILED, error="dropped")
+            record = self.report.get(record["step"])
+            if record["status"] == FAILED:
+                continue
+            for index, address, amount in record["recipients"]:
+                covered[index] = (address, amount)
+        return covered
+
+    def _batches(self, recipients, covered):
+        """把没有结算的收款人按数量上限分批"""
+        batch = []
+        for index, (address, amount) in enumerate(recipients):
+            address = self.content_contract.valid_address(address)
+            amount = int(amount)
+            if index in covered:
+                if covered[index] != (address, amount):
+                    raise ValueError("Recipient {} does not match the report: {} != {}".format(
+                        index, (address, amount), covered[index]))
+                continue
+            batch.append([index, address, amount])
+            if len(batch) >= self.max_batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _function(self, batch):
+        addresses = [address for _, address, _ in batch]
+        amounts = [amount for _, _, amount in batch]
+        if len(set(amounts)) == 1:
+            return "mulPaySame", self.contract.functions.mulPaySame(amounts[0], addresses)
+        return "mulPayDiff", self.contract.functions.mulPayDiff(addresses, amounts)
+
+    def _gas(self, func, batch, value):
+        """估算这批交易的gas上限, 估算失败(如合约余额还不够)时按每个收款人的上限估计"""
+        estimator = self.content_contract.gas_estimator
+        params = {"from": self.content_contract.account.address}
+        if value:
+            params["value"] = value
+        try:
+            estimate = func.estimateGas(params)
+        except Exception as e:
+            log.warning("estimate batch gas fail: {}".format(e))
+            return min(BASE_GAS + RECIPIENT_GAS * len(batch), estimator.cap)
+        return min(int(estimate * estimator.margin), estimator.cap)
+
+    def _send(self, step, batch):
+        """ 构建、签名并发送一批交易, 发送前写入报告
+        发送失败时批次保持 sent 状态和已记录的交易hash, 交易可能已经被节点接收(如响应超时),
+        下次运行时由 _reconcile 在链上确认交易被丢弃后才重新结算
+        """
+        cc = self.content_contract
+        method, func = self._function(batch)
+        value = sum(amount for _, _, amount in batch) if self.fund else None
+        gas = self._gas(func, batch, value)
+        tx = cc._build_transaction(func, gas_limit=gas, value=value)
+
+        def record(tx_hash, transaction):
+            # 只有确认上一个hash的交易不在节点上时才会用新的nonce重新签名, 覆盖hash是安全的
+            self.report.record(step, status=SENT, method=method, recipients=batch,
+                               tx_hash=tx_hash, nonce=transaction["nonce"], gas=gas)
+
+        try:
+            return send_signed(cc.web3.eth, cc.nonce_manager, cc.account.signTransaction, tx, before_send=record)
+        except Exception as e:
+            self.report.record(step, error=str(e))
+            raise
+
+    def _watch(self, step, tx_hash):
+        with self._lock:
+            self._pending[tx_hash] = step
+        self.content_contract._track(tx_hash, "MulTransfer")
+        self.content_contract.receipts.watch(tx_hash, callback=self._resolve, timeout=self.timeout)
+
+    def _finish(self, step, receipt):
+        if receipt.get("status") == 0:
+            log.warning("{} fail, txHash: {}".format(step, Web3.toHex(receipt["transactionHash"])))
+            self.report.record(step, status=FAILED, error="reverted", block_number=receipt["blockNumber"])
+        else:
+            self.report.record(step, status=DONE, block_number=receipt["blockNumber"], gas_used=receipt["gasUsed"])
+
+    def _resolve(self, tx_hash, receipt):
+        with self._lock:
+            step = self._pending[tx_hash]
+        if receipt is None:
+            # 超时的批次保持 sent 状态, 下次运行时核对
+            log.warning("{} is not in the chain after timeout, txHash: {}".format(step, tx_hash))
+        else:
+            self._finish(step, receipt)
+        # 结果写入报告后才移出等待列表, pay 返回时报告已经完整
+        with self._lock:
+            del self._pending[tx_hash]
+            self._idle.notify_all()
+        self._window.release()
+
+    def pay(self, recipients):
+        """ 结算
+        :param recipients: 可迭代的 (地址, 金额wei), 每次运行的顺序必须相同
+        :return: 结算报告的汇总, 见 PayoutReport.summary
+        """
+        covered = self._reconcile()
+        numbers = [int(r["step"][6:]) for r in self.report.batches()]
+        number = max(numbers) + 1 if numbers else 0
+        for batch in self._batches(recipients, covered):
+            step = "batch:{}".format(number)
+            number += 1
+            self._window.acquire()
+            try:
+                tx_hash = self._send(step, batch)
+            except Exception:
+                self._window.release()
+                raise
+            log.info("{} ({} recipients) sent, txHash: {}".format(step, len(batch), tx_hash))
+            self._watch(step, tx_hash)
+        with self._lock:
+            while self._pending:
+                self._idle.wait()
+        return self.report.summary()
+
+    def pay_csv(self, path):
+        """结算CSV文件中的收款人, 见 read_csv. 先读完整个文件, 有格式错误时一笔也不发送"""
+        return self.pay(list(read_csv(path)))
@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/30
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 批量发布. 文件并行上传到UDFS, 得到的哈希立即送入按nonce顺序发送的 AuthorModule.publish 交易,
+#            回执中的 LogNewClaim 资源id写入发布报告, 中断后可以从报告继续.
+#            上传前在本地计算文件的UDFS哈希, 已经发布过的内容不上传也不发送交易
+import csv
+import logging
+import os
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from web3 import Web3
+
+from ucwallet.content_contract.nonce import send_signed
+from ucwallet.deploy_journal import DeployJournal, DONE, FAILED, SENT
+
+log = logging.getLogger("publish")
+
+UPLOADED = "uploaded"
+DUPLICATE = "duplicate"
+OBJ_EXIST = 10  # RScorr.ObjExist(sols/ErrorModule.sol), 同一作者已经发布过这个udfs
+UPLOAD_WORKERS = 4
+QUEUE_SIZE = 8
+
+
+def read_manifest(path):
+    """ 读取发布清单, 每行为 文件路径,价格[,类型]; 相对路径相对于清单所在目录
+    空行、以#开头的行和第一行表头(价格列不含数字)会被跳过, 其他格式错误的行抛出 ValueError
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        first = True
+        for row in reader:
+            if not any(cell.strip() for cell in row) or row[0].strip().startswith("#"):
+                continue
+            price = row[1].strip() if len(row) > 1 else ""
+            if first and price and not any(c.isdigit() for c in price):
+                first = False
+                continue
+            first = False
+            type_ = row[2].strip() if len(row) > 2 else ""
+            if not row[0].strip() or not price.isdigit() or (type_ and not type_.isdigit()):
+                raise ValueError("{} line {}: invalid manifest row {}".format(path, reader.line_num, row))
+            yield os.path.join(base, row[0].strip()), int(price), int(type_) if type_ else None
+
+
+def walk_directory(path):
+    """目录下的所有文件(包括子目录), 按路径排序"""
+    files = []
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            files.append(os.path.join(dirpath, name))
+    return sorted(files)
+
+
+class PublishReport(DeployJournal):
+    """ 发布报告
+    与部署日志格式相同, 每一步是一个文件("file:<路径>"), 依次记录上传得到的UDFS哈希(uploaded)、
+    publish交易(sent)和资源id(done), 失败时记录错误(failed), 内容已经发布过时记录为重复(duplicate)
+    """
+
+    def files(self):
+        return [r for r in self.steps.values() if r["step"].startswith("file:")]
+
+    def export_csv(self, path):
+        """导出发布结果清单: 文件, UDFS哈希, 价格, 类型, 资源id, 交易hash, 状态"""
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["path", "udfs", "price", "type", "claim_id", "tx_hash", "status"])
+            for r in sorted(self.files(), key=lambda r: r["step"]):
+                writer.writerow([r["step"][5:], r.get("udfs"), r.get("price"), r.get("type"), r.get("claim_id"),
+                                 r.get("tx_hash"), r["status"]])
+
+    def summary(self):
+        """各状态的文件数"""
+        summary = {}
+        for record in self.files():
+            summary[record["status"]] = summary.get(record["status"], 0) + 1
+        return summary
+
+
+class BulkPublisher(object):
+    """ 批量发布流水线
+    上传阶段在线程池中并行调用 Udfs.upload, 上传结果放入有界队列; 发布阶段从队列中依次取出,
+    连续分配nonce发送 publish 交易, 同时在途的交易不超过 max_in_flight.
+    链上阶段跟不上时队列被填满, 上传线程阻塞等待, 不会无限制地积压已上传但未发布的文件.
+    每个文件的进度在发送前写入报告, 使用同一个报告再次运行时跳过已完成的步骤.
+    上传前先在本地计算UDFS哈希, 与事件索引(ContentContract.open_indexer)中已发布的udfs、报告中的其他文件
+    以及本次运行中的其他文件比较, 重复的内容既不上传也不发布.
+    """
+
+    def __init__(self, content_contract, udfs, report_path,
+                 upload_workers=UPLOAD_WORKERS,
+                 queue_size=QUEUE_SIZE,
+                 max_in_flight=16,
+                 timeout=None,
+                 skip_duplicates=True):
+        """
+        :param content_contract: ContentContract 对象
+        :param udfs: Udfs 对象
+        :param report_path: 发布报告文件路径
+        :param upload_workers: 并行上传的线程数
+        :param queue_size: 已上传等待发布的最大文件数
+        :param max_in_flight: 同时在途的最大交易数
+        :param timeout: 等待每笔交易回执的超时时间(秒)
+        :param skip_duplicates: 是否跳过内容已经发布过的文件
+        """
+        self.content_contract = content_contract
+        self.udfs = udfs
+        self.contract = content_contract.contract["AuthorModule"]
+        self.report = PublishReport(report_path)
+        self.upload_workers = upload_workers
+        self.timeout = timeout
+        self.skip_duplicates = skip_duplicates
+        self._queue = queue.Queue(queue_size)
+        self._window = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._pending = {}  # tx_hash -> 步骤名
+        self._hashes = {}  # udfs哈希 -> 步骤名, 本次运行和报告中已经上传的内容
+        self._idle = threading.Condition(self._lock)
+        self._stop = threading.Event()
+        self._deposit = None
+
+    @staticmethod
+    def _step(path):
+        return "file:" + os.path.abspath(path)
+
+    def _reconcile(self):
+        """ 核对报告中已发送但未确认的交易, 链上确认没有被节点接收的交易回到待发布状态
+        失败但没有回执证明的记录(如旧版本在发送超时后记录的失败)也要核对, 交易可能已经被节点接收
+        """
+        eth = self.content_contract.web3.eth
+        for record in self.report.files():
+            unproven = record["status"] == FAILED and record.get("tx_hash") and record.get("block_number") is None
+            if record["status"] != SENT and not unproven:
+                continue
+            receipt = eth.getTransactionReceipt(record["tx_hash"])
+            if receipt is not None:
+                self._finish(record["step"], receipt)
+            elif eth.getTransaction(record["tx_hash"]) is not None:
+                if record["status"] != SENT:
+                    self.report.record(record["step"], status=SENT)
+                self._window.acquire()
+                self._watch(record["step"], record["tx_hash"])
+            else:
+                self.report.record(record["step"], status=UPLOADED, tx_hash=None, nonce=None, error=None)
+
+    def _duplicate(self, step, filehash):
+        """ 检查内容是否重复, 不重复时登记为本步骤的内容
+        :return: 已发布资源的信息(资源id或简单声明的交易), 或者内容相同的另一个步骤; 不重复时返回None
+        """
+        indexer = self.content_contract.indexer
+        claims = indexer.claims_by_udfs(filehash) if indexer is not None else []
+        if claims:
+            claim = claims[0]
+            if "claim_id" in claim:
+                return {"claim_id": claim["claim_id"]}
+            return {"duplicate_of": claim["tx_hash"]}
+        with self._lock:
+            owner = self._hashes.setdefault(filehash, step)
+        if owner != step:
+            return {"duplicate_of": owner}
+        return None
+
+    def _upload(self, path, price, type_):
+        """上传阶段: 上传一个文件并放入发布队列, 队列满时阻塞"""
+        step = self._step(path)
+        if self._stop.is_set():
+            return
+        filehash = None
+        try:
+            if self.skip_duplicates:
+                filehash = self.udfs.content_hash(path)
+                duplicate = self._duplicate(step, filehash)
+                if duplicate is not None:
+                    log.info("{} is already published: {}, skipped".format(path, duplicate))
+                    self.report.record(step, status=DUPLICATE, udfs=filehash, price=price, type=type_, **duplicate)
+                    return
+            result = self.udfs.upload(path)
+            if not result:
+                raise ValueError("Not a file: {}".format(path))
+        except Exception as e:
+            log.error("upload {} fail: {}".format(path, e))
+            with self._lock:
+                if self._hashes.get(filehash) == step:
+                    del self._hashes[filehash]
+            self.report.record(step, status=FAILED, error="upload: {}".format(e), price=price, type=type_)
+            return
+        if self.skip_duplicates and result["Hash"] != filehash:
+            # 节点使用了不同的分块参数, 本地哈希无法用于去重
+            log.warning("udfs returned {} for {}, local hash is {}".format(result["Hash"], path, filehash))
+        self.report.record(step, status=UPLOADED, udfs=result["Hash"], price=price, type=type_)
+        self._queue.put(step)
+
+    def _send(self, step):
+        """ 发布阶段: 签名并发送一个 publish 交易, 发送前写入报告
+        发送失败时保持 sent 状态和已记录的交易hash(交易可能已经被节点接收), 下次运行时由 _reconcile 核对
+        """
+        cc = self.content_contract
+        record = self.report.get(step)
+        func = self.contract.functions.publish(record["udfs"], record["price"], record["type"])
+        if self._deposit is None:
+            self._deposit = self.contract.functions.getClaimDeposit().call()
+        tx = cc._build_transaction(func, value=self._deposit)
+
+        def sent(tx_hash, transaction):
+            self.report.record(step, status=SENT, tx_hash=tx_hash, nonce=transaction["nonce"])
+
+        try:
+            return send_signed(cc.web3.eth, cc.nonce_manager, cc.account.signTransaction, tx, before_send=sent)
+        except Exception as e:
+            self.report.record(step, error="publish: {}".format(e))
+            raise
+
+    def _watch(self, step, tx_hash):
+        with self._lock:
+            self._pending[tx_hash] = step
+        self.content_contract._track(tx_hash, "AuthorModule")
+        self.content_contract.receipts.watch(tx_hash, callback=self._resolve, timeout=self.timeout)
+
+    def _finish(self, step, receipt):
+        """ 从回执中取出 LogNewClaim 的资源id, publish 返回false时回执中只有 LogError
+        publish 返回false时押金不退回, 所以 LogError 的失败不会自动重试; 资源已存在(ObjExist)时记录为重复
+        """
+        block_number = receipt["blockNumber"]
+        if receipt.get("status") == 0:
+            self.report.record(step, status=FAILED, error="reverted", block_number=block_number)
+            return
+        errors = []
+        for event in self.content_contract.events.decode_receipt(receipt):
+            if event.event == "LogNewClaim":
+                claim_id = Web3.toHex(event.args["_claimId"])
+                self.report.record(step, status=DONE, claim_id=claim_id, block_number=block_number)
+                return
+            if event.event == "LogError":
+                errors.append(event.args["_errorNumber"])
+        status = DUPLICATE if OBJ_EXIST in errors else FAILED
+        log.warning("{} fail, LogError {}".format(step, errors))
+        self.report.record(step, status=status, error="LogError {}".format(errors), errors=errors,
+                           block_number=block_number)
+
+    def _resolve(self, tx_hash, receipt):
+        with self._lock:
+            step = self._pending[tx_hash]
+        if receipt is None:
+            # 超时的交易保持 sent 状态, 下次运行时核对
+            log.warning("{} is not in the chain after timeout, txHash: {}".format(step, tx_hash))
+        else:
+            self._finish(step, receipt)
+        with self._lock:
+            del self._pending[tx_hash]
+            self._idle.notify_all()
+        self._window.release()
+
+    def _uploader(self, uploaded, items):
+        """ 上传线程, 全部上传完成后向队列放入结束标记
+        :param uploaded: 之前已经上传、直接进入发布阶段的步骤
+        :param items: 需要上传的 (文件路径, 价格, 类型)
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        try:
+            for step in uploaded:
+                self._queue.put(step)
+            with ThreadPoolExecutor(max_workers=self.upload_workers) as pool:
+                for path, price, type_ in items:
+                    pool.submit(self._upload, path, price, type_)
+        finally:
+            self._queue.put(None)
+
+    def _index_published(self):
+        """同步事件索引, 并登记报告中已经上传的内容"""
+        indexer = self.content_contract.indexer
+        if indexer is not None:
+            try:
+                indexer.sync()
+            except Exception as e:
+                log.warning("sync event indexer fail: {}, duplicates are checked against the local index".format(e))
+        for record in self.report.files():
+            if record.get("udfs") and record["status"] != DUPLICATE:
+                self._hashes.setdefault(record["udfs"], record["step"])
+
+    def publish(self, items, default_type=1):
+        """ 发布
+        :param items: 可迭代的 (文件路径, 价格, 类型), 类型为None时使用 default_type
+        :return: 发布报告的汇总, 见 PublishReport.summary
+        """
+        self._reconcile()
+        self._stop.clear()
+        if self.skip_duplicates:
+            self._index_published()
+        uploaded, todo = [], []
+        for path, price, type_ in items:
+            type_ = default_type if type_ is None else type_
+            record = self.report.get(self._step(path))
+            if record is None:
+                todo.append((path, int(price), int(type_)))
+            elif record.get("errors") or str(record.get("error")).startswith("LogError"):
+                # 合约返回了错误(LogError), 押金已经被扣留, 不自动重试
+                continue
+            elif ((record["status"] == FAILED and record.get("udfs") is None)
+                  or (record["status"] == DUPLICATE and not self.skip_duplicates)):
+                todo.append((path, int(price), int(type_)))
+            elif record["status"] in (UPLOADED, FAILED):
+                # 已上传(或者交易回滚、被丢弃)的文件不需要重新上传, 直接进入发布阶段
+                self.report.record(record["step"], status=UPLOADED, price=int(price), type=int(type_),
+                                   tx_hash=None, nonce=None, block_number=None, error=None)
+                uploaded.append(record["step"])
+        uploader = threading.Thread(target=self._uploader, args=(uploaded, todo), name="publish-uploader")
+        uploader.daemon = True
+        uploader.start()
+        step = None
+        try:
+            while True:
+                step = self._queue.get()
+                if step is None:
+                    break
+                self._window.acquire()
+                try:
+                    tx_hash = self._send(step)
+                except Exception:
+                    self._window.release()
+                    raise
+                log.info("{} published, txHash: {}".format(step, tx_hash))
+                self._watch(step, tx_hash)
+        finally:
+            if step is not None:
+                # 发布阶段出错: 停止上传, 取出队列中剩余的文件(保持 uploaded 状态)直到结束标记
+                self._stop.set()
+                while self._queue.get() is not None:
+                    pass
+            uploader.join()
+        with self._lock:
+            while self._pending:
+                self._idle.wait()
+        return self.report.summary()
+
+    def publish_directory(self, path, price, type_=1):
+        """以相同的价格和类型发布目录下的所有文件"""
+        return self.publish((f, price, type_) for f in walk_directory(path))
+
+    def publish_manifest(self, path, default_type=1):
+        """发布清单中的文件, 见 read_manifest. 先读完整个清单, 有格式错误时不上传任何文件"""
+        return self.publish(list(read_manifest(path)), default_type)
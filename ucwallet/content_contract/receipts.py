@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/6
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 交易回执跟踪
+
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from web3.middleware.pythonic import receipt_formatter
+from web3.utils.datastructures import AttributeDict
+
+from ucwallet.content_contract.rpc import batch_request
+
+log = logging.getLogger("receipts")
+
+
+def format_receipt(raw):
+    """把节点返回的原始回执转换为与 web3.eth.getTransactionReceipt 相同的格式"""
+    return AttributeDict.recursive(receipt_formatter(raw))
+
+
+class ReceiptTracker(object):
+    """ 交易回执跟踪器
+    后台线程每出一个新块查询一次, 所有等待中的交易hash放在一个JSON-RPC批量请求中查询,
+    代替对每笔交易循环调用 getTransactionReceipt.
+    """
+
+    def __init__(self, web3, transport, poll_interval=1, timeout=600):
+        """
+        :param web3: Web3 对象, 用于查询最新块高
+        :param transport: Transport 对象或节点RPC地址, 用于批量请求
+        :param poll_interval: 检查新块的间隔(秒)
+        :param timeout: 默认等待超时时间(秒)
+        """
+        self.web3 = web3
+        self.transport = transport
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.pending = {}  # tx_hash -> (future, deadline)
+        self._fresh = False  # 上次查询之后是否有新加入的交易
+        self._last_block = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, tx_hash, callback=None, timeout=None):
+        """ 开始跟踪一笔交易
+        :param tx_hash: 交易hash
+        :param callback: 回调函数 callback(tx_hash, receipt), 超时时receipt为None
+        :param timeout: 超时时间(秒), 默认使用 self.timeout
+        :return: Future, 结果为交易回执, 超时时抛出 TimeoutError
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            if tx_hash in self.pending:
+                future = self.pending[tx_hash][0]
+            else:
+                future = Future()
+                self.pending[tx_hash] = (future, time.time() + timeout)
+                self._fresh = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="receipt-tracker")
+                self._thread.daemon = True
+                self._thread.start()
+        if callback is not None:
+            def done(f):
+                callback(tx_hash, None if f.exception() else f.result())
+
+            future.add_done_callback(done)
+        return future
+
+    def wait(self, tx_hash, timeout=None):
+        """阻塞等待交易回执"""
+        return self.watch(tx_hash, timeout=timeout).result()
+
+    def wait_all(self, tx_hashes, timeout=None):
+        """ 阻塞等待多笔交易的回执
+        :return: 与tx_hashes顺序一致的回执列表
+        """
+        futures = [self.watch(tx_hash, timeout=timeout) for tx_hash in tx_hashes]
+        return [f.result() for f in futures]
+
+    async def wait_async(self, tx_hash, timeout=None):
+        """在asyncio中等待交易回执: receipt = await tracker.wait_async(tx_hash)"""
+        return await asyncio.wrap_future(self.watch(tx_hash, timeout=timeout))
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.pending:
+                    self._thread = None
+                    return
+            try:
+                self._poll()
+            except Exception as e:
+                log.warning("poll receipts fail: {}".format(e))
+            self._expire()
+            time.sleep(self.poll_interval)
+
+    def _poll(self):
+        block = self.web3.eth.blockNumber
+        with self._lock:
+            if block == self._last_block and not self._fresh:
+                return
+            self._last_block = block
+            self._fresh = False
+            hashes = list(self.pending.keys())
+        results = batch_request(self.transport, [("eth_getTransactionReceipt", [h]) for h in hashes])
+        for tx_hash, (result, error) in zip(hashes, results):
+            if error is not None:
+                log.warning("get receipt of {} fail: {}".format(tx_hash, error))
+            elif result is not None:
+                self._resolve(tx_hash, format_receipt(result))
+
+    def _resolve(self, tx_hash, receipt):
+        with self._lock:
+            item = self.pending.pop(tx_hash, None)
+        if item is not None:
+            item[0].set_result(receipt)
+
+    def _expire(self):
+        now = time.time()
+        with self._lock:
+            expired = [h for h, (_, deadline) in self.pending.items() if deadline < now]
+            items = [self.pending.pop(h) for h in expired]
+        for tx_hash, (future, _) in zip(expired, items):
+            future.set_exception(TimeoutError("Transaction {} is not in the chain after timeout".format(tx_hash)))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/6
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : JSON-RPC 批量请求
+
+import itertools
+
+from eth_abi import decode_abi
+from hexbytes import HexBytes
+from web3.utils.abi import get_abi_output_types, map_abi_data
+from web3.utils.normalizers import BASE_RETURN_NORMALIZERS
+
+from ucwallet.transport import Transport, get_transport
+
+_request_id = itertools.count()
+
+
+class RPCError(Exception):
+    """节点对单个请求返回的错误"""
+
+    def __init__(self, error):
+        self.error = error
+        if isinstance(error, dict):
+            message = error.get("message", error)
+        else:
+            message = error
+        super(RPCError, self).__init__(message)
+
+
+def batch_request(transport, calls, timeout=None):
+    """ 把多个请求合并为一个JSON-RPC批量请求发送
+    :param transport: Transport 对象或节点RPC地址
+    :param calls: [(method, params), ...]
+    :param timeout: 请求超时时间(秒), 默认使用 transport 的设置
+    :return: 与calls顺序一致的列表, 每一项为 (result, error), error为None或RPCError
+    """
+    if not calls:
+        return []
+    payload = []
+    for method, params in calls:
+        payload.append({"jsonrpc": "2.0", "id": next(_request_id), "method": method, "params": params})
+    if not isinstance(transport, Transport):
+        transport = get_transport(transport)
+    response = transport.post(json=payload, timeout=timeout)
+    response.raise_for_status()
+    body = response.json()
+    if isinstance(body, dict):
+        # 节点不支持批量请求或整个请求出错
+        raise RPCError(body.get("error", body))
+    # 批量响应不保证顺序, 按id对应回去
+    by_id = {item.get("id"): item for item in body}
+    results = []
+    for request in payload:
+        item = by_id.get(request["id"])
+        if item is None:
+            results.append((None, RPCError("No response for {}".format(request["method"]))))
+        elif item.get("error") is not None:
+            results.append((None, RPCError(item["error"])))
+        else:
+            results.append((item.get("result"), None))
+    return results
+
+
+def to_block_param(block_identifier):
+    """把块号转换为JSON-RPC参数格式, 'latest'/'pending'/'earliest' 原样返回"""
+    if isinstance(block_identifier, int):
+        return hex(block_identifier)
+    return block_identifier
+
+
+def decode_call_result(fn_abi, return_data):
+    """ 按函数ABI解码 eth_call 的返回值, 规则与 ContractFunction.call() 一致
+    单个返回值直接返回该值, 多个返回值返回列表
+    """
+    output_types = get_abi_output_types(fn_abi)
+    data = decode_abi(output_types, HexBytes(return_data))
+    data = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, data)
+    if len(data) == 1:
+        return data[0]
+    return data
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/27
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 多进程离线签名. 交易签名是纯python的椭圆曲线运算, 批量发送时签名成为瓶颈,
+#            把签名分配到多个进程中并行执行
+import multiprocessing
+import os
+from collections import namedtuple
+
+from eth_account import Account
+from web3 import Web3
+
+# 签名后的交易, raw_transaction 和 hash 都是0x开头的十六进制字符串
+SignedRaw = namedtuple("SignedRaw", ["raw_transaction", "hash", "nonce"])
+
+# 工作进程中的账户, 私钥只在进程启动时传入一次, 之后的任务只传输交易
+_account = None
+
+
+def _init_worker(private_key):
+    global _account
+    _account = Account.privateKeyToAccount(private_key)
+
+
+def _sign(account, transactions):
+    results = []
+    for transaction in transactions:
+        signed = account.signTransaction(transaction)
+        results.append(SignedRaw(Web3.toHex(signed.rawTransaction), Web3.toHex(signed.hash), transaction["nonce"]))
+    return results
+
+
+def _sign_chunk(transactions):
+    return _sign(_account, transactions)
+
+
+def sign_serial(private_key, transactions):
+    """在当前进程中依次签名, 交易数量少时比启动进程池更快"""
+    return _sign(Account.privateKeyToAccount(private_key), transactions)
+
+
+class ParallelSigner(object):
+    """ 进程池签名器
+    进程池在第一次签名时启动并一直保留, 每个工作进程在启动时获得私钥.
+    交易按块分配给工作进程, 返回结果的顺序与输入一致.
+    """
+
+    def __init__(self, private_key, processes=None, chunk_size=None):
+        """
+        :param private_key: 签名使用的私钥
+        :param processes: 工作进程数, 默认为CPU核数
+        :param chunk_size: 每个任务包含的交易数, 默认按进程数平均分配
+        """
+        self.processes = processes if processes else os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._private_key = private_key
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=(self._private_key,))
+        return self._pool
+
+    def sign(self, transactions):
+        """ 签名一组交易
+        :param transactions: _build_transaction 构建的交易列表
+        :return: [SignedRaw, ...], 顺序与transactions一致
+        """
+        transactions = list(transactions)
+        if not transactions:
+            return []
+        size = self.chunk_size if self.chunk_size else -(-len(transactions) // (self.processes * 4))
+        chunks = [transactions[i:i + size] for i in range(0, len(transactions), size)]
+        results = []
+        for signed in self.pool.imap(_sign_chunk, chunks):
+            results.extend(signed)
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/5
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 流水线交易提交
+
+import threading
+from concurrent.futures import Future, TimeoutError
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class TransactionSubmitter(object):
+    """ 交易提交队列
+    调用者把合约调用放入队列, 发送线程按入队顺序分配连续的nonce, 签名后立即广播,
+    不等待上一笔交易上链. 同时在途(已发送未确认)的交易数量不超过 max_in_flight.
+    每笔交易对应一个 Future, 交易被打包后以回执作为结果.
+    """
+
+    def __init__(self, content_contract, max_in_flight=16, timeout=None):
+        """
+        :param content_contract: ContentContract 对象, 用于构建、签名和发送交易, 并通过它的回执跟踪器等待确认
+        :param max_in_flight: 同时在途的最大交易数
+        :param timeout: 等待单笔交易回执的超时时间(秒), 默认使用回执跟踪器的设置
+        """
+        self.content_contract = content_contract
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.pending = {}  # tx_hash -> (future, contract_name)
+        self._lock = threading.Lock()
+        self._window = threading.BoundedSemaphore(max_in_flight)
+        self._queue = queue.Queue()
+        self._closed = False
+        self._sender = threading.Thread(target=self._send_loop, name="tx-sender")
+        self._sender.daemon = True
+        self._sender.start()
+
+    def submit(self, func, contract_name=None, **kwargs):
+        """ 提交一个需要上链的合约调用
+        :param func: 已经传入参数的合约函数对象
+        :param contract_name: 合约名, 仅用于记录
+        :param kwargs: 传给 _build_transaction 的参数, 如 gas_limit, gas_price
+        :return: Future, 结果为交易回执. 发送后 future.tx_hash 为交易hash
+        """
+        if self._closed:
+            raise RuntimeError("The submitter has been closed.")
+        future = Future()
+        future.tx_hash = None
+        future.contract_name = contract_name
+        self._queue.put((future, func, contract_name, kwargs))
+        return future
+
+    def _send_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, func, contract_name, kwargs = item
+            self._window.acquire()
+            try:
+                tx = self.content_contract._build_transaction(func, **kwargs)
+                tx_hash = self.content_contract._sign_and_send_rawtransaction(transaction=tx)
+            except Exception as e:
+                self._window.release()
+                future.set_exception(e)
+                continue
+            future.tx_hash = tx_hash
+            with self._lock:
+                self.pending[tx_hash] = (future, contract_name)
+            self.content_contract._track(tx_hash, contract_name)
+            self.content_contract.receipts.watch(tx_hash, callback=self._resolve, timeout=self.timeout)
+
+    def _resolve(self, tx_hash, receipt):
+        with self._lock:
+            future, _ = self.pending.pop(tx_hash)
+        self._window.release()
+        if receipt is None:
+            future.set_exception(TimeoutError("Transaction {} is not in the chain after timeout".format(tx_hash)))
+        else:
+            future.set_result(receipt)
+
+    @property
+    def in_flight(self):
+        """已发送但还未确认的交易数"""
+        with self._lock:
+            return len(self.pending)
+
+    def close(self, wait=True):
+        """ 停止接收新的调用, 队列中已有的调用仍会被发送
+        :param wait: 是否等待所有交易确认
+        """
+        self._closed = True
+        self._queue.put(None)
+        if wait:
+            self._sender.join()
+            with self._lock:
+                futures = [f for f, _ in self.pending.values()]
+            for future in futures:
+                future.exception()
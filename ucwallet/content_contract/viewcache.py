@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/29
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 只读函数调用的本地缓存. 热门资源的 findClaimInfo/isSaleable/getGoodsInfo 等调用直接从内存返回,
+#            资源被修改或删除时根据 ClaimDB 的事件使对应的缓存失效
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from ucwallet.content_contract.logscanner import LogScanner
+
+log = logging.getLogger("viewcache")
+
+# 这些事件的参数(资源id、作者地址)出现在缓存的调用参数中时, 对应的缓存失效
+INVALIDATING_EVENTS = {
+    "ClaimDB": ["LogUpdateClaimUdfs", "LogUpdateClaimAuthor", "LogUpdateClaimPricing",
+                "LogUpdateClaimWaive", "LogDeleteClaim"],
+}
+MAX_SIZE = 4096
+TTL = 60
+REFRESH_INTERVAL = 2
+
+
+def _normalize(value):
+    """参数统一为可hash的值, bytes和十六进制字符串(资源id、地址)统一为小写的0x字符串"""
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + bytes(value).hex()
+    if isinstance(value, str) and value[:2].lower() == "0x":
+        return value.lower()
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalize(v) for v in value)
+    return value
+
+
+def _flatten(values):
+    for value in values:
+        if isinstance(value, tuple):
+            for v in _flatten(value):
+                yield v
+        else:
+            yield value
+
+
+class ViewCache(object):
+    """ 只读函数调用的LRU缓存
+    键为 (合约名, 函数名, 参数, 块). 指定块号的调用结果不会变化, 只按LRU淘汰; 最新块("latest")的结果
+    最多保存 ttl 秒, 并且每隔 refresh_interval 秒检查一次新块中的 INVALIDATING_EVENTS,
+    事件中的资源id或地址出现在某个缓存调用的参数中时, 该缓存失效. 节点回退到更早的块时清空缓存.
+    因此最新块的缓存最多落后链上 refresh_interval 秒(事件能覆盖的修改)或 ttl 秒(其他修改, 如合约配置).
+    """
+
+    def __init__(self, content_contract, maxsize=MAX_SIZE, ttl=TTL, refresh_interval=REFRESH_INTERVAL):
+        """
+        :param content_contract: 已加载合约的 ContentContract 对象
+        :param maxsize: 最多缓存的调用数
+        :param ttl: 最新块缓存的有效期(秒)
+        :param refresh_interval: 检查新块事件的间隔(秒)
+        """
+        self.content_contract = content_contract
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.scanner = LogScanner(content_contract, INVALIDATING_EVENTS, max_workers=1)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # 键 -> (结果, 过期时间)
+        self._refs = {}  # 参数值 -> 参数中包含它的最新块缓存键
+        self._head = None  # 已经检查过事件的最新块号
+        self._checked_at = 0
+        self._refreshing = False  # 是否有线程正在查询新块事件
+        self._lock = threading.RLock()
+
+    def needs_refresh(self):
+        """是否到了检查新块事件的时间"""
+        with self._lock:
+            return not self._refreshing and time.time() - self._checked_at >= self.refresh_interval
+
+    def refresh(self):
+        """ 检查上次检查之后的新块, 使被事件修改的缓存失效
+        查询块号和事件时不持有锁, 其他线程可以继续读取缓存; 同一时间只有一个线程在查询
+        """
+        with self._lock:
+            now = time.time()
+            if self._refreshing or now - self._checked_at < self.refresh_interval:
+                return
+            self._refreshing = True
+            start = self._head
+        events, error = [], None
+        try:
+            head = self.content_contract.web3.eth.blockNumber
+            if start is not None and head > start:
+                try:
+                    events = self.scanner.scan(start + 1, head)
+                except Exception as e:
+                    error = e
+        except Exception:
+            with self._lock:
+                self._refreshing = False
+            raise
+        with self._lock:
+            self._refreshing = False
+            if error is not None:
+                # 无法确定哪些缓存被修改, 全部丢弃
+                log.warning("fetch invalidating events fail: {}, clear the cache".format(error))
+                self._clear_latest()
+            elif start is not None and head < start:
+                log.warning("chain head moved back from {} to {}, clear the cache".format(start, head))
+                self._clear_latest()
+            for event in events:
+                self.invalidate(*event.args.values())
+            self._head = head
+            self._checked_at = now
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        if key[3] == "latest":
+            for value in _flatten(key[2]):
+                keys = self._refs.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._refs[value]
+
+    def _clear_latest(self):
+        for key in [k for k in self._entries if k[3] == "latest"]:
+            self._remove(key)
+
+    def get(self, key, refresh=True):
+        """ 读取缓存, 没有缓存或已过期时返回 (False, None)
+        :param refresh: 读取最新块缓存前是否检查新块事件, 调用者自己调用 refresh 时为False
+        """
+        if refresh and key[3] == "latest":
+            self.refresh()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[1] is not None and entry[1] <= time.time():
+                self._remove(key)
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._remove(key)
+            latest = key[3] == "latest"
+            self._entries[key] = (value, time.time() + self.ttl if latest else None)
+            if latest:
+                for arg in _flatten(key[2]):
+                    self._refs.setdefault(arg, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    @staticmethod
+    def key(contract_name, func, block_identifier="latest"):
+        """一个只读调用的缓存键"""
+        return contract_name, func.fn_name, _normalize(list(func.arguments)), block_identifier
+
+    def lookup(self, key, refresh=True):
+        """读取缓存并统计命中率, 返回 (是否命中, 结果)"""
+        found, value = self.get(key, refresh)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found, value
+
+    def call(self, contract_name, func, block_identifier="latest"):
+        """ 通过缓存调用只读函数
+        :param contract_name: 合约名
+        :param func: 已经传入参数的合约函数对象
+        :param block_identifier: 块号或 "latest"
+        """
+        key = self.key(contract_name, func, block_identifier)
+        found, value = self.lookup(key)
+        if found:
+            return value
+        value = func.call(block_identifier=block_identifier)
+        self.put(key, value)
+        return value
+
+    def invalidate(self, *values):
+        """使参数中包含这些值(资源id、地址等)的最新块缓存失效"""
+        with self._lock:
+            for value in values:
+                for key in list(self._refs.get(_normalize(value), ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._refs.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "head": self._head}
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/21
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 部署日志. 部署的每一步在发送交易前先写入日志, 中断后再次部署时从日志恢复
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger("deploy_journal")
+
+SENT = "sent"
+DONE = "done"
+FAILED = "failed"
+
+
+class DeployJournal(object):
+    """ 追加写入的部署日志(JSON Lines)
+    每行是某一步的一次状态变化, 同一步后写入的记录覆盖之前的字段. 每次写入后立即刷到磁盘,
+    进程在任何时候退出, 日志中都保留了已经签名的交易hash、nonce和已部署的合约地址.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: 日志文件路径
+        """
+        self.path = path
+        self.steps = {}  # 步骤名 -> 合并后的记录
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 写入时中断留下的不完整行
+                    log.warning("skip broken journal line: {}".format(line.strip()))
+                    continue
+                step = record["step"]
+                self.steps[step] = dict(self.steps.get(step, {}), **record)
+
+    def get(self, step):
+        """读取一步的记录, 没有记录时返回None"""
+        return self.steps.get(step)
+
+    def record(self, step, **fields):
+        """写入一步的状态变化"""
+        record = dict(fields, step=step)
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.steps[step] = dict(self.steps.get(step, {}), **record)
+
+    def archive(self):
+        """ 部署全部完成后归档日志(改名为 <日志>.done, 只保留最近一次), 下次部署不再从这份日志恢复
+        """
+        with self._lock:
+            if os.path.isfile(self.path):
+                os.replace(self.path, self.path + ".done")
+            self.steps = {}
+
+    def clear(self):
+        """删除日志, 下次部署从头开始"""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.steps = {}
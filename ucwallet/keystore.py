@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/28
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : keystore解密缓存. keystore默认使用scrypt(n=262144)派生密钥, 每次解密要几百毫秒到几秒,
+#            同一进程中解密过的keystore在有效期内直接复用私钥; 服务账户可以用较小的KDF参数重新加密
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger("keystore")
+
+DEFAULT_TTL = 15 * 60  # 解密结果的默认有效期(秒)
+
+
+def load_keystore(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _fingerprint(wallet, password):
+    """keystore内容和密码的摘要, 缓存中不保存密码本身"""
+    password = password if isinstance(password, bytes) else str(password).encode("utf-8")
+    content = json.dumps(wallet, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(content + b"\0" + password).digest()
+
+
+def _address(wallet):
+    address = wallet.get("address", "")
+    return address.lower()[2:] if address.lower().startswith("0x") else address.lower()
+
+
+class KeyCache(object):
+    """ 解密后的私钥缓存
+    按keystore中的地址保存 (私钥, keystore和密码的摘要, 过期时间). 同一个keystore和密码在有效期内再次解密时
+    直接返回私钥; 密码错误或keystore内容不同时重新解密, 解密失败的结果不缓存.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        """
+        :param ttl: 默认有效期(秒), 为0时不缓存
+        """
+        self.ttl = ttl
+        self._keys = {}  # 地址 -> (私钥, 摘要, 过期时间)
+        self._lock = threading.Lock()
+
+    def _get(self, address):
+        entry = self._keys.get(address)
+        if entry is None:
+            return None
+        if entry[2] <= time.time():
+            del self._keys[address]
+            return None
+        return entry
+
+    def unlock(self, wallet, password, ttl=None):
+        """ 解密keystore, 返回私钥(bytes)
+        :param wallet: keystore的内容(dict)
+        :param password: keystore的密码
+        :param ttl: 这次解密结果的有效期(秒), 默认使用 self.ttl
+        """
+        from eth_account import Account
+
+        ttl = self.ttl if ttl is None else ttl
+        address = _address(wallet)
+        fingerprint = _fingerprint(wallet, password)
+        with self._lock:
+            entry = self._get(address)
+            if entry is not None and hmac.compare_digest(entry[1], fingerprint):
+                return entry[0]
+        private_key = bytes(Account.decrypt(wallet, password))
+        if ttl > 0:
+            with self._lock:
+                self._keys[address] = (private_key, fingerprint, time.time() + ttl)
+        return private_key
+
+    def get(self, address):
+        """已解锁的地址对应的私钥, 没有解锁或已过期时返回None"""
+        address = _address({"address": address})
+        with self._lock:
+            entry = self._get(address)
+        return entry[0] if entry is not None else None
+
+    def lock(self, address=None):
+        """清除某个地址的私钥, address为None时清除全部"""
+        with self._lock:
+            if address is None:
+                self._keys.clear()
+            else:
+                self._keys.pop(_address({"address": address}), None)
+
+    def unlocked(self):
+        """有效期内的地址 -> 剩余秒数"""
+        now = time.time()
+        with self._lock:
+            return {"0x" + address: int(entry[2] - now) for address, entry in self._keys.items() if entry[2] > now}
+
+
+# 进程内共用的缓存, ContentContract 和 Deploy 都通过它解密keystore
+key_cache = KeyCache()
+
+
+def unlock_keystore(wallet, password, ttl=None):
+    """ 通过进程内缓存解密keystore
+    :param wallet: keystore文件路径或内容(dict)
+    :return: 私钥(bytes)
+    """
+    if not isinstance(wallet, dict):
+        wallet = load_keystore(wallet)
+    return key_cache.unlock(wallet, password, ttl=ttl)
+
+
+def reencrypt_keystore(path, password, new_password=None, kdf="scrypt", work_factor=None, output=None):
+    """ 用新的KDF参数重新加密keystore
+    服务账户每次启动都要解密, 可以用较小的 scrypt n(如 2**14) 或 pbkdf2 迭代次数换取解锁速度,
+    代价是密码被暴力破解的难度同比降低, 只适合keystore文件本身受到保护的场合.
+    :param path: keystore文件路径
+    :param password: 原密码
+    :param new_password: 新密码, 默认不变
+    :param kdf: "scrypt" 或 "pbkdf2"
+    :param work_factor: scrypt的n(必须是2的幂)或pbkdf2的迭代次数, 默认使用 eth_keyfile 的默认值
+    :param output: 新keystore的保存路径, 默认覆盖原文件
+    :return: 新keystore的内容
+    """
+    from eth_account import Account
+    from eth_keyfile import create_keyfile_json
+
+    if kdf not in ("scrypt", "pbkdf2"):
+        raise ValueError("kdf must be scrypt or pbkdf2.")
+    if work_factor is not None:
+        work_factor = int(work_factor)
+        if kdf == "scrypt" and (work_factor < 2 or work_factor & (work_factor - 1)):
+            raise ValueError("scrypt work factor must be a power of 2.")
+    new_password = new_password if new_password else password
+    private_key = bytes(Account.decrypt(load_keystore(path), password))
+    password_bytes = new_password if isinstance(new_password, bytes) else str(new_password).encode("utf-8")
+    wallet = create_keyfile_json(private_key, password_bytes, kdf=kdf, iterations=work_factor)
+    # 写入前确认新keystore可以解密出相同的私钥
+    if bytes(Account.decrypt(wallet, new_password)) != private_key:
+        raise ValueError("Re-encrypted keystore does not match the original key.")
+    output = output if output else path
+    tmp = output + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(wallet, f)
+    os.replace(tmp, output)
+    key_cache.lock(wallet["address"])
+    log.info("re-encrypt keystore {} with {} {}".format(output, kdf, wallet["crypto"]["kdfparams"]))
+    return wallet
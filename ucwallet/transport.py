@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016-2018 The Ulord Core Developers
+#
+# @Date    : 2018/9/12
+# @Author  : Shu [Ulord DevTeam]
+# @Email   : httpservlet@yeah.net
+# @Des     : 共享的HTTP传输层. ContentContract、Deploy 和 Udfs 共用带连接池的keep-alive连接,
+#            统一设置超时和重试, 并支持在多个侧链RPC节点之间轮询或按延迟选择
+import itertools
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import MaxRetryError, NewConnectionError
+from requests.packages.urllib3.util.retry import Retry
+from web3 import HTTPProvider
+
+import dconfig
+
+log = logging.getLogger("transport")
+
+ROUND_ROBIN = "round_robin"
+LEAST_LATENCY = "least_latency"
+
+# 请求失败的节点在选择时加上的延迟惩罚(秒)
+FAILURE_PENALTY = 10
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """没有指定timeout的请求使用默认超时时间"""
+
+    def __init__(self, timeout=None, *args, **kwargs):
+        self.timeout = timeout
+        super(TimeoutHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super(TimeoutHTTPAdapter, self).send(request, **kwargs)
+
+
+def _connect_failed(error):
+    """请求是否在建立连接时失败(请求还没有发出), 只有这种情况可以安全地重试或切换节点"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, NewConnectionError)
+
+
+class Transport(object):
+    """ 一组节点共用的HTTP连接池
+    建立连接失败时按退避时间重试, 仍然失败则切换到下一个节点.
+    请求发出之后的错误(读超时、连接中断、502/503/504)不重试也不切换节点, 因为JSON-RPC都是POST,
+    请求(例如发送交易)可能已经被节点处理.
+    """
+
+    def __init__(self, endpoints,
+                 pool_size=dconfig.POOL_SIZE,
+                 timeout=dconfig.REQUEST_TIMEOUT,
+                 retries=dconfig.RETRIES,
+                 backoff=dconfig.BACKOFF,
+                 strategy=dconfig.ENDPOINT_STRATEGY):
+        """
+        :param endpoints: 节点地址或节点地址列表
+        :param pool_size: 每个节点的连接池大小
+        :param timeout: 请求超时时间(秒)
+        :param retries: 建立连接失败时的重试次数, 幂等请求(GET)返回502/503/504时也重试
+        :param backoff: 重试退避系数, 第n次重试前等待 backoff * 2^(n-1) 秒
+        :param strategy: 节点选择策略, round_robin 或 least_latency
+        """
+        if isinstance(endpoints, str):
+            endpoints = [endpoints]
+        if not endpoints:
+            raise ValueError("At least one endpoint is required.")
+        if strategy not in (ROUND_ROBIN, LEAST_LATENCY):
+            raise ValueError('"{}" not a valid endpoint strategy.'.format(strategy))
+        self.endpoints = list(endpoints)
+        self.timeout = timeout
+        self.strategy = strategy
+        self.latency = {endpoint: 0.0 for endpoint in self.endpoints}  # 平滑后的请求延迟
+        self._cycle = itertools.cycle(self.endpoints)
+        self._lock = threading.Lock()
+
+        # 状态码重试只用于默认的幂等方法, 不包括POST
+        retry = Retry(total=retries, connect=retries, read=0, status=retries,
+                      backoff_factor=backoff, status_forcelist=(502, 503, 504),
+                      raise_on_status=False)
+        adapter = TimeoutHTTPAdapter(timeout=timeout, pool_connections=len(self.endpoints),
+                                     pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._pool_size = pool_size
+        self._stream_session = None
+
+    @property
+    def stream_session(self):
+        """ 同一组节点的另一个连接池, 没有默认超时, 也不重试
+        用于请求体是生成器的流式上传(如ipfsapi的 /add), 请求体只能读取一次, 大文件上传的时间也不固定
+        """
+        with self._lock:
+            if self._stream_session is None:
+                adapter = HTTPAdapter(pool_connections=len(self.endpoints), pool_maxsize=self._pool_size,
+                                      max_retries=Retry(total=0, read=False, raise_on_status=False))
+                self._stream_session = requests.Session()
+                self._stream_session.mount("http://", adapter)
+                self._stream_session.mount("https://", adapter)
+            return self._stream_session
+
+    def select(self):
+        """按策略选择一个节点"""
+        with self._lock:
+            if self.strategy == LEAST_LATENCY:
+                return min(self.endpoints, key=lambda e: self.latency[e])
+            return next(self._cycle)
+
+    def _candidates(self):
+        first = self.select()
+        return [first] + [e for e in self.endpoints if e != first]
+
+    def _record(self, endpoint, cost):
+        with self._lock:
+            self.latency[endpoint] = self.latency[endpoint] * 0.8 + cost * 0.2
+
+    def post(self, endpoint=None, **kwargs):
+        """ 发送POST请求, 建立连接失败时切换到其他节点, 请求发出之后的错误直接抛出
+        :param endpoint: 指定节点, 默认按策略选择
+        :param kwargs: 传给 requests.Session.post 的参数
+        """
+        candidates = [endpoint] if endpoint else self._candidates()
+        error = None
+        for candidate in candidates:
+            start = time.time()
+            try:
+                response = self.session.post(candidate, **kwargs)
+            except requests.ConnectionError as e:
+                self._record(candidate, FAILURE_PENALTY)
+                if not _connect_failed(e):
+                    raise
+                log.warning("request {} fail: {}".format(candidate, e))
+                error = e
+                continue
+            self._record(candidate, time.time() - start)
+            return response
+        raise error
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """通过 Transport 发送请求的web3 HTTPProvider"""
+
+    def __init__(self, transport, request_kwargs=None):
+        self.transport = transport
+        super(PooledHTTPProvider, self).__init__(transport.endpoints[0], request_kwargs=request_kwargs)
+
+    def __str__(self):
+        return "RPC connection {0}".format(", ".join(self.transport.endpoints))
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        response = self.transport.post(data=request_data, **self.get_request_kwargs())
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+
+def get_transport(endpoints=None, **kwargs):
+    """ 获取一组节点共用的 Transport, 同一组节点在进程内只创建一次
+    :param endpoints: 节点地址或节点地址列表, 默认为 dconfig.providers
+    :param kwargs: 第一次创建时传给 Transport 的参数
+    """
+    if endpoints is None:
+        endpoints = dconfig.providers
+    if isinstance(endpoints, str):
+        endpoints = [endpoints]
+    key = tuple(endpoints)
+    with _transports_lock:
+        transport = _transports.get(key)
+        if transport is None:
+            transport = _transports[key] = Transport(list(endpoints), **kwargs)
+        return transport
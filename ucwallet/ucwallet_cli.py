@@ -6,22 +6,18 @@
 import copy
 import sys
 import os
+import json
 import logging
 import inspect
+import threading
 import traceback
+from concurrent.futures import Future
 
 import click
-from prompt_toolkit import PromptSession
-from prompt_toolkit.history import FileHistory  # 历史记录
-from prompt_toolkit.auto_suggest import AutoSuggestFromHistory  # 自动联想
-from prompt_toolkit.completion import WordCompleter  # 词汇建议
-
-from deploy_contract import Deploy
 
 sys.path.insert(0, os.path.dirname(os.getcwd()))
+import dconfig
 from ucwallet import __version__
-from ucwallet.content_contract import ContentContract
-from ucwallet.udfs.udfs import Udfs
 from ucwallet.version import PACKAGE_ROOT
 
 
@@ -32,19 +28,107 @@ class UCwallet():
     history = None
 
     def __init__(self, keystore_file, keystore_pwd, **kwargs):
-        """init a ucwallet"""
-        self.content_contract = ContentContract(
-            keystore_file=keystore_file,
-            keystore_pwd=keystore_pwd,
-            **kwargs
-        )
-        self.udfs_helper = Udfs()
+        """
+        init a ucwallet
+
+        The keystore is decrypted here, so a wrong file or password fails at start-up.
+        The content contract (web3) and the udfs helper are created on first use.
+        The interactive shell starts creating the contract in the background while it waits for the
+        first command, so the prompt does not wait for web3 to import.
+        """
+        if keystore_file and keystore_pwd and not kwargs.get("private_key"):
+            kwargs["private_key"] = self._unlock(keystore_file, keystore_pwd)
+            keystore_file, keystore_pwd = None, None
+        self._contract_kwargs = dict(keystore_file=keystore_file, keystore_pwd=keystore_pwd, **kwargs)
+        self._content_contract = None
+        self._contract_future = None
+        self._commands_synced = False
+        self._udfs_helper = None
+        self._loader_lock = threading.Lock()
         self.reload_contract()
 
+    @staticmethod
+    def _unlock(keystore_file, keystore_pwd):
+        """decrypt the keystore, a bare file name is looked up in content_contract/resources/keystore"""
+        from ucwallet.keystore import unlock_keystore
+        if not os.path.isfile(keystore_file):
+            keystore_file = os.path.join(PACKAGE_ROOT, 'content_contract', 'resources', 'keystore', keystore_file)
+            if not os.path.isfile(keystore_file):
+                raise ValueError("Wallet file not a valid path.")
+        return unlock_keystore(keystore_file, keystore_pwd)
+
+    def _start_loading(self):
+        """create the content contract in a background thread, only once"""
+        with self._loader_lock:
+            if self._contract_future is None:
+                self._contract_future = Future()
+                loader = threading.Thread(target=self._load_contract, args=(self._contract_future,),
+                                          name="ucwallet-loader")
+                loader.daemon = True
+                loader.start()
+        return self._contract_future
+
+    def _load_contract(self, future):
+        # 后台线程只创建合约对象, 命令列表和日志等界面状态由主线程更新, 见 _sync_commands
+        try:
+            from ucwallet.content_contract import ContentContract
+            future.set_result(ContentContract(**self._contract_kwargs))
+        except Exception as e:
+            future.set_exception(e)
+
+    @property
+    def content_contract(self):
+        """ContentContract, waits for the background loading"""
+        if self._content_contract is None:
+            self._content_contract = self._start_loading().result()
+        return self._content_contract
+
+    def _sync_commands(self):
+        """
+        refresh the command list from the loaded contract, called on the main thread between prompts
+
+        The contracts may differ from the index file read at start-up (e.g. a stale index).
+        """
+        future = self._contract_future
+        if self._commands_synced or future is None or not future.done() or future.exception() is not None:
+            return
+        self._content_contract = future.result()
+        self._commands_synced = True
+        for name in self._contract_functions():
+            self.__setattr__(name, self._contract)
+        self._get_commands()
+        self.COMMANDS = None
+
+    @property
+    def udfs_helper(self):
+        if self._udfs_helper is None:
+            from ucwallet.udfs.udfs import Udfs
+            self._udfs_helper = Udfs()
+        return self._udfs_helper
+
+    def _contract_functions(self):
+        """
+        contract name -> function names
+
+        Uses the ABI index of the loaded contract, or reads the index and address files directly
+        before it is loaded, which needs neither web3 nor the contract objects.
+        """
+        cc = self._content_contract
+        if cc is not None:
+            return {name: cc.abi_index["contracts"][name]["functions"] for name in cc.contract}
+        try:
+            with open(os.path.join(dconfig.CURR_DIR, "contractAddresses.json")) as f:
+                addresses = json.load(f)
+            with open(os.path.join(dconfig.CURR_DIR, "abi", "abi_index.json")) as f:
+                contracts = json.load(f)["contracts"]
+        except (OSError, ValueError, KeyError):
+            return {}
+        return {name: contracts[name]["functions"] for name in addresses if name in contracts}
+
     def reload_contract(self):
         """reload the contract file"""
         try:
-            for name, cont in self.content_contract.contract.items():
+            for name in self._contract_functions():
                 self.__setattr__(name, self._contract)
         except Exception as err:
             print(err)
@@ -53,15 +137,14 @@ class UCwallet():
 
     def _get_commands(self):
         """Get current commands"""
-        basic_commands = [command[0] for command in inspect.getmembers(self, predicate=inspect.ismethod) if
+        # 从类中查找命令, 不访问实例属性, 避免触发 content_contract 的加载
+        basic_commands = [command[0] for command in inspect.getmembers(type(self), predicate=inspect.isfunction) if
                           not command[0].startswith('_')]
+        functions = self._contract_functions()
+        basic_commands.extend(functions)
         self.basic_commands = copy.deepcopy(basic_commands)
-        try:
-            for name, cont in self.content_contract.contract.items():
-                func_names = list(cont.abi.keys())
-                basic_commands.extend(func_names)
-        except:
-            pass
+        for names in functions.values():
+            basic_commands.extend(names)
         # 去重
         self.BASIC_COMMANDS = list(set(basic_commands))
 
@@ -81,7 +164,14 @@ class UCwallet():
         )
 
         self._get_commands()
-        self.COMMANDS = WordCompleter(self.BASIC_COMMANDS)
+        self.COMMANDS = None
+
+    def _completer(self):
+        """Build the command completer, prompt_toolkit is imported when the prompt starts"""
+        if self.COMMANDS is None:
+            from prompt_toolkit.completion import WordCompleter  # 词汇建议
+            self.COMMANDS = WordCompleter(self.BASIC_COMMANDS)
+        return self.COMMANDS
 
     @staticmethod
     def _info(info):
@@ -110,19 +200,25 @@ class UCwallet():
 
     def _run_cli(self):
         """Interactive shell operation"""
+        from prompt_toolkit import PromptSession
+        from prompt_toolkit.auto_suggest import AutoSuggestFromHistory  # 自动联想
+        # 等待输入时在后台加载合约
+        self._start_loading()
         try:
             session = PromptSession()
             while True:
                 # 运行命令
                 try:
+                    self._sync_commands()
                     command = session.prompt(
                         message='ucwallet>',
                         # history=FileHistory(self.history), removed in v2.0, auto done.
                         auto_suggest=AutoSuggestFromHistory(),
-                        completer=self.COMMANDS,
+                        completer=self._completer(),
                     )
                     # command 为用户输入
                     commands = command.split(' ')
+                    self._sync_commands()
                     if commands[0] not in self.basic_commands:
                         self._error('error command {}'.format(commands[0]))
                     else:
@@ -165,6 +261,18 @@ class UCwallet():
         """Reload the private key file and password"""
         return self.content_contract.set_account_from_wallet(wallet_file=keystorefile, wallet_password=keystore_pwd)
 
+    def lock_wallet(self):
+        """Forget the decrypted keystores, the next login decrypts the keystore again"""
+        from ucwallet.keystore import key_cache
+        key_cache.lock()
+        return "Success"
+
+    def reencrypt_keystore(self, keystorefile, keystore_pwd, kdf="scrypt", work_factor=None, output=None):
+        """Re-encrypt a keystore with new kdf parameters, e.g. scrypt 16384 unlocks faster for service accounts"""
+        from ucwallet.keystore import reencrypt_keystore
+        wallet = reencrypt_keystore(keystorefile, keystore_pwd, kdf=kdf, work_factor=work_factor, output=output)
+        return wallet["crypto"]["kdfparams"]
+
     def login_by_private_key(self, key, wallet_password=None):
         """Reload the private key"""
         return self.content_contract.set_account_from_privatekey(key, wallet_password)
@@ -174,19 +282,42 @@ class UCwallet():
         return self.content_contract.get_gas_balance(address)
 
     def upload(self, file_path):
-        """Upload the file and get the hash """
-        return self.udfs_helper.upload(file_path)
+        """Upload the file and get the hash. Skipped if the content is already published (after find_published)"""
+        indexer = self.content_contract.indexer
+        return self.udfs_helper.upload(file_path, published=indexer.is_published if indexer else None)
+
+    def find_published(self, file_path):
+        """Compute the udfs hash of a file locally and list the claims already published with it"""
+        filehash = self.udfs_helper.content_hash(file_path)
+        indexer = self.content_contract.open_indexer()
+        indexer.sync()
+        return {"Hash": filehash, "Claims": indexer.claims_by_udfs(filehash)}
+
+    def upload_large(self, file_path, chunk_size=4194304, workers=4):
+        """Upload a large file in chunks concurrently and get the root hash"""
+        def progress(uploaded, total):
+            click.echo("\r{}/{} bytes".format(uploaded, total), nl=False)
+
+        result = self.udfs_helper.upload_stream(file_path, chunk_size=int(chunk_size), max_workers=int(workers),
+                                                progress=progress)
+        click.echo("")
+        return result
 
     def download_hash(self, filehash, filepath=None, Debug=False):
         """Download files from udfs"""
         return self.udfs_helper.downloadhash(filehash, filepath, Debug)
 
-    def deploy_contract(self):
-        """Deploying Ushare contracts"""
+    def deploy_contract(self, *options):
+        """Deploying Ushare contracts, resume an interrupted deploy unless --fresh is given"""
+        unknown = [o for o in options if o != "--fresh"]
+        if unknown:
+            raise ValueError("unknown option {}".format(" ".join(unknown)))
+        from deploy_contract import Deploy
         d = Deploy(
             config="deploy_contract.json",
             spath="sols",
             privateKey=self.content_contract.account.privateKey,
+            resume="--fresh" not in options,
         )
         d.deploy()
         self.content_contract.reloading_contract()
@@ -217,6 +348,13 @@ class UCwallet():
         """Obtain receipt of transaction"""
         return self.content_contract.get_for_receipt(tx_hash=tx_hash)
 
+    def wait_receipt(self, tx_hash=None, timeout=600):
+        """Wait until the transaction is mined and return its receipt. Default is the last transaction"""
+        tx_hash = tx_hash if tx_hash else self.content_contract.last_tx
+        if tx_hash is None:
+            return None
+        return self.content_contract.wait_for_receipt(tx_hash, timeout=float(timeout))
+
     def transfer_gas(self, to_address, value):
         """transfer gas"""
         return self.content_contract.transfer_gas(to_address=to_address, value=value)
@@ -227,6 +365,43 @@ class UCwallet():
         qualitys = qualitys.split(',')
         return self.content_contract.transfer_tokens(addresses=addresses, qualitys=qualitys)
 
+    def enable_view_cache(self, ttl=60):
+        """Serve view function calls from a local cache, invalidated by claim update/delete events"""
+        return self.content_contract.enable_view_cache(ttl=float(ttl)).stats()
+
+    def enable_account_pool(self, keystore_pwd, min_balance=None, refill_amount=None):
+        """Send transactions from all keystores in resources/keystore, the current account refills their gas (ether)"""
+        from web3 import Web3
+        pool = self.content_contract.enable_account_pool(
+            password=keystore_pwd,
+            min_balance=Web3.toWei(min_balance, "ether") if min_balance else None,
+            refill_amount=Web3.toWei(refill_amount, "ether") if refill_amount else None,
+        )
+        return pool.status()
+
+    def disable_account_pool(self):
+        """Send transactions from the current account only"""
+        self.content_contract.disable_account_pool()
+        return "Success"
+
+    def bulk_transfer_tokens(self, csv_file, report_file=None):
+        """Settle the recipients in a csv file (address,amount per line) in gas-bounded batches. Resumable"""
+        report_file = report_file if report_file else csv_file + ".report"
+        return self.content_contract.bulk_transfer_tokens(csv_file, report_file)
+
+    def publish_catalogue(self, source, price=0, type=1, report_file=None):
+        """Upload and publish every file in a directory (all at price/type) or a csv manifest (path,price[,type] per line). Resumable"""
+        from ucwallet.content_contract.publish import BulkPublisher
+
+        report_file = report_file if report_file else source.rstrip("/\\") + ".publish"
+        publisher = BulkPublisher(self.content_contract, self.udfs_helper, report_file)
+        if os.path.isdir(source):
+            summary = publisher.publish_directory(source, int(price), int(type))
+        else:
+            summary = publisher.publish_manifest(source, int(type))
+        publisher.report.export_csv(report_file + ".csv")
+        return summary
+
     # def transfer_ownership(self, address):
     #     return self.content_contract.transfer_ownership(address)
 
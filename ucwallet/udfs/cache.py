@@ -0,0 +1,234 @@
+# coding=utf-8
+# Copyright (c) 2016-2018 The Ulord Core Developers
+# @File  : cache.py
+# @Author: Shu [Ulord DevTeam]
+# @Date  : 2018/9/30
+"""
+UDFS对象的本地缓存. 文件按UDFS哈希保存在用户数据目录下, 重复下载同一个资源时直接从本地磁盘复制.
+每个对象旁边保存内容的sha256, 读取时校验, 校验失败的对象被删除; 总大小超过上限时按最近使用时间淘汰.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger("udfs")
+
+CHECKSUM_SUFFIX = ".sha256"
+READ_SIZE = 1024 * 1024
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_checksum(path):
+    """读取对象的校验和文件, 不存在时返回None"""
+    try:
+        with open(path + CHECKSUM_SUFFIX) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _link_or_copy(src, dst):
+    """优先使用硬链接, 不在同一个文件系统或不支持时复制"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class CacheWriter(object):
+    """ 边上传边写入缓存的临时文件
+    上传成功后用 commit(哈希) 放入缓存, 失败时 abort() 删除
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        fd, self.path = tempfile.mkstemp(dir=cache.tmp_dir)
+        self._file = os.fdopen(fd, "wb")
+        self._digest = hashlib.sha256()
+
+    def write(self, data):
+        self._file.write(data)
+        self._digest.update(data)
+
+    def commit(self, filehash):
+        self._file.close()
+        self.cache._add(filehash, self.path, self._digest.hexdigest())
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UdfsCache(object):
+    """ 内容寻址的本地缓存
+    对象保存为 objects/<哈希后两位>/<哈希>, 校验和保存为同名的 .sha256 文件.
+    索引只在内存中, 启动时扫描目录重建, 按文件修改时间恢复使用顺序(命中时更新修改时间).
+    """
+
+    def __init__(self, cache_dir, max_size, verify=True):
+        """
+        :param cache_dir: 缓存目录
+        :param max_size: 缓存的总大小上限(字节)
+        :param verify: 读取时是否校验内容
+        """
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, "objects")
+        self.tmp_dir = os.path.join(cache_dir, "tmp")
+        self.max_size = max_size
+        self.verify = verify
+        self.size = 0
+        self._index = OrderedDict()  # 哈希 -> 大小, 最近使用的在最后
+        self._lock = threading.RLock()
+        self.rebuild()
+
+    def _path(self, filehash):
+        return os.path.join(self.objects_dir, filehash[-2:], filehash)
+
+    def rebuild(self):
+        """扫描缓存目录重建索引, 删除没有校验和的对象和上次中断留下的临时文件"""
+        with self._lock:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            os.makedirs(self.tmp_dir, exist_ok=True)
+            os.makedirs(self.objects_dir, exist_ok=True)
+            entries = []
+            for dirpath, _, filenames in os.walk(self.objects_dir):
+                names = set(filenames)
+                for name in names:
+                    path = os.path.join(dirpath, name)
+                    if name.endswith(CHECKSUM_SUFFIX):
+                        if name[:-len(CHECKSUM_SUFFIX)] not in names:
+                            os.remove(path)
+                        continue
+                    if name + CHECKSUM_SUFFIX not in names:
+                        os.remove(path)
+                        continue
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, name, stat.st_size))
+            self._index.clear()
+            self.size = 0
+            for _, name, size in sorted(entries):
+                self._index[name] = size
+                self.size += size
+            self._evict()
+
+    def _remove(self, filehash):
+        size = self._index.pop(filehash, None)
+        if size is not None:
+            self.size -= size
+        path = self._path(filehash)
+        for p in (path, path + CHECKSUM_SUFFIX):
+            if os.path.exists(p):
+                os.remove(p)
+
+    def _evict(self):
+        while self.size > self.max_size and self._index:
+            filehash = next(iter(self._index))
+            log.info("evict {} from udfs cache".format(filehash))
+            self._remove(filehash)
+
+    def _add(self, filehash, tmp_path, checksum):
+        """把临时文件放入缓存"""
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            if size > self.max_size:
+                os.remove(tmp_path)
+                return False
+            self._remove(filehash)
+            path = self._path(filehash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + CHECKSUM_SUFFIX, "w") as f:
+                f.write(checksum)
+            os.replace(tmp_path, path)
+            self._index[filehash] = size
+            self.size += size
+            self._evict()
+            return filehash in self._index
+
+    def __contains__(self, filehash):
+        with self._lock:
+            return filehash in self._index
+
+    def get(self, filehash):
+        """ 读取缓存的对象
+        校验在锁外进行, 大对象的校验不会阻塞其他缓存操作
+        :return: 缓存文件的路径, 不在缓存中或校验失败时返回None
+        """
+        with self._lock:
+            if filehash not in self._index:
+                return None
+            path = self._path(filehash)
+        if self.verify:
+            expected = _read_checksum(path)
+            try:
+                valid = expected is not None and _sha256_file(path) == expected
+            except OSError:
+                valid = False
+            if not valid:
+                with self._lock:
+                    # 校验期间对象可能已被淘汰或重新写入, 只删除校验过的那一份
+                    if filehash in self._index and _read_checksum(path) in (expected, None):
+                        log.warning("udfs cache object {} is corrupted, removed".format(filehash))
+                        self._remove(filehash)
+                return None
+        with self._lock:
+            if filehash not in self._index:
+                return None
+            self._index.move_to_end(filehash)
+            try:
+                os.utime(path)
+            except OSError:
+                return None
+            return path
+
+    def copy_to(self, filehash, target):
+        """ 把缓存的对象复制到target, 命中时返回True
+        复制前对象可能被其他线程淘汰, 此时按未命中处理
+        """
+        path = self.get(filehash)
+        if path is None:
+            return False
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            shutil.copyfile(path, target)
+        except FileNotFoundError:
+            if os.path.exists(path):
+                raise
+            if os.path.exists(target):
+                os.remove(target)
+            return False
+        return True
+
+    def put_file(self, filehash, source):
+        """把一个已经存在的文件放入缓存"""
+        fd, tmp = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(fd)
+        os.remove(tmp)
+        _link_or_copy(source, tmp)
+        # 硬链接与原文件共用数据, 原文件之后被修改时读取校验会发现
+        return self._add(filehash, tmp, _sha256_file(tmp))
+
+    def writer(self):
+        """创建边写入边计算校验和的临时文件, 见 CacheWriter"""
+        return CacheWriter(self)
+
+    def remove(self, filehash):
+        with self._lock:
+            self._remove(filehash)
+
+    def clear(self):
+        with self._lock:
+            for filehash in list(self._index):
+                self._remove(filehash)
@@ -0,0 +1,373 @@
+# coding=utf-8
+# Copyright (c) 2016-2018 The Ulord Core Developers
+# @File  : transfer.py
+# @Author: Shu [Ulord DevTeam]
+# @Date  : 2018/9/29
+"""
+UDFS大文件传输. 上传时把数据流切成固定大小的块并行上传, 再用 UnixFS 文件节点把各块组合成一个根哈希;
+内存中同时只保留正在上传的几个块, 与文件大小无关.
+下载时解析哈希对应的DAG, 从一个或多个UDFS节点并行获取数据块, 写入预先分配好大小的文件中对应的位置,
+已完成的数据块记录在旁路进度文件中, 中断后可以继续. 也可以只读取文件中的一段字节.
+"""
+import io
+import itertools
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ucwallet.transport import get_transport
+from ucwallet.udfs.unixfs import (DEFAULT_CHUNK_SIZE, DIRECTORY, Link, MAX_LINKS, balanced_root, decode_node,
+                                   decode_unixfs, file_node, leaf_node, multihash)
+
+log = logging.getLogger("udfs")
+
+CHUNK_SIZE = 4 * 1024 * 1024  # 每个上传块的大小, 是 go-ipfs 默认分块(256KiB)的整数倍
+MAX_WORKERS = 4
+DOWNLOAD_WORKERS = 8
+PROGRESS_SUFFIX = ".udfs-progress"  # 下载进度文件的后缀
+SAVE_INTERVAL = 1.0  # 保存下载进度的最小间隔(秒)
+
+_write_lock = threading.Lock()
+
+
+class IsDirectoryError(ValueError):
+    """下载的哈希是目录, 不是文件"""
+
+
+def pwrite(fd, data, offset):
+    """在文件的指定位置写入, 不支持 os.pwrite 的平台(Windows)用 lseek + write"""
+    view = memoryview(data)
+    if hasattr(os, "pwrite"):
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        return
+    with _write_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while view:
+            view = view[os.write(fd, view):]
+
+
+def iter_chunks(source, chunk_size=CHUNK_SIZE):
+    """ 把数据源切成固定大小的块(最后一块可能较小)
+    :param source: 文件路径、文件对象、mmap/bytes/memoryview, 或者产生bytes的迭代器
+    """
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            for chunk in iter_chunks(f, chunk_size):
+                yield chunk
+    elif isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        view = memoryview(source)
+        for start in range(0, len(view), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+    elif hasattr(source, "read"):
+        while True:
+            # 非缓冲的流可能返回不足的数据, 读满一块再上传, 保证分块位置与数据源无关
+            chunk = source.read(chunk_size)
+            if not chunk:
+                return
+            while len(chunk) < chunk_size:
+                more = source.read(chunk_size - len(chunk))
+                if not more:
+                    break
+                chunk += more
+            yield chunk
+            if len(chunk) < chunk_size:
+                return
+    else:
+        buf = bytearray()
+        for data in source:
+            buf += data
+            while len(buf) >= chunk_size:
+                yield bytes(buf[:chunk_size])
+                del buf[:chunk_size]
+        if buf:
+            yield bytes(buf)
+
+
+def source_size(source):
+    """数据源的总大小, 无法预先知道时返回None"""
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    if isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        return len(source)
+    try:
+        return os.fstat(source.fileno()).st_size - source.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def _add_hash(chunks):
+    """按 ipfs add 默认参数计算若干个 256KiB 数据块组成的文件, 返回 (Link, 文件字节数)"""
+    leaves = []
+    for chunk in chunks:
+        leaf = leaf_node(chunk)
+        leaves.append((Link(multihash(leaf), "", len(leaf)), len(chunk)))
+    if not leaves:
+        leaf = leaf_node(b"")
+        leaves.append((Link(multihash(leaf), "", len(leaf)), 0))
+    return balanced_root(leaves)
+
+
+def content_hash(source, chunk_size=None):
+    """ 在本地计算数据源上传到UDFS后得到的哈希, 不发送任何数据
+    :param source: 数据源, 同 iter_chunks
+    :param chunk_size: 为None时与 Udfs.upload(ipfs add 默认参数: 256KiB分块, 平衡树布局)的结果相同;
+                       指定时与按该大小分块上传的 ChunkedUploader(Udfs.upload_stream)的结果相同
+    :return: (哈希, 文件字节数)
+    """
+    if chunk_size is None:
+        link, size = _add_hash(iter_chunks(source, DEFAULT_CHUNK_SIZE))
+        return link.hash, size
+    # ChunkedUploader 的每块通过 /add 上传, 各块的哈希再按平衡树组合
+    level = [_add_hash(iter_chunks(chunk, DEFAULT_CHUNK_SIZE)) for chunk in iter_chunks(source, chunk_size)]
+    if not level:
+        level = [_add_hash([])]
+    link, size = balanced_root(level)
+    return link.hash, size
+
+
+class ChunkedUploader(object):
+    """ 分块并行上传
+    每块通过 /add 上传为一个独立的文件, 所有块上传完成后按顺序组合为 UnixFS 文件节点(链接超过174个时分层),
+    通过 /block/put 上传并固定根节点. 同时在内存中的块不超过 max_workers + 1 个.
+    """
+
+    def __init__(self, udfs, chunk_size=CHUNK_SIZE, max_workers=MAX_WORKERS, progress=None, sink=None):
+        """
+        :param udfs: Udfs 对象
+        :param chunk_size: 每块的大小
+        :param max_workers: 并行上传的线程数
+        :param progress: 进度回调 progress(已上传字节数, 总字节数), 总字节数未知时为None
+        :param sink: 按顺序接收每块数据的对象(如缓存的 CacheWriter), 有 write 方法
+        """
+        self.udfs = udfs
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.progress = progress
+        self.sink = sink
+        self._lock = threading.Lock()
+        self._uploaded = 0
+
+    def _add(self, data):
+        """上传一块, 返回 Link(哈希, "", 累计大小)"""
+        from ipfsapi import multipart
+
+        client = self.udfs.connect
+        body, headers = multipart.stream_bytes(data, client.chunk_size)
+        result = client._client.request('/add', decoder='json', data=body, headers=headers)
+        if isinstance(result, list):
+            result = result[-1]
+        return Link(result["Hash"], "", int(result["Size"]))
+
+    def _put(self, node):
+        """上传一个dag-pb节点, 返回它的哈希"""
+        key = self.udfs.connect.block_put(io.BytesIO(node))["Key"]
+        if key != multihash(node):
+            log.warning("udfs returned {} for node {}".format(key, multihash(node)))
+        return key
+
+    def _uploaded_chunk(self, size, total):
+        with self._lock:
+            self._uploaded += size
+            uploaded = self._uploaded
+        if self.progress is not None:
+            self.progress(uploaded, total)
+
+    def _link(self, children):
+        """把若干个子节点组合为一个文件节点, 返回 (Link, 文件字节数)"""
+        node = file_node(children)
+        size = len(node) + sum(link.size for link, _ in children)
+        return Link(self._put(node), "", size), sum(filesize for _, filesize in children)
+
+    def upload(self, source):
+        """ 上传数据源
+        :return: {"Hash": 根哈希, "Size": 文件字节数, "Chunks": 块数}
+        """
+        total = source_size(source)
+        window = threading.BoundedSemaphore(self.max_workers + 1)
+        failed = threading.Event()
+        futures = []
+
+        def done(future, size):
+            window.release()
+            if future.exception() is None:
+                self._uploaded_chunk(size, total)
+            else:
+                failed.set()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for chunk in iter_chunks(source, self.chunk_size):
+                # 窗口满时等待, 读取速度不会超过上传速度
+                window.acquire()
+                if failed.is_set():
+                    window.release()
+                    break
+                if self.sink is not None:
+                    self.sink.write(chunk)
+                future = pool.submit(self._add, chunk)
+                future.add_done_callback(lambda f, size=len(chunk): done(f, size))
+                futures.append((future, len(chunk)))
+                del chunk
+        level = [(future.result(), size) for future, size in futures]
+        if not level:
+            level = [(self._add(b""), 0)]
+        if len(level) == 1:
+            link, size = level[0]
+        else:
+            while len(level) > MAX_LINKS:
+                level = [self._link(level[i:i + MAX_LINKS]) for i in range(0, len(level), MAX_LINKS)]
+            link, size = self._link(level)
+        self.udfs.connect.pin_add(link.hash)
+        self.udfs.log.info("upload {} bytes in {} chunks: {}".format(size, len(futures), link.hash))
+        return {"Hash": link.hash, "Size": size, "Chunks": len(futures)}
+
+
+class ParallelDownloader(object):
+    """ 并行下载
+    按文件顺序遍历 UnixFS DAG, 预取窗口内的 2 * max_workers 个数据块在线程池中并行获取,
+    每个数据块在多个节点之间按 Transport 的策略选择, 连接失败时切换到其他节点, 获取后校验哈希.
+    """
+
+    def __init__(self, gateways, max_workers=DOWNLOAD_WORKERS, progress=None, save_interval=SAVE_INTERVAL):
+        """
+        :param gateways: UDFS节点的API地址列表, 如 ["http://114.67.37.2:20418"]
+        :param max_workers: 并行获取的线程数
+        :param progress: 进度回调 progress(已下载字节数, 总字节数)
+        :param save_interval: 保存下载进度的最小间隔(秒)
+        """
+        if isinstance(gateways, str):
+            gateways = [gateways]
+        self.transport = get_transport([g.rstrip("/") + "/api/v0/block/get" for g in gateways])
+        self.max_workers = max_workers
+        self.progress = progress
+        self.save_interval = save_interval
+
+    def fetch(self, block_hash):
+        """获取一个数据块并校验哈希"""
+        response = self.transport.post(params={"arg": block_hash})
+        response.raise_for_status()
+        data = response.content
+        if multihash(data) != block_hash:
+            raise ValueError("Block {} failed hash verification.".format(block_hash))
+        return data
+
+    def _decode(self, block_hash):
+        node = decode_node(self.fetch(block_hash))
+        return node, decode_unixfs(node.data)
+
+    def stat(self, filehash):
+        """ 文件的根节点信息
+        :return: (根节点, UnixFS数据, 文件字节数)
+        """
+        node, data = self._decode(filehash)
+        if data.type == DIRECTORY:
+            raise IsDirectoryError("{} is a directory.".format(filehash))
+        size = data.filesize if data.filesize is not None else len(data.data or b"")
+        return node, data, size
+
+    def _walk(self, pool, filehash, start, end, skip=()):
+        """ 按顺序返回 [start, end) 内的数据
+        :param skip: 不需要获取的叶子节点 "偏移:哈希"
+        :return: 迭代 (偏移, 数据, 叶子节点键), 中间节点自带的数据没有键
+        """
+        window = self.max_workers * 2
+        queue = deque([[filehash, 0, None]])
+        while queue:
+            for item in itertools.islice(queue, window):
+                if item[2] is None:
+                    item[2] = pool.submit(self._decode, item[0])
+            block_hash, offset, future = queue.popleft()
+            node, data = future.result()
+            inline = data.data or b""
+            low, high = max(start, offset), min(end, offset + len(inline))
+            if low < high:
+                yield low, inline[low - offset:high - offset], None if node.links else "{}:{}".format(offset,
+                                                                                                     block_hash)
+            if not node.links:
+                continue
+            if len(data.blocksizes) != len(node.links):
+                raise ValueError("Block {} is not a UnixFS file node.".format(block_hash))
+            children = []
+            child_offset = offset + len(inline)
+            for link, size in zip(node.links, data.blocksizes):
+                if child_offset < end and child_offset + size > start and \
+                        "{}:{}".format(child_offset, link.hash) not in skip:
+                    children.append([link.hash, child_offset, None])
+                child_offset += size
+            queue.extendleft(reversed(children))
+
+    def read_range(self, filehash, start=0, end=None):
+        """ 读取文件中的一段字节 [start, end), 只获取与这一段重叠的数据块
+        :return: 按顺序迭代的bytes
+        """
+        _, _, size = self.stat(filehash)
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for _, data, _ in self._walk(pool, filehash, start, end):
+                yield data
+
+    @staticmethod
+    def _load_progress(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _save_progress(path, state):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, path)
+
+    def download(self, filehash, path):
+        """ 下载文件, 中断后使用相同的参数再次调用会从进度文件继续
+        :param path: 保存的文件路径, 进度保存在 path + ".udfs-progress"
+        :return: path
+        """
+        _, _, size = self.stat(filehash)
+        progress_path = path + PROGRESS_SUFFIX
+        state = self._load_progress(progress_path)
+        if state is None or state.get("hash") != filehash or state.get("size") != size or not os.path.isfile(path):
+            state = {"hash": filehash, "size": size, "done": {}}
+            with open(path, "wb") as f:
+                f.truncate(size)
+        done = state["done"]
+        downloaded = sum(done.values())
+        saved_at = time.time()
+        fd = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for offset, data, key in self._walk(pool, filehash, 0, size, skip=done):
+                    pwrite(fd, data, offset)
+                    if key is None:
+                        continue
+                    done[key] = len(data)
+                    downloaded += len(data)
+                    if self.progress is not None:
+                        self.progress(downloaded, size)
+                    if time.time() - saved_at >= self.save_interval:
+                        # 进度只记录已经写入的数据块, 中断时最多重新下载最近一段时间的数据
+                        os.fsync(fd)
+                        self._save_progress(progress_path, state)
+                        saved_at = time.time()
+            os.fsync(fd)
+        except BaseException:
+            os.fsync(fd)
+            self._save_progress(progress_path, state)
+            raise
+        finally:
+            os.close(fd)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        return path
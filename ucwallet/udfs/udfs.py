@@ -16,55 +16,196 @@ import atexit
 import copy
 from uuid import uuid1
 
-import ipfsapi
-
+import dconfig
+from ucwallet.transport import get_transport
 from ucwallet.version import PACKAGE_ROOT
 
 
 class Udfs():
     """udfs helper"""
 
-    def __init__(self, host='114.67.37.2', port='20418'):
-        """init a connector"""
-        self.connect = ipfsapi.connect(host=host, port=port)
+    def __init__(self, host='114.67.37.2', port='20418', cache_size=None):
+        """
+        init a connector
+
+        :param cache_size: size limit in bytes of the local udfs cache, 0 disables the cache,
+                           default is dconfig.UDFS_CACHE_SIZE
+        """
         self.log = logging.getLogger("udfs")
+        self.cache_size = dconfig.UDFS_CACHE_SIZE if cache_size is None else cache_size
+        self._cache = None
+        self.config(host, port)
+
+    def config(self, host, port, gateways=None):
+        """
+        change connect
+
+        The client reuses the pooled keep-alive stream session of the shared transport for this node,
+        so switching nodes or creating more helpers does not open new connections from scratch.
+        That session has no default timeout and never retries, streamed upload bodies are sent only once.
+
+        :param gateways: udfs API addresses used for downloads, such as ["http://host:port"],
+                         default is this node only
+        """
+        self.host = host
+        self.port = port
+        self.transport = get_transport("http://{}:{}".format(host, port))
+        self.gateways = list(gateways) if gateways else ["http://{}:{}".format(host, port)]
+        self._connect = None
 
-    def config(self, host, port):
-        """change connect"""
-        self.connect = ipfsapi.connect(host=host, port=port)
+    @property
+    def connect(self):
+        """udfs client, ipfsapi is imported when the client is first used"""
+        if self._connect is None:
+            import ipfsapi
+            self._connect = ipfsapi.Client(host=self.host, port=self.port)
+            self._connect._client._session = self.transport.stream_session
+        return self._connect
 
-    def upload(self, filepath):
-        """upload a file to udfs"""
+    @property
+    def cache(self):
+        """local content-addressed cache, the index is rebuilt when it is first used. None if disabled"""
+        if self._cache is None and self.cache_size:
+            from ucwallet.udfs.cache import UdfsCache
+            self._cache = UdfsCache(os.path.join(dconfig.prepare_user_data_dir(), "udfs_cache"), self.cache_size)
+        return self._cache
+
+    def _cache_file(self, filehash, path):
+        if self.cache is not None:
+            try:
+                self.cache.put_file(filehash, path)
+            except OSError as e:
+                self.log.warning("cache {} fail: {}".format(filehash, e))
+
+    def content_hash(self, source, chunk_size=None):
+        """
+        compute the udfs hash of a file locally without sending any bytes
+
+        :param source: a file path, a file object, a mmap/bytes object or an iterator of bytes
+        :param chunk_size: None for the hash given by upload (ipfs add defaults),
+                           or the chunk size passed to upload_stream for the hash given by upload_stream
+        :return: udfs hash
+        """
+        from ucwallet.udfs.transfer import content_hash
+        return content_hash(source, chunk_size)[0]
+
+    def upload(self, filepath, published=None):
+        """
+        upload a file to udfs, file objects and iterators are uploaded by upload_stream
+
+        :param published: callable(udfs_hash) returning True if the content is already published,
+                          such as EventIndexer.is_published. The hash is computed locally first and
+                          a published file is not uploaded, the result then has "Duplicate": True
+        """
+        if not isinstance(filepath, str):
+            return self.upload_stream(filepath)
         if os.path.isfile(filepath):
-            return self.connect.add(filepath)
+            if published is not None:
+                filehash = self.content_hash(filepath)
+                if published(filehash):
+                    self.log.info("{} is already published: {}, skip the upload".format(filepath, filehash))
+                    self._cache_file(filehash, filepath)
+                    return {"Name": os.path.basename(filepath), "Hash": filehash, "Duplicate": True}
+            result = self.connect.add(filepath)
+            self._cache_file(result["Hash"], filepath)
+            return result
         else:
             self.log.error("Not a file:{}".format(filepath))
             return None
 
+    def upload_stream(self, source, chunk_size=None, max_workers=None, progress=None):
+        """
+        upload a large file in fixed-size chunks over a pool of workers
+
+        Memory use is bounded by (max_workers + 1) * chunk_size whatever the file size.
+        The chunks are linked into one UnixFS file whose root hash is returned.
+
+        :param source: a file path, a file object, a mmap/bytes object or an iterator of bytes
+        :param chunk_size: size of each chunk, default is 4MiB
+        :param max_workers: number of concurrent chunk uploads, default is 4
+        :param progress: callback progress(uploaded_bytes, total_bytes), total_bytes is None if unknown
+        :return: {"Hash": root hash, "Size": file size, "Chunks": number of chunks}
+        """
+        from ucwallet.udfs.transfer import CHUNK_SIZE, MAX_WORKERS, ChunkedUploader
+        # 上传的同时写入本地缓存, 之后下载同一个哈希时不需要再访问节点
+        writer = self.cache.writer() if self.cache is not None else None
+        uploader = ChunkedUploader(self,
+                                   chunk_size=chunk_size if chunk_size else CHUNK_SIZE,
+                                   max_workers=max_workers if max_workers else MAX_WORKERS,
+                                   progress=progress,
+                                   sink=writer)
+        try:
+            result = uploader.upload(source)
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            writer.commit(result["Hash"])
+        return result
+
+    def _downloader(self, max_workers=None, progress=None):
+        from ucwallet.udfs.transfer import DOWNLOAD_WORKERS, ParallelDownloader
+        return ParallelDownloader(self.gateways, max_workers=max_workers if max_workers else DOWNLOAD_WORKERS,
+                                  progress=progress)
+
+    def download(self, filehash, path, max_workers=None, progress=None):
+        """
+        download a file in parallel blocks from the gateways, resumable after interruption
+
+        The blocks are verified and written into a preallocated file, the finished blocks
+        are recorded in path + ".udfs-progress" until the download completes.
+
+        :param filehash: file udfs hash
+        :param path: the file path to save to
+        :param max_workers: number of concurrent block downloads, default is 8
+        :param progress: callback progress(downloaded_bytes, total_bytes)
+        :return: path
+        """
+        if self.cache is not None and self.cache.copy_to(filehash, path):
+            self.log.info("download {} from the local cache".format(filehash))
+            return path
+        self._downloader(max_workers, progress).download(filehash, path)
+        self._cache_file(filehash, path)
+        return path
+
+    def read_range(self, filehash, start=0, end=None, max_workers=None):
+        """
+        read bytes [start, end) of a file, only the blocks overlapping the range are downloaded
+
+        :return: an iterator of bytes in order
+        """
+        return self._downloader(max_workers).read_range(filehash, start, end)
+
     def downloadhash(self, filehash, filepath=None, Debug=False):
         """
         download file from the UDFS according to the udfs hash
 
         :param filehash: file udfs hash
         :type filehash: str
-        :param filepath: the path to save the file
+        :param filepath: the directory to save the file, the file is named by its hash
         :type filepath: str
         :param Debug: if Debug print the cost time
         :type Debug: bool
         :return: True or False
         """
+        from ucwallet.udfs.transfer import IsDirectoryError
+        start = time.time()
+        target = os.path.join(filepath if filepath else os.getcwd(), filehash)
         try:
-            start = time.time()
-            self.connect.get(filehash, filepath=filepath)
-            if Debug:
-                end = time.time()
-                self.log.debug('download {0} cost:{1}'.format(filehash, (end - start)))
-                print('download {0} cost:{1}'.format(filehash, (end - start)))
-            self.log.info("download {} successfully!".format(filehash))
-            return True
+            try:
+                self.download(filehash, target)
+            except IsDirectoryError:
+                # 目录仍然通过 /get 整体下载
+                self.connect.get(filehash, filepath=filepath)
         except Exception as e:
-            logging.error("download fail:{}".format(e))
+            self.log.error("download {} fail: {}: {}".format(filehash, type(e).__name__, e))
             return False
+        cost = time.time() - start
+        self.log.info("download {} successfully, cost: {:.2f}s".format(filehash, cost))
+        if Debug:
+            print('download {0} cost:{1}'.format(filehash, cost))
+        return True
 
 
 if __name__ == '__main__':
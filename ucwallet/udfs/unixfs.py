@@ -0,0 +1,187 @@
+# coding=utf-8
+# Copyright (c) 2016-2018 The Ulord Core Developers
+# @File  : unixfs.py
+# @Author: Shu [Ulord DevTeam]
+# @Date  : 2018/9/29
+"""
+UDFS(IPFS)对象的编码和解码: dag-pb 节点(PBNode/PBLink)、UnixFS 数据和 base58 哈希.
+只实现文件分块需要的部分, 编码结果与 go-ipfs 一致, 同样的节点得到同样的哈希.
+"""
+import hashlib
+from collections import namedtuple
+
+# UnixFS 数据类型
+RAW = 0
+DIRECTORY = 1
+FILE = 2
+
+# go-ipfs 平衡树布局中每个节点的最大链接数
+MAX_LINKS = 174
+# go-ipfs 默认的分块大小(size-262144)
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+B58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+Link = namedtuple("Link", ["hash", "name", "size"])  # hash 为 base58 字符串, size 为子树的累计大小
+Node = namedtuple("Node", ["links", "data"])
+UnixFSData = namedtuple("UnixFSData", ["type", "data", "filesize", "blocksizes"])
+
+
+def b58encode(data):
+    number = int.from_bytes(data, "big")
+    chars = []
+    while number:
+        number, rem = divmod(number, 58)
+        chars.append(B58_ALPHABET[rem])
+    pad = len(data) - len(data.lstrip(b"\0"))
+    return "1" * pad + "".join(reversed(chars))
+
+
+def b58decode(text):
+    number = 0
+    for char in text:
+        number = number * 58 + B58_ALPHABET.index(char)
+    pad = len(text) - len(text.lstrip("1"))
+    body = number.to_bytes((number.bit_length() + 7) // 8, "big") if number else b""
+    return b"\0" * pad + body
+
+
+def multihash(data):
+    """节点数据的 sha2-256 multihash(CIDv0), 返回 base58 字符串"""
+    return b58encode(b"\x12\x20" + hashlib.sha256(data).digest())
+
+
+# protobuf 编码
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _field(number, wire_type):
+    return _varint(number << 3 | wire_type)
+
+
+def _bytes_field(number, value):
+    return _field(number, 2) + _varint(len(value)) + value
+
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _fields(buf):
+    """依次返回 (字段号, 值), 只支持 varint 和 length-delimited 两种类型"""
+    pos = 0
+    while pos < len(buf):
+        key, pos = _read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value = bytes(buf[pos:pos + length])
+            pos += length
+        else:
+            raise ValueError("unsupported protobuf wire type {}".format(wire_type))
+        yield number, value
+
+
+def encode_unixfs(type_, data=None, filesize=None, blocksizes=()):
+    out = _field(1, 0) + _varint(type_)
+    if data is not None:
+        out += _bytes_field(2, data)
+    if filesize is not None:
+        out += _field(3, 0) + _varint(filesize)
+    for size in blocksizes:
+        out += _field(4, 0) + _varint(size)
+    return out
+
+
+def decode_unixfs(buf):
+    type_, data, filesize, blocksizes = None, None, None, []
+    for number, value in _fields(buf):
+        if number == 1:
+            type_ = value
+        elif number == 2:
+            data = value
+        elif number == 3:
+            filesize = value
+        elif number == 4:
+            blocksizes.append(value)
+    return UnixFSData(type_, data, filesize, blocksizes)
+
+
+def encode_node(links, data):
+    """编码 dag-pb 节点, 与 go-ipfs 相同: 先写链接, 再写数据"""
+    out = b""
+    for link in links:
+        body = _bytes_field(1, b58decode(link.hash)) + _bytes_field(2, link.name.encode("utf-8"))
+        body += _field(3, 0) + _varint(link.size)
+        out += _bytes_field(2, body)
+    return out + _bytes_field(1, data)
+
+
+def decode_node(buf):
+    links, data = [], b""
+    for number, value in _fields(buf):
+        if number == 1:
+            data = value
+        elif number == 2:
+            hash_, name, size = b"", "", 0
+            for n, v in _fields(value):
+                if n == 1:
+                    hash_ = v
+                elif n == 2:
+                    name = v.decode("utf-8")
+                elif n == 3:
+                    size = v
+            links.append(Link(b58encode(hash_), name, size))
+    return Node(links, data)
+
+
+def file_node(children):
+    """ 用若干个子文件节点组成一个 UnixFS 文件节点
+    :param children: [(Link, 子文件的字节数), ...]
+    :return: 编码后的节点
+    """
+    sizes = [filesize for _, filesize in children]
+    data = encode_unixfs(FILE, filesize=sum(sizes), blocksizes=sizes)
+    return encode_node([link for link, _ in children], data)
+
+
+def leaf_node(data):
+    """ ipfs add 默认参数(CIDv0, 非raw叶子)下一个数据块的叶子节点, 空数据时不写 data 字段"""
+    return encode_node([], encode_unixfs(FILE, data=data if data else None, filesize=len(data)))
+
+
+def balanced_root(children):
+    """ 在本地按平衡树布局组合文件节点, 不上传
+    每 MAX_LINKS 个节点组成上一层的一个节点, 直到只剩一个根节点; 与 go-ipfs 的平衡树布局结果相同
+    :param children: [(Link, 子文件的字节数), ...], 至少一个
+    :return: (根节点的 Link, 文件字节数)
+    """
+    level = list(children)
+    while len(level) > 1:
+        parents = []
+        for i in range(0, len(level), MAX_LINKS):
+            group = level[i:i + MAX_LINKS]
+            node = file_node(group)
+            size = len(node) + sum(link.size for link, _ in group)
+            parents.append((Link(multihash(node), "", size), sum(filesize for _, filesize in group)))
+        level = parents
+    return level[0]